@@ -0,0 +1,191 @@
+"""
+Набор замеров редактора без терминала (через harness.FakeScreen).
+
+    python benchmarks/bench_editor.py [--sizes 1000,10000,100000,1000000] [--only latency,highlight,io,undo]
+
+latency    задержка нажатие → кадр (p50/p99/max) при наборе, переходах по
+           строкам и страницам и поиске, байты вывода на кадр
+highlight  пропускная способность лексеров по языкам (строк/с, МБ/с)
+io         время открытия и сохранения файла
+undo       память истории правок после серии нажатий
+
+Файлы каждого размера генерируются во временном каталоге; отдельно
+меряется файл с длинными строками.
+"""
+import argparse
+import curses
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import harness
+from bench_highlight import SAMPLES
+from harness import unislate
+
+EXTENSIONS = {"python": ".py", "js": ".js", "c": ".c", "java": ".java", "markdown": ".md"}
+LONG_LINE_CHARS = 20000
+LONG_LINE_COUNT = 200
+
+COLORS = {
+    "default": 0, "keyword": 1, "string": 2, "comment": 3,
+    "number": 4, "md_header": 5, "md_link": 6,
+}
+
+
+def make_lines(lang, count):
+    sample = SAMPLES[lang]
+    return (sample * (count // len(sample) + 1))[:count]
+
+
+def write_file(directory, name, lines):
+    path = os.path.join(directory, name)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines))
+        f.write("\n")
+    return path
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def human_bytes(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024 or unit == "GB":
+            return f"{n:.0f}{unit}" if unit == "B" else f"{n:.1f}{unit}"
+        n /= 1024
+
+
+##############################
+# Сценарии
+##############################
+
+def latency_scenarios():
+    """(название, пачки клавиш); каждая клавиша — отдельная пачка и отдельный кадр."""
+    typing = harness.type_text("value = compute(42)  # note\n") * 4
+    return [
+        ("type", harness.burst_per_key(typing)),
+        ("scroll", harness.burst_per_key([curses.KEY_DOWN] * 200 + [curses.KEY_UP] * 50)),
+        ("page", harness.burst_per_key([curses.KEY_NPAGE] * 50 + [curses.KEY_PPAGE] * 20 + [curses.KEY_END])),
+        ("edit-far", harness.burst_per_key([curses.KEY_DOWN] * 100 + harness.type_text("x\n") * 20
+                                           + [curses.KEY_BACKSPACE] * 40)),
+        ("find", harness.burst_per_key([6] + harness.type_text("return") + [curses.KEY_DOWN] * 10 + [10])),
+    ]
+
+
+def bench_latency(files):
+    print(f"{'file':<18} {'scenario':<10} {'frames':>7} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8} {'B/frame':>8}")
+    for label, path in files:
+        for name, bursts in latency_scenarios():
+            screen = harness.run_editor(path, bursts)
+            lat = [t * 1000 for t in screen.latencies]
+            per_frame = screen.bytes_emitted / max(screen.frames, 1)
+            print(f"{label:<18} {name:<10} {screen.frames:>7} {percentile(lat, 50):>8.2f} "
+                  f"{percentile(lat, 99):>8.2f} {max(lat, default=0):>8.2f} {per_frame:>8.0f}")
+
+
+def bench_highlight(count):
+    # Холодный проход по файлу с переносом состояния между строками, без кэша
+    print(f"{'language':<10} {'lines':>9} {'lines/s':>12} {'MB/s':>8}")
+    for lang in SAMPLES:
+        lines = make_lines(lang, count)
+        lexer = unislate.get_lexer("sample" + EXTENSIONS[lang])
+        size_mb = sum(len(line) + 1 for line in lines) / 1e6
+        start = time.perf_counter()
+        state = None
+        for line in lines:
+            state = lexer.lex(line, state, COLORS)[1]
+        elapsed = time.perf_counter() - start
+        print(f"{lang:<10} {count:>9,} {count / elapsed:>12,.0f} {size_mb / elapsed:>8.1f}")
+
+
+def bench_io(files):
+    # edit+save — сохранение после одной правки в середине файла: у отображённых
+    # файлов нетронутые части копируются без декодирования
+    print(f"{'file':<18} {'size':>9} {'load s':>8} {'save s':>8} {'edit+save s':>12}")
+    for label, path in files:
+        size = os.path.getsize(path)
+        start = time.perf_counter()
+        buf = unislate.load_file(path)
+        buf.finish_loading()
+        loaded = time.perf_counter() - start
+        start = time.perf_counter()
+        unislate.save_file(path + ".out", buf)
+        saved = time.perf_counter() - start
+        buf.insert(buf.line_start(buf.line_count() // 2), "x")
+        start = time.perf_counter()
+        unislate.save_file(path + ".out", buf)
+        edited = time.perf_counter() - start
+        os.unlink(path + ".out")
+        print(f"{label:<18} {human_bytes(size):>9} {loaded:>8.3f} {saved:>8.3f} {edited:>12.3f}")
+
+
+def bench_undo(files, edits=2000):
+    print(f"{'file':<18} {'edits':>6} {'steps':>6} {'history':>9} {'traced':>9} {'edit us':>8}")
+    for label, path in files:
+        buf = unislate.load_file(path)
+        buf.finish_loading()
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        history = unislate.UndoHistory(buf)
+        line_count = buf.line_count()
+        start = time.perf_counter()
+        for i in range(edits):
+            # Чередуем набор в разных местах файла, Enter и Backspace
+            y = (i * 7919) % line_count
+            pos = buf.line_start(y)
+            if i % 3 == 2:
+                history.begin(None, "delete")
+                if pos:
+                    buf.delete(pos - 1, pos)
+            else:
+                history.begin(None, "insert" if i % 3 == 0 else None)
+                buf.insert(pos, "x" if i % 3 == 0 else "\n")
+        elapsed = time.perf_counter() - start
+        traced = tracemalloc.get_traced_memory()[0] - base
+        tracemalloc.stop()
+        print(f"{label:<18} {edits:>6} {len(history.undo_stack):>6} {human_bytes(history.bytes_used):>9} "
+              f"{human_bytes(traced):>9} {elapsed / edits * 1e6:>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="1000,10000,100000,1000000",
+                        help="размеры файлов в строках через запятую")
+    parser.add_argument("--only", default="latency,highlight,io,undo",
+                        help="какие замеры запускать")
+    parser.add_argument("--highlight-lines", type=int, default=100000)
+    args = parser.parse_args()
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+    only = set(args.only.split(","))
+
+    directory = tempfile.mkdtemp(prefix="unislate-bench-")
+    try:
+        files = []
+        for size in sizes:
+            files.append((f"py {size:,}", write_file(directory, f"lines_{size}.py", make_lines("python", size))))
+        long_lines = ["x = '" + "abc def " * (LONG_LINE_CHARS // 8) + "'"] * LONG_LINE_COUNT
+        files.append((f"long {LONG_LINE_COUNT}x{LONG_LINE_CHARS // 1000}k",
+                      write_file(directory, "long_lines.py", long_lines)))
+
+        sections = (
+            ("latency", "Keystroke-to-frame latency", lambda: bench_latency(files)),
+            ("highlight", "Highlighter throughput", lambda: bench_highlight(args.highlight_lines)),
+            ("io", "Load / save", lambda: bench_io(files)),
+            ("undo", "Undo memory", lambda: bench_undo(files)),
+        )
+        for key, title, run in sections:
+            if key in only:
+                print(f"\n== {title} ==")
+                run()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""
+Пропускная способность подсветки: однопроходные лексеры unislate
+против прежних многопроходных подсветчиков (finditer по каждому виду
+токенов + сортировка).
+
+    python benchmarks/bench_highlight.py [--lines N] [--repeat R]
+
+Для каждого языка печатает строк/с и МБ/с для обеих реализаций и число
+строк, у которых прежняя реализация выдавала искажённые сегменты
+(перекрывающиеся токены — склейка сегментов не равна исходной строке).
+"""
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import unislate  # noqa: E402
+
+##############################
+# Прежние многопроходные подсветчики
+##############################
+
+LEGACY_PY = (
+    re.compile(r"#.*"),
+    re.compile(r'(\'[^\']*\'|"[^"]*")'),
+    re.compile(r'\b(' + '|'.join(unislate.PYTHON_KEYWORDS) + r')\b'),
+    re.compile(r'\b\d+(\.\d+)?\b'),
+)
+LEGACY_JS = (
+    re.compile(r"(//.*|/\*.*?\*/)", re.DOTALL),
+    re.compile(r'(".*?"|\'.*?\'|`.*?`)', re.DOTALL),
+    re.compile(r'\b(' + '|'.join(unislate.JS_KEYWORDS) + r')\b'),
+    re.compile(r'\b\d+(\.\d+)?\b'),
+)
+LEGACY_C = (
+    re.compile(r"(//.*|/\*.*?\*/)", re.DOTALL),
+    re.compile(r'(".*?"|\'.*?\')', re.DOTALL),
+    re.compile(r'\b(' + '|'.join(unislate.C_KEYWORDS) + r')\b'),
+    re.compile(r'\b\d+(\.\d+)?\b'),
+)
+LEGACY_JAVA = (
+    re.compile(r"(//.*|/\*.*?\*/)", re.DOTALL),
+    re.compile(r'(".*?"|\'.*?\')', re.DOTALL),
+    re.compile(r'\b(' + '|'.join(unislate.JAVA_KEYWORDS) + r')\b'),
+    re.compile(r'\b\d+(\.\d+)?\b'),
+)
+LEGACY_MD_HEADER = re.compile(r'^(#{1,6})\s*(.*)$')
+LEGACY_MD_LINK = re.compile(r'(\[.*?\]\(.*?\))')
+
+
+def legacy_highlight_generic(line, regexes, colors):
+    comment_re, string_re, keyword_re, number_re = regexes
+    segments = []
+    tokens = []
+    for m in comment_re.finditer(line):
+        tokens.append((m.start(), m.end(), "comment"))
+    for m in string_re.finditer(line):
+        tokens.append((m.start(), m.end(), "string"))
+    for m in keyword_re.finditer(line):
+        tokens.append((m.start(), m.end(), "keyword"))
+    for m in number_re.finditer(line):
+        tokens.append((m.start(), m.end(), "number"))
+    if not tokens:
+        return [(line, colors["default"])]
+    tokens.sort(key=lambda x: x[0])
+    last_idx = 0
+    for start, end, ttype in tokens:
+        if start > last_idx:
+            segments.append((line[last_idx:start], colors["default"]))
+        segments.append((line[start:end], colors.get(ttype, colors["default"])))
+        last_idx = end
+    if last_idx < len(line):
+        segments.append((line[last_idx:], colors["default"]))
+    return segments
+
+
+def legacy_highlight_markdown(line, colors):
+    segments = []
+    m = LEGACY_MD_HEADER.match(line)
+    if m:
+        header_marks, header_text = m.groups()
+        segments.append((header_marks + " ", colors["default"]))
+        segments.append((header_text, colors["md_header"]))
+        return segments
+    last = 0
+    for m in LEGACY_MD_LINK.finditer(line):
+        start, end = m.span()
+        if start > last:
+            segments.append((line[last:start], colors["default"]))
+        segments.append((line[start:end], colors["md_link"]))
+        last = end
+    if last < len(line):
+        segments.append((line[last:], colors["default"]))
+    if not segments:
+        segments = [(line, colors["default"])]
+    return segments
+
+##############################
+# Образцы кода
+##############################
+
+SAMPLES = {
+    "python": [
+        "def handler(request, retries=3):",
+        "    # retry loop for flaky upstream, see issue 42",
+        "    for attempt in range(retries):",
+        "        if request.status == 200 and not request.cached:",
+        "            return {'status': 'ok', 'body': \"return if for\", 'n': 3.14}",
+        "        value = compute(attempt * 2 + 1)  # if this fails, raise",
+        "    raise RuntimeError('giving up after %d attempts' % retries)",
+        "",
+    ],
+    "js": [
+        "export function render(items, opts = {}) {",
+        "  // render every item unless it is hidden",
+        "  const out = items.filter(x => !x.hidden).map(x => `<li>${x.name}</li>`);",
+        "  if (opts.limit > 0 && out.length > opts.limit) { return out.slice(0, 10); }",
+        "  let label = \"for each item in list\"; /* inline note */ var n = 42;",
+        "  return out.join('');",
+        "}",
+        "",
+    ],
+    "c": [
+        "static int parse_header(const char *buf, size_t len, struct hdr *out) {",
+        "    /* header layout: magic, version, flags */",
+        "    if (len < 16) return -1;  // too short",
+        "    out->magic = read_u32(buf); out->version = buf[4];",
+        "    for (int i = 0; i < 8; i++) { out->flags[i] = buf[8 + i]; }",
+        "    printf(\"version %d, while parsing\\n\", out->version);",
+        "    return 0;",
+        "}",
+    ],
+    "java": [
+        "public final class Cache<K, V> implements Store<K, V> {",
+        "    private static final int DEFAULT_SIZE = 1024; // entries",
+        "    @Override public synchronized V get(K key) {",
+        "        if (key == null) throw new IllegalArgumentException(\"null key in get\");",
+        "        for (int i = 0; i < buckets.length; i++) { /* scan */ }",
+        "        return map.getOrDefault(key, null);",
+        "    }",
+        "}",
+    ],
+    "markdown": [
+        "# Unislate benchmark",
+        "",
+        "See the [README](README.md) and the [issue tracker](https://example.com/issues).",
+        "## Results",
+        "###Compact heading",
+        "Plain paragraph text without any markup at all, just words and numbers 123.",
+        "- item with a [link](x) in it",
+    ],
+}
+
+IMPLEMENTATIONS = {
+    "python": (lambda line, c: legacy_highlight_generic(line, LEGACY_PY, c), unislate.highlight_python_line),
+    "js": (lambda line, c: legacy_highlight_generic(line, LEGACY_JS, c), unislate.highlight_js_line),
+    "c": (lambda line, c: legacy_highlight_generic(line, LEGACY_C, c), unislate.highlight_c_line),
+    "java": (lambda line, c: legacy_highlight_generic(line, LEGACY_JAVA, c), unislate.highlight_java_line),
+    "markdown": (legacy_highlight_markdown, unislate.highlight_markdown_line),
+}
+
+COLORS = {
+    "default": 0, "keyword": 1, "string": 2, "comment": 3,
+    "number": 4, "md_header": 5, "md_link": 6,
+}
+
+
+def run(func, lines, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for line in lines:
+            func(line, COLORS)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def garbled(func, lines):
+    return sum(1 for line in lines if "".join(t for t, _ in func(line, COLORS)) != line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--lines", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'language':<10} {'impl':<8} {'lines/s':>12} {'MB/s':>8} {'garbled':>8}")
+    for lang, sample in SAMPLES.items():
+        lines = (sample * (args.lines // len(sample) + 1))[:args.lines]
+        size_mb = sum(len(line) + 1 for line in lines) / 1e6
+        legacy, current = IMPLEMENTATIONS[lang]
+        results = []
+        for name, func in (("legacy", legacy), ("single", current)):
+            elapsed = run(func, lines, args.repeat)
+            results.append(elapsed)
+            print(f"{lang:<10} {name:<8} {len(lines) / elapsed:>12,.0f} {size_mb / elapsed:>8.1f} "
+                  f"{garbled(func, sample):>8}")
+        print(f"{lang:<10} speedup  {results[0] / results[1]:>12.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Время запуска редактора.
+
+    python benchmarks/bench_startup.py [--runs N] [--top K]
+
+import     время `import unislate` по `python -X importtime`: итог и самые
+           дорогие модули (собственное и накопленное время, мс)
+first-frame  от запуска процесса до первого кадра (через harness.FakeScreen)
+           для пустого редактора и файлов разных типов; для сравнения —
+           запуск пустого интерпретатора
+
+Каждый замер — отдельный процесс; печатается медиана и минимум по --runs.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+FILES = {
+    "python": ("sample.py", "def main(argv):\n    return len(argv)  # count\n" * 50),
+    "markdown": ("notes.md", "# Title\n\nSee [docs](https://example.com).\n" * 50),
+    "text": ("notes.txt", "plain text line\n" * 50),
+}
+
+
+def import_times(runs):
+    """Медиана итогового времени импорта и разбивка последнего запуска по модулям."""
+    totals = []
+    modules = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import unislate"],
+                                cwd=os.path.join(HERE, ".."), capture_output=True, text=True, check=True)
+        modules = []
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:") or "|" not in line or "self [us]" in line:
+                continue
+            self_us, cumulative_us, name = line[len("import time:"):].split("|")
+            modules.append((name.strip(), int(self_us) / 1000, int(cumulative_us) / 1000))
+        totals.append(next(cum for name, _, cum in modules if name == "unislate"))
+    return totals, modules
+
+
+def child_first_frame(filename):
+    """Выполняется в дочернем процессе: печатает время первого кадра по часам CLOCK_MONOTONIC."""
+    import harness
+
+    first = []
+
+    class Screen(harness.FakeScreen):
+        def frame_done(self):
+            if not first:
+                first.append(time.monotonic())
+            super().frame_done()
+
+    screen = Screen()
+    argv = sys.argv
+    sys.argv = ["unislate"] + ([filename] if filename else [])
+    try:
+        with harness.headless_curses(screen), harness.contextlib.redirect_stdout(harness.io.StringIO()):
+            harness.unislate.main(screen)
+    finally:
+        sys.argv = argv
+    print(first[0])
+
+
+def first_frame(filename, runs):
+    times = []
+    for _ in range(runs):
+        started = time.monotonic()
+        result = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", filename or ""],
+                                cwd=HERE, capture_output=True, text=True, check=True)
+        times.append((float(result.stdout.strip().splitlines()[-1]) - started) * 1000)
+    return times
+
+
+def interpreter_start(runs):
+    times = []
+    for _ in range(runs):
+        started = time.monotonic()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        times.append((time.monotonic() - started) * 1000)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--top", type=int, default=10, help="сколько самых дорогих модулей показать")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child is not None:
+        child_first_frame(args.child)
+        return
+
+    print("== import unislate (-X importtime) ==")
+    totals, modules = import_times(args.runs)
+    print(f"total: median {statistics.median(totals):.1f} ms, min {min(totals):.1f} ms")
+    print(f"{'module':<32} {'self ms':>8} {'cum ms':>8}")
+    for name, self_ms, cum_ms in sorted(modules, key=lambda m: m[1], reverse=True)[:args.top]:
+        print(f"{name:<32} {self_ms:>8.2f} {cum_ms:>8.2f}")
+
+    print("\n== Time to first frame ==")
+    print(f"{'case':<12} {'median ms':>10} {'min ms':>8}")
+    times = interpreter_start(args.runs)
+    print(f"{'python -c':<12} {statistics.median(times):>10.1f} {min(times):>8.1f}")
+    directory = tempfile.mkdtemp(prefix="unislate-startup-")
+    try:
+        cases = [("empty", None)]
+        for lang, (name, text) in FILES.items():
+            path = os.path.join(directory, name)
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(text)
+            cases.append((lang, path))
+        for label, path in cases:
+            times = first_frame(path, args.runs)
+            print(f"{label:<12} {statistics.median(times):>10.1f} {min(times):>8.1f}")
+    finally:
+        for name in os.listdir(directory):
+            os.unlink(os.path.join(directory, name))
+        os.rmdir(directory)
+
+
+if __name__ == "__main__":
+    main()
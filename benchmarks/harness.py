@@ -0,0 +1,211 @@
+"""
+Безголовый запуск редактора: поддельный stdscr вместо терминала.
+
+FakeScreen хранит содержимое экрана, считает вызовы addstr и выведенные
+байты и отдаёт main() заранее записанные нажатия пачками. Для каждой пачки
+засекается время от выдачи первой клавиши до ближайшего кадра (doupdate
+или refresh) — задержка «нажатие → кадр».
+
+    screen = run_editor("big.py", [type_text("hello"), [curses.KEY_DOWN] * 10])
+    print(screen.latencies, screen.frames, screen.bytes_emitted)
+
+Работает без TTY: функции модуля curses, которым нужен initscr(),
+на время запуска подменяются заглушками.
+"""
+import collections
+import contextlib
+import curses
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import unislate  # noqa: E402
+
+# После сценария редактор закрывается: Esc выходит из поиска и подсказок,
+# Ctrl+Q — выход, 'y' подтверждает выход без сохранения
+EXIT_KEYS = (27, 17, ord("y"))
+EXIT_KEYS_LIMIT = 300
+# Сдвиг области прокрутки терминалу обходится в пару коротких последовательностей
+# (CSR и IND/RI); их и считаем вместо перерисованного экрана
+SCROLL_BYTES = 16
+
+
+def type_text(text):
+    """Пачка нажатий, набирающая text (переводы строк — Enter)."""
+    return [10 if ch == "\n" else ord(ch) for ch in text]
+
+
+def burst_per_key(keys):
+    """Каждая клавиша — отдельная пачка: редактор рисует кадр после каждой."""
+    return [[key] for key in keys]
+
+
+class FakeScreen:
+    """Подмена окна curses: экран в памяти, сценарий клавиш и счётчики."""
+
+    def __init__(self, bursts=(), height=24, width=80):
+        self.height = height
+        self.width = width
+        self.rows = [" " * width for _ in range(height)]
+        self.cursor = (0, 0)
+        self.region = (0, height - 1)
+        self.scrolling = False
+        self.bursts = iter(bursts)
+        self.pending = collections.deque()
+        self.delay = -1
+        self.exit_keys = 0
+        self.addstr_calls = 0
+        self.bytes_emitted = 0
+        self.frames = 0
+        self.burst_start = None
+        self.latencies = []
+
+    # --- вывод ---
+
+    def getmaxyx(self):
+        return self.height, self.width
+
+    def addstr(self, *args):
+        if len(args) >= 3:
+            y, x, text = args[:3]
+        else:
+            (y, x), text = self.cursor, args[0]
+        if not (0 <= y < self.height and 0 <= x < self.width):
+            raise curses.error("addstr() returned ERR")
+        self.addstr_calls += 1
+        self.bytes_emitted += len(text.encode("utf-8"))
+        row = self.rows[y]
+        fits = text[:self.width - x]
+        self.rows[y] = row[:x] + fits + row[x + len(fits):]
+        self.cursor = (y, min(x + len(fits), self.width - 1))
+        if len(fits) < len(text):
+            # Перенос на следующую строку не моделируем: лишнее обрезается с ошибкой
+            raise curses.error("addstr() returned ERR")
+
+    def move(self, y, x):
+        if not (0 <= y < self.height and 0 <= x < self.width):
+            raise curses.error("wmove() returned ERR")
+        self.cursor = (y, x)
+
+    def clrtoeol(self):
+        y, x = self.cursor
+        self.rows[y] = self.rows[y][:x].ljust(self.width)
+
+    def delch(self, y, x):
+        row = self.rows[y]
+        self.rows[y] = (row[:x] + row[x + 1:]).ljust(self.width)
+
+    def setscrreg(self, top, bottom):
+        if not 0 <= top <= bottom < self.height:
+            raise curses.error("wsetscrreg() returned ERR")
+        self.region = (top, bottom)
+
+    def scrollok(self, flag):
+        self.scrolling = flag
+
+    def idlok(self, flag):
+        pass
+
+    def scroll(self, lines=1):
+        if not self.scrolling:
+            raise curses.error("scroll() returned ERR")
+        top, bottom = self.region
+        rows = self.rows[top:bottom + 1]
+        blank = [" " * self.width] * min(abs(lines), len(rows))
+        rows = rows[lines:] + blank if lines > 0 else blank + rows[:len(rows) - len(blank)]
+        self.rows[top:bottom + 1] = rows
+        self.bytes_emitted += SCROLL_BYTES
+
+    def erase(self):
+        self.rows = [" " * self.width for _ in range(self.height)]
+
+    clear = erase
+
+    def bkgd(self, *args):
+        pass
+
+    def keypad(self, flag):
+        pass
+
+    def noutrefresh(self):
+        pass
+
+    def refresh(self):
+        self.frame_done()
+
+    def frame_done(self):
+        self.frames += 1
+        if self.burst_start is not None:
+            self.latencies.append(time.perf_counter() - self.burst_start)
+            self.burst_start = None
+
+    def display(self):
+        return list(self.rows)
+
+    # --- ввод ---
+
+    def timeout(self, delay):
+        self.delay = delay
+
+    def getch(self):
+        if self.pending:
+            return self.pending.popleft()
+        if self.delay == 0:
+            return -1  # терминал «молчит»: редактор рисует кадр
+        burst = next(self.bursts, None)
+        if burst is None:
+            if self.exit_keys >= EXIT_KEYS_LIMIT:
+                raise RuntimeError("editor did not exit after the script ended")
+            key = EXIT_KEYS[self.exit_keys % len(EXIT_KEYS)]
+            self.exit_keys += 1
+            return key
+        self.pending.extend(burst)
+        self.burst_start = time.perf_counter()
+        return self.pending.popleft() if self.pending else -1
+
+    def getstr(self, *args):
+        return b""
+
+
+@contextlib.contextmanager
+def headless_curses(screen):
+    """Подменяет функции curses, которым нужен настоящий терминал."""
+    replacements = {
+        "doupdate": screen.frame_done,
+        "beep": lambda: None,
+        "napms": lambda ms: None,
+        "curs_set": lambda visibility: None,
+        "noecho": lambda: None,
+        "echo": lambda: None,
+        "raw": lambda: None,
+        "endwin": lambda: None,
+        "start_color": lambda: None,
+        "use_default_colors": lambda: None,
+        "init_pair": lambda pair, fg, bg: None,
+        "color_pair": lambda pair: pair << 8,
+    }
+    saved = {name: getattr(curses, name) for name in replacements}
+    for name, func in replacements.items():
+        setattr(curses, name, func)
+    try:
+        yield screen
+    finally:
+        for name, func in saved.items():
+            setattr(curses, name, func)
+
+
+def run_editor(filename, bursts, height=24, width=80):
+    """Запускает unislate.main() на FakeScreen по сценарию и возвращает экран."""
+    screen = FakeScreen(bursts, height, width)
+    argv = sys.argv
+    sys.argv = ["unislate"] + ([filename] if filename else [])
+    try:
+        # Управляющие последовательности терминалу (bracketed paste) не нужны
+        with headless_curses(screen), contextlib.redirect_stdout(io.StringIO()):
+            unislate.main(screen)
+    finally:
+        sys.argv = argv
+    return screen
@@ -0,0 +1,58 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import unislate
+
+
+class MappedRoundTripTest(unittest.TestCase):
+    """Большой (отображённый в память) файл сохраняется байт в байт."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "big.txt")
+        self.sources = []
+
+    def tearDown(self):
+        for source in self.sources:
+            source.wait()
+        self.directory.cleanup()
+
+    def open_mapped(self, data):
+        with open(self.path, "wb") as f:
+            f.write(data)
+        source = unislate.MappedSource(self.path)
+        self.sources.append(source)
+        source.wait()
+        buf = unislate.TextBuffer.from_mapped(source)
+        buf.poll()
+        return buf
+
+    def save(self, buf):
+        copy = os.path.join(self.directory.name, "copy.txt")
+        unislate.save_file(copy, buf)
+        with open(copy, "rb") as f:
+            return f.read()
+
+    def test_unedited_files_round_trip(self):
+        for data in (b"a\r\nb\n", b"a\nb\r\n", b"a\r\nb\r\n", b"a\nb\n", b"a\r\nb",
+                     b"a\nb\r\r\n", b"a\rb\n", b"\r\n", b"x" * 10 + b"\r"):
+            with self.subTest(data=data):
+                self.assertEqual(self.save(self.open_mapped(data)), data)
+
+    def test_edit_keeps_mixed_endings_of_other_lines(self):
+        buf = self.open_mapped(b"one\r\ntwo\nthree\r\nfour\n")
+        buf.insert(buf.offset(1, 3), "!")
+        self.assertEqual(self.save(buf), b"one\r\ntwo!\nthree\r\nfour\n")
+
+    def test_crlf_file_is_edited_as_lf(self):
+        buf = self.open_mapped(b"one\r\ntwo\r\n")
+        self.assertEqual(buf.text(), "one\ntwo")
+        buf.insert(buf.offset(0, 3), "\nnew")
+        self.assertEqual(self.save(buf), b"one\r\nnew\r\ntwo\r\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import unislate
+
+CTRL_X = 24
+CTRL_Z = 26
+
+
+class MultipleCursorsTest(unittest.TestCase):
+
+    def editor(self, text, first_line, count):
+        """Редактор с курсорами в начале строк first_line..first_line+count-1."""
+        buf = unislate.TextBuffer(text)
+        ed = unislate.Editor(buf)
+        ed.goto(first_line, 0)
+        for _ in range(count - 1):
+            ed.key(unislate.KEY_ALT_DOWN)
+        return buf, ed
+
+    def test_cut_last_line_with_the_line_above(self):
+        buf, ed = self.editor("a\nb\nc", 1, 2)
+        ed.key(CTRL_X)
+        self.assertEqual(buf.text(), "a")
+        self.assertEqual(ed.copied, "b\nc")
+        ed.key(CTRL_Z)
+        self.assertEqual(buf.text(), "a\nb\nc")
+
+    def test_cut_every_line(self):
+        buf, ed = self.editor("a\nb\nc", 0, 3)
+        ed.key(CTRL_X)
+        self.assertEqual(buf.text(), "")
+        self.assertEqual(ed.copied, "a\nb\nc")
+        self.assertEqual(ed.carets, [])
+
+    def test_typing_undoes_in_one_step(self):
+        buf, ed = self.editor("foo\nfoo\nfoo", 0, 3)
+        for ch in "baz":
+            ed.key(ord(ch))
+        self.assertEqual(buf.text(), "bazfoo\nbazfoo\nbazfoo")
+        ed.key(CTRL_Z)
+        self.assertEqual(buf.text(), "foo\nfoo\nfoo")
+
+
+if __name__ == "__main__":
+    unittest.main()
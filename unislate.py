@@ -1,24 +1,220 @@
+import argparse
+import bisect
+import collections
 import curses
+import errno
+import itertools
 import sys
 import os
+import mmap
+import random
 import re
 import signal
+import threading
+import time
 
-try:
-    import pyperclip
-except ImportError:
-    pyperclip = None
+# json, shutil, tempfile и pyperclip импортируются там, где нужны: редактор
+# часто запускают из скриптов, и каждая миллисекунда запуска на счету
 
 ##############################
 # Editor Settings
 ##############################
 
 TAB_SPACES = " " * 4  # 4 пробела вместо табуляции
+UNDO_MAX_BYTES = 64 * 1024 * 1024  # бюджет памяти истории undo/redo
+HIGHLIGHT_CACHE_SIZE = 8192  # число строк в LRU-кэше подсветки
+HIGHLIGHT_CACHE_MAX_LINE = 4096  # более длинные строки подсвечиваются без кэша
+HIGHLIGHT_BATCH_TIME = 0.001  # как часто (с) фоновый лексер отдаёт готовые контрольные точки
+HIGHLIGHT_FRAME_WAIT = 0.002  # сколько секунд кадр ждёт фоновую подсветку, прежде чем рисовать без неё
+HIGHLIGHT_POLL_MS = 20  # как часто проверять готовность подсветки, пока она считается
+SWITCH_INTERVAL = 0.001  # как быстро фоновые потоки отдают GIL главному (sys.setswitchinterval)
+LARGE_FILE_THRESHOLD = 64 * 1024 * 1024  # файлы больше открываются через mmap лениво
+COPY_BLOCK_BYTES = 64 * 1024 * 1024  # по сколько байт копировать нетронутые части файла при сохранении
+LONG_LINE_THRESHOLD = 2048  # более длинные строки рисуются и лексируются только в видимом окне
+LINE_CHECKPOINT_STEP = 1024  # шаг контрольных точек лексера внутри длинной строки
+WINDOW_LOOKAHEAD = 256  # сколько символов правее окна читается для токенов на его краю
 
 ##############################
 # Синтаксическая подсветка
 ##############################
 
+# --- Движок токенизации ---
+# Состояние лексера в конце строки — открывающий разделитель незакрытой
+# многострочной конструкции ('"""', "'''", "/*", "`") или None.
+MULTILINE_END = {
+    '"""': re.compile(r'(?:\\.|[^\\])*?"""'),
+    "'''": re.compile(r"(?:\\.|[^\\])*?'''"),
+    "/*": re.compile(r'.*?\*/'),
+    "`": re.compile(r'(?:\\.|[^\\`])*`'),
+}
+MULTILINE_TYPES = {'"""': "string", "'''": "string", "/*": "comment", "`": "string"}
+STRUCT_TYPES = ("open", "comment", "string")
+
+RE_NUMBER = r'\b\d+(?:\.\d+)?\b'
+RE_WORD = r'[A-Za-z_]\w*'
+RE_SQ_STRING = r"'(?:\\.|[^'\\])*(?:'|$)"
+RE_DQ_STRING = r'"(?:\\.|[^"\\])*(?:"|$)'
+
+class Lexer:
+    """
+    Однопроходный построчный лексер. Правила (тип, шаблон) собираются в одно
+    регулярное выражение с именованными группами: при совпадении в одной позиции
+    побеждает правило, идущее раньше, поэтому ключевые слова внутри строк
+    и комментариев не подсвечиваются, а сегменты не пересекаются.
+    Тип "open" открывает многострочную конструкцию из MULTILINE_END; если она
+    не закрыта в этой строке, её разделитель становится состоянием конца строки.
+    Тип "word" забирает идентификатор целиком: он подсвечивается как keyword,
+    только если входит в keywords (дешевле, чем перебирать ключевые слова
+    регулярным выражением в каждой позиции).
+    first_chars — необязательный класс символов, с которых начинаются все
+    токены: просмотр вперёд по нему позволяет движку regex быстро пропускать
+    обычный текст.
+    """
+
+    def __init__(self, rules, keywords=(), first_chars=None):
+        self.rules = rules
+        self.keywords = frozenset(keywords)
+        self.types = {}
+        parts = []
+        struct_parts = []
+        for i, (ttype, pattern) in enumerate(rules):
+            name = f"t{i}"
+            self.types[name] = ttype
+            parts.append(f"(?P<{name}>{pattern})")
+            if ttype in STRUCT_TYPES:
+                struct_parts.append(f"(?P<{name}>{pattern})")
+        prefix = f"(?=[{first_chars}])" if first_chars else ""
+        self.regex = re.compile(prefix + "(?:" + "|".join(parts) + ")") if parts else None
+        has_open = any(ttype == "open" for ttype, _ in rules)
+        # Для пересчёта состояний хватает строк, комментариев и открытий
+        self.struct_re = re.compile("|".join(struct_parts)) if has_open else None
+
+    def lex(self, line, state, colors, pos=0):
+        """
+        Возвращает (сегменты, состояние конца строки) для входного состояния state.
+        pos — с какой позиции начинать (сегменты покрывают line[pos:]); символы
+        перед ней нужны только для ^ и \\b.
+        """
+        default = colors["default"]
+        segments = []
+        if state is not None:
+            attr = colors.get(MULTILINE_TYPES[state], default)
+            m = MULTILINE_END[state].match(line, pos)
+            if m is None:
+                return [(line[pos:], attr)], state
+            segments.append((line[pos:m.end()], attr))
+            pos = m.end()
+        if self.regex is None:
+            if pos < len(line) or not segments:
+                segments.append((line[pos:], default))
+            return segments, None
+        last = pos
+        finditer = self.regex.finditer
+        types = self.types
+        keywords = self.keywords
+        scanning = True
+        while scanning:
+            scanning = False
+            for m in finditer(line, pos):
+                start, end = m.span()
+                if end == start:
+                    continue
+                ttype = types[m.lastgroup]
+                if ttype == "word":
+                    if m.group() not in keywords:
+                        continue
+                    ttype = "keyword"
+                elif ttype == "open":
+                    opener = m.group()
+                    ttype = MULTILINE_TYPES[opener]
+                    close = MULTILINE_END[opener].match(line, end)
+                    if close is None:
+                        if start > last:
+                            segments.append((line[last:start], default))
+                        segments.append((line[start:], colors.get(ttype, default)))
+                        return segments, opener
+                    # Конструкция закрылась в этой же строке: продолжаем поиск после неё
+                    end = close.end()
+                    scanning = True
+                if start > last:
+                    segments.append((line[last:start], default))
+                segments.append((line[start:end], colors.get(ttype, default)))
+                last = pos = end
+                if scanning:
+                    break
+        if last < len(line) or not segments:
+            segments.append((line[last:], default))
+        return segments, None
+
+    def end_state(self, line, state):
+        """Только состояние конца строки, без построения сегментов."""
+        if self.struct_re is None:
+            return None
+        pos = 0
+        if state is not None:
+            m = MULTILINE_END[state].match(line)
+            if m is None:
+                return state
+            pos = m.end()
+        search = self.struct_re.search
+        types = self.types
+        while True:
+            m = search(line, pos)
+            if m is None:
+                return None
+            if types[m.lastgroup] == "open":
+                opener = m.group()
+                close = MULTILINE_END[opener].match(line, m.end())
+                if close is None:
+                    return opener
+                pos = close.end()
+            else:
+                pos = max(m.end(), pos + 1)
+
+    def resume(self, text, pos, state, stop, complete):
+        """
+        Первая граница токенов не раньше stop при сканировании text с позиции
+        pos в состоянии state: (позиция, состояние в ней). text — кусок строки;
+        complete — доходит ли он до конца строки. None, если токен, начатый
+        до stop, может продолжаться за концом text (нужно прочитать больше).
+        """
+        if state is not None:
+            m = MULTILINE_END[state].match(text, pos)
+            if m is None:
+                return (len(text), state) if complete else None
+            pos = m.end()
+        if self.regex is None:
+            return max(pos, stop), None
+        finditer = self.regex.finditer
+        types = self.types
+        size = len(text)
+        while pos < stop:
+            restart = False
+            for m in finditer(text, pos):
+                start, end = m.span()
+                if start >= stop:
+                    return stop, None  # stop попал в обычный текст между токенами
+                if end == start:
+                    continue
+                if types[m.lastgroup] == "open":
+                    opener = m.group()
+                    close = MULTILINE_END[opener].match(text, end)
+                    if close is None:
+                        return (size, opener) if complete else None
+                    end = close.end()
+                    restart = True
+                if end >= size and not complete:
+                    return None
+                pos = end
+                if restart or pos >= stop:
+                    break
+            else:
+                return max(pos, stop), None
+        return pos, None
+
+    def highlight(self, line, colors):
+        return self.lex(line, None, colors)[0]
+
 # --- Python ---
 PYTHON_KEYWORDS = {
     'False', 'None', 'True', 'and', 'as', 'assert', 'async', 'await',
@@ -26,35 +222,19 @@ PYTHON_KEYWORDS = {
     'finally', 'for', 'from', 'global', 'if', 'import', 'in', 'is', 'lambda',
     'nonlocal', 'not', 'or', 'pass', 'raise', 'return', 'try', 'while', 'with', 'yield'
 }
-RE_PY_COMMENT = re.compile(r"#.*")
-RE_PY_STRING = re.compile(r'(\'[^\']*\'|"[^"]*")')
-RE_PY_KEYWORD = re.compile(r'\b(' + '|'.join(PYTHON_KEYWORDS) + r')\b')
-RE_PY_NUMBER  = re.compile(r'\b\d+(\.\d+)?\b')
+
+def python_lexer():
+    return Lexer([
+        ("open", r'"""|' + r"'''"),
+        ("comment", r"#.*"),
+        ("string", RE_SQ_STRING + "|" + RE_DQ_STRING),
+        ("word", RE_WORD),
+        ("number", RE_NUMBER),
+    ], PYTHON_KEYWORDS)
 
 def highlight_python_line(line, colors):
     """Подсветка для Python."""
-    segments = []
-    tokens = []
-    for m in RE_PY_COMMENT.finditer(line):
-        tokens.append((m.start(), m.end(), "comment"))
-    for m in RE_PY_STRING.finditer(line):
-        tokens.append((m.start(), m.end(), "string"))
-    for m in RE_PY_KEYWORD.finditer(line):
-        tokens.append((m.start(), m.end(), "keyword"))
-    for m in RE_PY_NUMBER.finditer(line):
-        tokens.append((m.start(), m.end(), "number"))
-    if not tokens:
-        return [(line, colors["default"])]
-    tokens.sort(key=lambda x: x[0])
-    last_idx = 0
-    for start, end, ttype in tokens:
-        if start > last_idx:
-            segments.append((line[last_idx:start], colors["default"]))
-        segments.append((line[start:end], colors.get(ttype, colors["default"])))
-        last_idx = end
-    if last_idx < len(line):
-        segments.append((line[last_idx:], colors["default"]))
-    return segments
+    return language_lexer("python").highlight(line, colors)
 
 # --- JavaScript ---
 JS_KEYWORDS = {
@@ -64,10 +244,15 @@ JS_KEYWORDS = {
     'super', 'switch', 'this', 'throw', 'try', 'typeof', 'var', 'void',
     'while', 'with', 'yield'
 }
-RE_JS_COMMENT = re.compile(r"(//.*|/\*.*?\*/)", re.DOTALL)
-RE_JS_STRING = re.compile(r'(".*?"|\'.*?\'|`.*?`)', re.DOTALL)
-RE_JS_KEYWORD = re.compile(r'\b(' + '|'.join(JS_KEYWORDS) + r')\b')
-RE_JS_NUMBER  = re.compile(r'\b\d+(\.\d+)?\b')
+
+def js_lexer():
+    return Lexer([
+        ("comment", r"//.*"),
+        ("open", r"/\*|`"),
+        ("string", RE_SQ_STRING + "|" + RE_DQ_STRING),
+        ("word", RE_WORD),
+        ("number", RE_NUMBER),
+    ], JS_KEYWORDS)
 
 # --- C ---
 C_KEYWORDS = {
@@ -76,10 +261,15 @@ C_KEYWORDS = {
     'register','restrict','return','short','signed','sizeof','static','struct',
     'switch','typedef','union','unsigned','void','volatile','while'
 }
-RE_C_COMMENT = re.compile(r"(//.*|/\*.*?\*/)", re.DOTALL)
-RE_C_STRING = re.compile(r'(".*?"|\'.*?\')', re.DOTALL)
-RE_C_KEYWORD = re.compile(r'\b(' + '|'.join(C_KEYWORDS) + r')\b')
-RE_C_NUMBER  = re.compile(r'\b\d+(\.\d+)?\b')
+
+def c_lexer():
+    return Lexer([
+        ("comment", r"//.*"),
+        ("open", r"/\*"),
+        ("string", RE_SQ_STRING + "|" + RE_DQ_STRING),
+        ("word", RE_WORD),
+        ("number", RE_NUMBER),
+    ], C_KEYWORDS)
 
 # --- Java ---
 JAVA_KEYWORDS = {
@@ -90,72 +280,34 @@ JAVA_KEYWORDS = {
     'return','short','static','strictfp','super','switch','synchronized','this',
     'throw','throws','transient','try','void','volatile','while'
 }
-RE_JAVA_COMMENT = re.compile(r"(//.*|/\*.*?\*/)", re.DOTALL)
-RE_JAVA_STRING = re.compile(r'(".*?"|\'.*?\')', re.DOTALL)
-RE_JAVA_KEYWORD = re.compile(r'\b(' + '|'.join(JAVA_KEYWORDS) + r')\b')
-RE_JAVA_NUMBER  = re.compile(r'\b\d+(\.\d+)?\b')
-
-# Функция-генератор подсветки для языков с похожей структурой
-def highlight_line_generic(line, comment_re, string_re, keyword_re, number_re, colors):
-    segments = []
-    tokens = []
-    for m in comment_re.finditer(line):
-        tokens.append((m.start(), m.end(), "comment"))
-    for m in string_re.finditer(line):
-        tokens.append((m.start(), m.end(), "string"))
-    for m in keyword_re.finditer(line):
-        tokens.append((m.start(), m.end(), "keyword"))
-    for m in number_re.finditer(line):
-        tokens.append((m.start(), m.end(), "number"))
-    if not tokens:
-        return [(line, colors["default"])]
-    tokens.sort(key=lambda x: x[0])
-    last_idx = 0
-    for start, end, ttype in tokens:
-        if start > last_idx:
-            segments.append((line[last_idx:start], colors["default"]))
-        segments.append((line[start:end], colors.get(ttype, colors["default"])))
-        last_idx = end
-    if last_idx < len(line):
-        segments.append((line[last_idx:], colors["default"]))
-    return segments
+
+def java_lexer():
+    return Lexer([
+        ("comment", r"//.*"),
+        ("open", r'/\*|"""'),
+        ("string", RE_SQ_STRING + "|" + RE_DQ_STRING),
+        ("word", RE_WORD),
+        ("number", RE_NUMBER),
+    ], JAVA_KEYWORDS)
 
 def highlight_js_line(line, colors):
-    return highlight_line_generic(line, RE_JS_COMMENT, RE_JS_STRING, RE_JS_KEYWORD, RE_JS_NUMBER, colors)
+    return language_lexer("js").highlight(line, colors)
 
 def highlight_c_line(line, colors):
-    return highlight_line_generic(line, RE_C_COMMENT, RE_C_STRING, RE_C_KEYWORD, RE_C_NUMBER, colors)
+    return language_lexer("c").highlight(line, colors)
 
 def highlight_java_line(line, colors):
-    return highlight_line_generic(line, RE_JAVA_COMMENT, RE_JAVA_STRING, RE_JAVA_KEYWORD, RE_JAVA_NUMBER, colors)
+    return language_lexer("java").highlight(line, colors)
 
 # --- Markdown и базовая подсветка по умолчанию ---
-RE_MD_HEADER = re.compile(r'^(#{1,6})\s*(.*)$')
-RE_MD_LINK = re.compile(r'(\[.*?\]\(.*?\))')
+def markdown_lexer():
+    return Lexer([
+        ("md_header", r'^#{1,6}.*'),
+        ("md_link", r'\[.*?\]\(.*?\)'),
+    ], first_chars=r"#\[")
 
 def highlight_markdown_line(line, colors):
-    segments = []
-    m = RE_MD_HEADER.match(line)
-    if m:
-        header_marks, header_text = m.groups()
-        segments.append((header_marks + " ", colors["default"]))
-        segments.append((header_text, colors["md_header"]))
-        return segments
-    parts = []
-    last = 0
-    for m in RE_MD_LINK.finditer(line):
-        start, end = m.span()
-        if start > last:
-            parts.append((line[last:start], "default"))
-        parts.append((line[start:end], "md_link"))
-        last = end
-    if last < len(line):
-        parts.append((line[last:], "default"))
-    for text, typ in parts:
-        segments.append((text, colors.get(typ, colors["default"])))
-    if not segments:
-        segments = [(line, colors["default"])]
-    return segments
+    return language_lexer("markdown").highlight(line, colors)
 
 def default_highlight_line(line, colors):
     return [(line, colors["default"])]
@@ -205,599 +357,4949 @@ HIGHLIGHT_FUNCTIONS = {
     ".exs": default_highlight_line,
 }
 
-##############################
-# Другие функции редактора
-##############################
+# --- Реестр языков ---
+# Лексер языка собирается (а его регулярное выражение компилируется) при
+# первом открытии файла этого типа, а не при импорте модуля.
+LANGUAGES = {
+    "python": python_lexer,
+    "js": js_lexer,
+    "c": c_lexer,
+    "java": java_lexer,
+    "markdown": markdown_lexer,
+    "text": lambda: Lexer([]),
+}
+_LANGUAGE_BY_FUNC = {
+    highlight_python_line: "python",
+    highlight_js_line: "js",
+    highlight_c_line: "c",
+    highlight_java_line: "java",
+    highlight_markdown_line: "markdown",
+    default_highlight_line: "text",
+}
+LANGUAGE_BY_EXT = {ext: _LANGUAGE_BY_FUNC[func] for ext, func in HIGHLIGHT_FUNCTIONS.items()}
+_lexers = {}
 
-def load_file(filename):
-    try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            lines = f.read().splitlines()
-    except Exception:
-        lines = [""]
-    if not lines:
-        lines = [""]
-    return lines
+def language_lexer(name):
+    lexer = _lexers.get(name)
+    if lexer is None:
+        lexer = _lexers[name] = LANGUAGES[name]()
+    return lexer
 
-def save_file(filename, lines):
-    with open(filename, 'w', encoding='utf-8') as f:
-        f.write("\n".join(lines))
+def get_lexer(filename):
+    ext = os.path.splitext(filename)[1].lower() if filename else ""
+    return language_lexer(LANGUAGE_BY_EXT.get(ext, "text"))
 
-def prompt_user(stdscr, prompt):
-    curses.echo()
-    height, width = stdscr.getmaxyx()
-    stdscr.move(height - 1, 0)
-    stdscr.clrtoeol()
-    stdscr.addstr(height - 1, 0, prompt)
-    stdscr.refresh()
-    inp = stdscr.getstr(height - 1, len(prompt), width - len(prompt) - 1)
-    curses.noecho()
-    try:
-        return inp.decode("utf-8").strip()
-    except Exception:
-        return ""
+_STALE = object()  # контрольная точка вставленной строки, ещё не пролексированной
 
-def prompt_user_cancelable(stdscr, prompt):
-    height, width = stdscr.getmaxyx()
-    input_str = ""
-    pos = len(prompt)
-    stdscr.move(height - 1, 0)
-    stdscr.clrtoeol()
-    stdscr.addstr(height - 1, 0, prompt)
-    stdscr.refresh()
-    while True:
-        ch = stdscr.getch()
-        if ch == 27:
-            return None
-        elif ch in (curses.KEY_ENTER, 10, 13):
-            break
-        elif ch in (curses.KEY_BACKSPACE, 127, 8):
-            if len(input_str) > 0:
-                input_str = input_str[:-1]
-                pos -= 1
-                stdscr.move(height - 1, pos)
-                stdscr.delch(height - 1, pos)
-        else:
-            if 0 <= ch < 256:
-                c = chr(ch)
-                if c.isprintable():
-                    input_str += c
-                    stdscr.addstr(height - 1, pos, c)
-                    pos += 1
-        stdscr.refresh()
-    return input_str.strip()
+def read_line_piece(buf, line_start, start, end, length):
+    """
+    Кусок [start, end) строки длины length, начинающейся в line_start, и флаг
+    «дошли до конца строки». Обратную косую черту на краю куска не оставляем:
+    экранирование в строковых правилах должно видеть следующий символ.
+    """
+    end = min(end, length)
+    text = buf.get_range(line_start + start, line_start + end)
+    if end < length and text.endswith("\\"):
+        text += buf.get_range(line_start + end, line_start + end + 1)
+        end += 1
+    return text, end == length
 
-# ASCII art и приветственное сообщение
-ASCII_ART = r"""
-  _    _       _     _       _       
- | |  | |     (_)   | |     | |      
- | |  | |_ __  _ ___| | __ _| |_ ___ 
- | |  | | '_ \| / __| |/ _` | __/ _ \
- | |__| | | | | \__ \ | (_| | ||  __/
-  \____/|_| |_|_|___/_|\__,_|\__\___|
-                                                   
-developed by qwez with ♥️
-"""
+class LexerStates:
+    """
+    Контрольные точки лексера для буфера: states[i] — состояние в конце строки i.
+    После правки строки перелексируются с места правки только до тех пор,
+    пока новое состояние не совпадёт со старой контрольной точкой, и только
+    до той строки, которая реально нужна (обычно — низ экрана).
+    """
 
-def draw_welcome(stdscr, colors):
-    stdscr.clear()
-    height, width = stdscr.getmaxyx()
-    ascii_lines = ASCII_ART.strip("\n").splitlines()
-    total_lines = len(ascii_lines) + 3
-    start_y = max((height - total_lines) // 2, 0)
-    for idx, line in enumerate(ascii_lines):
-        x = max((width - len(line)) // 2, 0)
-        try:
-            stdscr.addstr(start_y + idx, x, line, colors["default"])
-        except curses.error:
-            pass
-    prompt_msg = "Press any key to start..."
-    try:
-        stdscr.addstr(start_y + len(ascii_lines) + 2, max((width - len(prompt_msg)) // 2, 0),
-                      prompt_msg, colors["default"])
-    except curses.error:
-        pass
-    stdscr.refresh()
-    key = stdscr.getch()
-    if key == 17:
-        curses.endwin()
-        sys.exit(0)
+    def __init__(self, buf, lexer, listen=True):
+        self.buf = buf
+        self.lexer = lexer
+        self.states = []
+        self.valid = 0  # states[:valid] проверены
+        self.dirty_to = -1  # до этой строки включительно сходиться нельзя
+        self.changed = None  # (lo, hi): у этих строк поменялось входное состояние
+        self.touched = None  # первая строка, изменённая после начала фонового прохода
+        self.columns = {}  # длинные строки: номер -> (входное состояние, [(позиция, состояние)])
+        if listen:
+            buf.listeners.append(self.on_edit)
 
-##############################
-# Функции для выделения
-##############################
+    def reset(self, lexer):
+        self.lexer = lexer
+        self.states = []
+        self.valid = 0
+        self.dirty_to = -1
+        self.changed = None
+        self.touched = 0
+        self.columns.clear()
 
-def get_line_selection_range(line_no, sel_start, sel_end, line_length):
-    if sel_start is None or sel_end is None:
-        return None
-    (sy, sx) = sel_start
-    (ey, ex) = sel_end
-    if (sy, sx) > (ey, ex):
-        sy, sx, ey, ex = ey, ex, sy, sx
-    if line_no < sy or line_no > ey:
-        return None
-    if sy == ey:
-        return (min(sx, ex), max(sx, ex))
-    if line_no == sy:
-        return (sx, line_length)
-    elif line_no == ey:
-        return (0, ex)
-    else:
-        return (0, line_length)
+    def _drop_columns(self, line_no, shifted):
+        if shifted:
+            self.columns = {y: v for y, v in self.columns.items() if y < line_no}
+        else:
+            self.columns.pop(line_no, None)
 
-def apply_selection_to_segment(text, seg_start, seg_end, sel_start, sel_end, base_attr):
-    result = []
-    if seg_end <= sel_start or seg_start >= sel_end:
-        return [(text, base_attr)]
-    if seg_start < sel_start:
-        prefix_len = sel_start - seg_start
-        result.append((text[:prefix_len], base_attr))
-        text = text[prefix_len:]
-        seg_start = sel_start
-    overlap = min(seg_end, sel_end) - seg_start
-    if overlap > 0:
-        result.append((text[:overlap], base_attr | curses.A_REVERSE))
-        text = text[overlap:]
-        seg_start += overlap
-    if seg_start < seg_end:
-        result.append((text, base_attr))
-    return result
+    def _touch(self, line_no):
+        if self.touched is None or line_no < self.touched:
+            self.touched = line_no
 
-def get_selected_text(lines, sel_start, sel_end):
-    (sy, sx) = sel_start
-    (ey, ex) = sel_end
-    if (sy, sx) > (ey, ex):
-        sy, sx, ey, ex = ey, ex, sy, sx
-    if sy == ey:
-        return lines[sy][sx:ex]
-    result = []
-    result.append(lines[sy][sx:])
-    for i in range(sy + 1, ey):
-        result.append(lines[i])
-    result.append(lines[ey][:ex])
-    return "\n".join(result)
+    def on_edit(self, offset, removed, inserted):
+        line_no = self.buf.position(offset)[0]
+        self._touch(line_no)
+        if self.columns:
+            self._drop_columns(line_no, "\n" in removed or "\n" in inserted)
+        if line_no >= len(self.states):
+            return
+        removed_lines = removed.count("\n")
+        added_lines = inserted.count("\n")
+        if removed_lines or added_lines:
+            # Конец последней из склеенных строк теперь — конец строки line_no + added_lines
+            self.states[line_no:line_no + removed_lines] = [_STALE] * added_lines
+            if self.dirty_to > line_no:
+                self.dirty_to += max(added_lines - removed_lines, 0)
+        self.valid = min(self.valid, line_no)
+        self.dirty_to = max(self.dirty_to, line_no + added_lines)
 
-def remove_selected_text(lines, sel_start, sel_end):
-    (sy, sx) = sel_start
-    (ey, ex) = sel_end
-    if (sy, sx) > (ey, ex):
-        sy, sx, ey, ex = ey, ex, sy, sx
-    if sy == ey:
-        lines[sy] = lines[sy][:sx] + lines[sy][ex:]
-        return lines
-    first_part = lines[sy][:sx]
-    last_part = lines[ey][ex:]
-    new_line = first_part + last_part
-    new_lines = lines[:sy] + [new_line] + lines[ey+1:]
-    return new_lines
+    def invalidate_from(self, line_no):
+        """Строки начиная с line_no изменились без уведомления (дочитывание файла)."""
+        self._drop_columns(line_no, True)
+        self._touch(line_no)
+        self.valid = min(self.valid, line_no)
+        self.dirty_to = max(self.dirty_to, line_no)
 
-##############################
-# Отрисовка редактора с номерами строк и выделением
-##############################
+    def _mark_changed(self, line_no):
+        if self.changed is None:
+            self.changed = (line_no, line_no)
+        else:
+            self.changed = (min(self.changed[0], line_no), max(self.changed[1], line_no))
 
-def draw_editor(stdscr, lines, cursor_y, cursor_x, offset_y, offset_x, filename, colors, sel_start, sel_end):
-    stdscr.clear()
-    height, width = stdscr.getmaxyx()
-    ext = os.path.splitext(filename)[1].lower() if filename else ""
-    highlighter = HIGHLIGHT_FUNCTIONS.get(ext, default_highlight_line)
-    
-    line_num_width = len(str(len(lines))) + 2
-    
-    for i, line in enumerate(lines[offset_y: offset_y + height - 1]):
-        actual_line = i + offset_y
-        line_number = f"{actual_line+1}".rjust(line_num_width - 1) + " "
-        try:
-            stdscr.addstr(i, 0, line_number, curses.A_DIM)
-        except curses.error:
-            pass
-        
-        segments = highlighter(line, colors)
-        x = line_num_width
-        sel_range = get_line_selection_range(actual_line, sel_start, sel_end, len(line))
-        current_index = 0
-        for text, attr in segments:
-            seg_start = current_index
-            seg_end = current_index + len(text)
-            current_index = seg_end
-            if sel_range is None:
-                if x + len(text) > width:
-                    text = text[:max(width - x, 0)]
-                try:
-                    stdscr.addstr(i, x, text, attr)
-                except curses.error:
-                    pass
-                x += len(text)
+    def advance(self, line_no):
+        """Проверяет контрольные точки всех строк до line_no (не включая)."""
+        i = self.valid
+        if i >= line_no:
+            return
+        state = self.states[i - 1] if i > 0 else None
+        end_state = self.lexer.end_state
+
+        def end_states(state):
+            for line in self.buf.iter_lines(i):
+                state = end_state(line, state)
+                yield state
+
+        if not self.apply(i, itertools.islice(end_states(state), line_no - i)):
+            self.advance(line_no)
+
+    def apply(self, start, new_states):
+        """
+        Принимает состояния в конце строк start, start + 1, ..., посчитанные
+        от состояния state_before(start); start должен быть равен valid.
+        Возвращает False, если контрольные точки сошлись со старыми раньше,
+        чем кончились new_states: остальные тогда не нужны.
+        """
+        states = self.states
+        i = start
+        for new in new_states:
+            if i < len(states):
+                old = states[i]
+                states[i] = new
+                if old is not _STALE and old == new:
+                    if i >= self.dirty_to:
+                        # Дальше контрольные точки совпадают со старыми
+                        self.valid = len(states)
+                        self.dirty_to = -1
+                        return False
+                else:
+                    self._mark_changed(i + 1)
             else:
-                sub_segments = apply_selection_to_segment(text, seg_start, seg_end, sel_range[0], sel_range[1], attr)
-                for sub_text, sub_attr in sub_segments:
-                    if x + len(sub_text) > width:
-                        sub_text = sub_text[:max(width - x, 0)]
-                    try:
-                        stdscr.addstr(i, x, sub_text, sub_attr)
-                    except curses.error:
-                        pass
-                    x += len(sub_text)
-                    
-    # Статусная строка – только информация, без управления.
-    # Добавлено указание, если файл новый (еще не существует).
-    if filename is None:
-        status_filename = "untitled (new)"
-    elif not os.path.exists(filename):
-        status_filename = f"{filename} (new)"
-    else:
-        status_filename = filename
+                states.append(new)
+            i += 1
+        self.valid = i
+        # Старые точки после i согласованы только со старым состоянием строки i - 1
+        if i < len(states):
+            self.dirty_to = max(self.dirty_to, i)
+        return True
 
-    status = f"{status_filename} | Ln {cursor_y+1}/{len(lines)} | Col {cursor_x+1} | EDIT"
-    try:
-        stdscr.addstr(height - 1, 0, status[:width].ljust(width), colors["default"])
-    except curses.error:
-        pass
-    scr_y = cursor_y - offset_y
-    scr_x = (cursor_x - offset_x) + line_num_width
-    if 0 <= scr_y < height - 1 and 0 <= scr_x < width:
-        try:
-            stdscr.move(scr_y, scr_x)
-        except curses.error:
-            pass
-    stdscr.refresh()
+    def state_before(self, line_no):
+        """Состояние лексера на входе в строку line_no."""
+        if line_no <= 0:
+            return None
+        self.advance(line_no)
+        return self.states[line_no - 1] if line_no - 1 < len(self.states) else None
 
-##############################
-# Main Editor Function
-##############################
+    def column_state(self, line_no, column):
+        """
+        (позиция, состояние) лексера на границе токенов не правее column
+        в строке line_no. Для длинных строк точки запоминаются через каждые
+        LINE_CHECKPOINT_STEP символов, так что прокрутка вправо не сканирует
+        строку заново с нулевой колонки. Строка читается кусками.
+        """
+        entry = self.state_before(line_no)
+        cached = self.columns.get(line_no)
+        if cached is None or cached[0] != entry:
+            cached = (entry, [(0, entry)])
+            self.columns[line_no] = cached
+        points = cached[1]
+        buf = self.buf
+        line_start = buf.line_start(line_no)
+        length = buf.line_length(line_no)
+        target = min(column, length) // LINE_CHECKPOINT_STEP
+        while len(points) <= target:
+            pos, state = points[-1]
+            stop = len(points) * LINE_CHECKPOINT_STEP
+            if pos >= stop:
+                # Токен предыдущего шага перекрыл и этот
+                points.append((pos, state))
+                continue
+            # Символ перед pos читается ради ^ и \b в правилах
+            base = max(pos - 1, 0)
+            fetch = stop - base + WINDOW_LOOKAHEAD
+            while True:
+                text, complete = read_line_piece(buf, line_start, base, base + fetch, length)
+                found = self.lexer.resume(text, pos - base, state, stop - base, complete)
+                if found is not None:
+                    break
+                fetch *= 2
+            points.append((base + found[0], found[1]))
+        i = target
+        while points[i][0] > column:
+            i -= 1
+        return points[i]
 
-def main(stdscr):
-    # Инициализация curses – используем raw() чтобы Ctrl+C не обрабатывался терминалом
-    curses.noecho()
-    curses.raw()
-    stdscr.keypad(True)
-    curses.curs_set(1)
-    curses.start_color()
-    curses.use_default_colors()
-    stdscr.bkgd(' ', curses.A_NORMAL)
-    
-    signal.signal(signal.SIGINT, lambda sig, frame: None)
+    def take_changed(self):
+        changed = self.changed
+        self.changed = None
+        return changed
 
-    # Инициализация цветовых пар
-    curses.init_pair(1, curses.COLOR_WHITE, -1)    # default
-    curses.init_pair(2, curses.COLOR_CYAN, -1)       # keyword (жирный)
-    curses.init_pair(3, curses.COLOR_YELLOW, -1)     # string
-    curses.init_pair(4, curses.COLOR_GREEN, -1)      # comment
-    curses.init_pair(5, curses.COLOR_MAGENTA, -1)    # number
-    curses.init_pair(6, curses.COLOR_BLUE, -1)       # md_header
-    curses.init_pair(7, curses.COLOR_CYAN, -1)       # md_link
 
-    colors = {
-        "default": curses.A_NORMAL,
-        "keyword": curses.color_pair(2) | curses.A_BOLD,
-        "string": curses.color_pair(3),
-        "comment": curses.color_pair(4),
-        "number": curses.color_pair(5),
-        "md_header": curses.color_pair(6) | curses.A_BOLD,
-        "md_link": curses.color_pair(7)
-    }
+# --- Кэш подсветки ---
+class HighlightCache:
+    """
+    LRU-кэш результатов лексера по содержимому строки, общий для всех буферов.
+    Ключ — (лексер, строка, входное состояние), значение — (сегменты, состояние
+    в конце строки); слишком длинные строки не кэшируются, чтобы не держать
+    в памяти мегабайтные ключи.
+    """
 
-    # Загрузка файла или приветственный экран
-    if len(sys.argv) > 1:
-        filename = sys.argv[1]
-        lines = load_file(filename)
-    else:
-        draw_welcome(stdscr, colors)
-        filename = None
-        lines = [""]
-
-    cursor_y = 0
-    cursor_x = 0
-    offset_y = 0
-    offset_x = 0
-    modified = False
-    undo_stack = []
-    redo_stack = []
-    clipboard = ""  # Внутренний буфер
-
-    # Параметры выделения
-    select_mode = False
-    selection_start = None
-    selection_end = None
-
-    def get_state():
-        return (list(lines), cursor_y, cursor_x, offset_y, offset_x, modified)
-
-    def set_state(state):
-        nonlocal lines, cursor_y, cursor_x, offset_y, offset_x, modified
-        lines, cursor_y, cursor_x, offset_y, offset_x, modified = state
-
-    def record_undo():
-        undo_stack.append(get_state())
-        redo_stack.clear()
-
-    def cancel_selection():
-        nonlocal select_mode, selection_start, selection_end
-        select_mode = False
-        selection_start = None
-        selection_end = None
+    def __init__(self, max_entries=HIGHLIGHT_CACHE_SIZE, max_line=HIGHLIGHT_CACHE_MAX_LINE):
+        self.max_entries = max_entries
+        self.max_line = max_line
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
 
-    while True:
-        height, width = stdscr.getmaxyx()
-        draw_editor(stdscr, lines, cursor_y, cursor_x, offset_y, offset_x, filename, colors, selection_start, selection_end)
-        key = stdscr.getch()
+    def lex(self, lexer, line, state, colors):
+        if len(line) > self.max_line:
+            self.misses += 1
+            return lexer.lex(line, state, colors)
+        result = self.get(lexer, line, state, colors)
+        if result is None:
+            result = lexer.lex(line, state, colors)
+            self.put(lexer, line, state, colors, result)
+        return result
 
-        if key == curses.KEY_RESIZE:
-            stdscr.clear()
-            offset_y = 0
-            offset_x = 0
-            continue
+    def get(self, lexer, line, state, colors):
+        """Результат из кэша или None; при промахе строка не лексируется."""
+        key = (lexer, id(colors), state, line)
+        result = self.entries.get(key)
+        if result is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return result
 
-        # Выход: Ctrl+Q (код 17)
-        if key == 17:
-            if modified:
-                stdscr.move(height - 1, 0)
-                stdscr.clrtoeol()
-                stdscr.addstr(height - 1, 0, "Unsaved changes! Quit without saving? (y/n): ", colors["default"])
-                stdscr.refresh()
-                confirm = stdscr.getch()
-                if confirm not in (ord('y'), ord('Y')):
-                    continue
-            break
+    def put(self, lexer, line, state, colors, result):
+        if len(line) > self.max_line:
+            return
+        self.entries[(lexer, id(colors), state, line)] = result
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
 
-        elif key == 19:  # Сохранение Ctrl+S
-            if not filename:
-                name = prompt_user_cancelable(stdscr, "Save as: ")
-                if name is None or name == "":
-                    continue
-                filename = name
-            try:
-                save_file(filename, lines)
-                modified = False
-                msg = f"Saved: {filename}"
-                try:
-                    stdscr.addstr(height - 1, 0, msg[:width].ljust(width), colors["default"])
-                except curses.error:
-                    pass
-                stdscr.refresh()
-                curses.napms(800)
-            except Exception:
-                pass
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self.entries),
+            "hit_rate": self.hits / total if total else 0.0,
+        }
 
-        elif key == 26:  # Undo: Ctrl+Z
-            if undo_stack:
-                redo_stack.append(get_state())
-                set_state(undo_stack.pop())
-                cancel_selection()
-            else:
-                curses.beep()
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
 
-        elif key == 25:  # Redo: Ctrl+Y
-            if redo_stack:
-                undo_stack.append(get_state())
-                set_state(redo_stack.pop())
-                cancel_selection()
-            else:
-                curses.beep()
+highlight_cache = HighlightCache()
 
-        # Обработка обычных стрелок — сбрасываем выделение
-        elif key == curses.KEY_UP:
-            cancel_selection()
-            if cursor_y > 0:
-                cursor_y -= 1
-                if cursor_y < offset_y:
-                    offset_y = cursor_y
-                cursor_x = min(cursor_x, len(lines[cursor_y]))
-            else:
-                curses.beep()
-        elif key == curses.KEY_DOWN:
-            cancel_selection()
-            if cursor_y < len(lines) - 1:
-                cursor_y += 1
-                if cursor_y >= offset_y + height - 1:
-                    offset_y += 1
-                cursor_x = min(cursor_x, len(lines[cursor_y]))
-            else:
-                curses.beep()
-        elif key == curses.KEY_LEFT:
-            cancel_selection()
-            if cursor_x > 0:
-                cursor_x -= 1
-            elif cursor_y > 0:
-                cursor_y -= 1
-                cursor_x = len(lines[cursor_y])
-                if cursor_y < offset_y:
-                    offset_y = cursor_y
-            else:
-                curses.beep()
-        elif key == curses.KEY_RIGHT:
-            cancel_selection()
-            if cursor_x < len(lines[cursor_y]):
-                cursor_x += 1
-            elif cursor_y < len(lines) - 1:
-                cursor_y += 1
-                cursor_x = 0
-                if cursor_y >= offset_y + height - 1:
-                    offset_y += 1
+# --- Фоновая подсветка ---
+class HighlightWorker:
+    """
+    Лексер в отдельном потоке, чтобы дорогая подсветка не задерживала ввод.
+    Поток получает задания двух видов: проход по контрольным точкам
+    LexerStates от первой непроверенной строки до низа экрана (по снимку
+    буфера, видимые строки заодно лексируются целиком) и отдельные видимые
+    строки, которых нет в highlight_cache. Результаты забирает главный поток
+    в poll(): сегменты кладутся в highlight_cache, контрольные точки
+    принимаются через LexerStates.apply. Если после начала прохода буфер
+    поменялся, принимаются только точки строк выше правки.
+    """
+
+    def __init__(self, lexer_states, colors):
+        self.lexer_states = lexer_states
+        self.colors = colors
+        self.cond = threading.Condition()
+        self.job_id = 0
+        # (id, лексер, первая строка, её состояние, снимок, первая видимая строка, конец,
+        #  старые контрольные точки с первой строки, dirty_to)
+        self.job = None
+        self.next_job = None  # ещё не взятый потоком проход
+        self.requests = collections.deque()  # (лексер, строка, входное состояние)
+        self.requested = set()
+        self.results = collections.deque()
+        self.arrived = False  # с прошлого take_arrived() что-то пришло
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    @property
+    def busy(self):
+        return self.job is not None or bool(self.requested) or bool(self.results)
+
+    # --- фоновый поток ---
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.closed and self.next_job is None and not self.requests:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                job = self.next_job
+                self.next_job = None
+            if job is not None:
+                self._scan(job)
+            self._serve_requests()
+
+    def _publish(self, result):
+        self.results.append(result)
+        with self.cond:
+            self.cond.notify_all()
+
+    def _serve_requests(self):
+        lexed = []
+        while self.requests:
+            lexer, line, state = self.requests.popleft()
+            lexed.append((lexer, line, state, lexer.lex(line, state, self.colors)))
+        if lexed:
+            self._publish((None, None, (), lexed, False))
+
+    def _scan(self, job):
+        job_id, lexer, line_no, state, pieces, lex_from, _, old, dirty_to = job
+        colors = self.colors
+        first = start = line_no
+        states = []
+        lexed = []
+        clock = time.perf_counter
+        publish_at = clock() + HIGHLIGHT_BATCH_TIME
+        lines = (line for _, block in iter_snapshot_blocks(pieces)
+                 for line in (block[:-1] if block.endswith("\n") else block).split("\n"))
+        for line in lines:
+            if self.requests:
+                self._serve_requests()
+            if job_id != self.job_id:
+                return
+            if line_no >= lex_from and len(line) <= LONG_LINE_THRESHOLD:
+                result = lexer.lex(line, state, colors)
+                lexed.append((lexer, line, state, result))
+                state = result[1]
+            else:
+                state = lexer.end_state(line, state)
+            states.append(state)
+            i = line_no - first
+            line_no += 1
+            if i < len(old) and old[i] is not _STALE and old[i] == state and line_no > dirty_to:
+                # Сошлись со старыми точками, как в LexerStates.apply: дальше считать незачем
+                break
+            if clock() >= publish_at:
+                # Готовое отдаём частями: правка ниже по тексту не обесценит уже посчитанное
+                self._publish((job_id, start, states, lexed, False))
+                start = line_no
+                states = []
+                lexed = []
+                publish_at = clock() + HIGHLIGHT_BATCH_TIME
+        self._publish((job_id, start, states, lexed, True))
+
+    # --- главный поток ---
+
+    def _cancel(self):
+        self.job_id += 1
+        self.job = None
+
+    def schedule(self, first_line, last_line):
+        """Запускает проход по контрольным точкам до last_line, если текущего не хватает."""
+        states = self.lexer_states
+        buf = states.buf
+        last_line = min(last_line, buf.line_count())
+        if states.valid >= last_line:
+            return
+        job = self.job
+        # Правка выше уже принятых точек: всё, что проход посчитает дальше, устарело
+        stale = states.touched is not None and states.touched <= states.valid
+        if job is not None and job[1] is states.lexer and job[6] >= last_line and not stale:
+            return
+        self._cancel()
+        start = states.valid
+        # Запас в экран вниз, чтобы прокрутка не перезапускала проход
+        end = min(last_line + (last_line - first_line), buf.line_count())
+        pieces = buf.snapshot(buf.line_start(start), buf.line_end(end - 1))
+        entry = states.states[start - 1] if start > 0 else None
+        states.touched = None
+        self.job = (self.job_id, states.lexer, start, entry, pieces, first_line, end,
+                    states.states[start:end], states.dirty_to)
+        with self.cond:
+            self.next_job = self.job
+            self.cond.notify_all()
+
+    def request(self, lexer, line, state):
+        """Просит пролексировать видимую строку с известным входным состоянием."""
+        key = (lexer, line, state)
+        if key in self.requested:
+            return
+        self.requested.add(key)
+        self.requests.append(key)
+        with self.cond:
+            self.cond.notify_all()
+
+    def poll(self):
+        """Применяет готовые результаты. Возвращает True, если что-то пришло."""
+        if not self.results:
+            return False
+        self.arrived = True
+        states = self.lexer_states
+        while self.results:
+            job_id, start, new_states, lexed, finished = self.results.popleft()
+            for lexer, line, state, result in lexed:
+                highlight_cache.put(lexer, line, state, self.colors, result)
+                self.requested.discard((lexer, line, state))
+            if job_id != self.job_id:
+                continue
+            if self.job[1] is not states.lexer or start != states.valid:
+                self._cancel()
+                continue
+            keep = True
+            if states.touched is not None and states.touched < start + len(new_states):
+                # Строки ниже правки посчитаны по старому тексту
+                new_states = new_states[:max(states.touched - start, 0)]
+                keep = False
+            if not states.apply(start, new_states):
+                keep = False
+            if finished or not keep:
+                self._cancel()
+        return True
+
+    def take_arrived(self):
+        arrived = self.arrived
+        self.arrived = False
+        return arrived
+
+    def wait(self, first_line, last_line, deadline):
+        """
+        Ждёт до deadline (time.monotonic), пока у строк до last_line не будет
+        контрольных точек и не придут запрошенные строки. True, если дождались.
+        """
+        last_line = min(last_line, self.lexer_states.buf.line_count())
+        while True:
+            self.poll()
+            self.schedule(first_line, last_line)
+            if self.lexer_states.valid >= last_line and not self.requested:
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            with self.cond:
+                if not self.results:
+                    self.cond.wait(remaining)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.job_id += 1
+            self.cond.notify_all()
+
+##############################
+# Текстовый буфер (rope)
+##############################
+
+CHUNK_SIZE = 1024  # максимальный размер чанка при построении и вставке
+
+
+class _Chunk:
+    """
+    Узел rope: кусок текста + агрегаты поддерева (символы и переводы строк).
+    У чанка, ещё не прочитанного из отображённого файла, text равен None,
+    а src = (источник, начало, конец) в байтах; read() декодирует его по требованию.
+    nl_pos — позиции переводов строк в чанке, считаются при первом поиске строки.
+    """
+    __slots__ = ("text", "src", "length", "nl", "nl_pos", "prio", "left", "right", "size", "lines")
+
+    def __init__(self, text, src=None, length=None, nl=None):
+        self.text = text
+        self.src = src
+        self.length = len(text) if length is None else length
+        self.nl = text.count("\n") if nl is None else nl
+        self.nl_pos = None
+        self.prio = random.random()
+        self.left = None
+        self.right = None
+        self.size = self.length
+        self.lines = self.nl
+
+    def read(self):
+        if self.text is not None:
+            return self.text
+        source, start, end = self.src
+        return source.read(start, end)
+
+    def replace(self, text):
+        """Заменяет содержимое чанка; связь с файлом при этом теряется."""
+        self.text = text
+        self.src = None
+        self.length = len(text)
+        self.nl = text.count("\n")
+        self.nl_pos = None
+
+    def newline_positions(self):
+        if self.nl_pos is None:
+            text = self.read()
+            positions = []
+            pos = text.find("\n")
+            while pos != -1:
+                positions.append(pos)
+                pos = text.find("\n", pos + 1)
+            self.nl_pos = positions
+        return self.nl_pos
+
+    def update(self):
+        size = self.length
+        lines = self.nl
+        if self.left is not None:
+            size += self.left.size
+            lines += self.left.lines
+        if self.right is not None:
+            size += self.right.size
+            lines += self.right.lines
+        self.size = size
+        self.lines = lines
+
+
+def _rope_merge(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if a.prio > b.prio:
+        a.right = _rope_merge(a.right, b)
+        a.update()
+        return a
+    b.left = _rope_merge(a, b.left)
+    b.update()
+    return b
+
+
+def _rope_split(node, offset):
+    """Делит поддерево на (первые offset символов, остаток)."""
+    if node is None:
+        return None, None
+    lsize = node.left.size if node.left is not None else 0
+    if offset <= lsize:
+        a, b = _rope_split(node.left, offset)
+        node.left = b
+        node.update()
+        return a, node
+    tlen = node.length
+    if offset >= lsize + tlen:
+        a, b = _rope_split(node.right, offset - lsize - tlen)
+        node.right = a
+        node.update()
+        return node, b
+    cut = offset - lsize
+    text = node.read()
+    tail = _rope_merge(_Chunk(text[cut:]), node.right)
+    node.replace(text[:cut])
+    node.right = None
+    node.update()
+    return node, tail
+
+
+def _rope_build(text):
+    """Строит дерево из текста за O(n)."""
+    return _rope_build_nodes(_Chunk(text[i:i + CHUNK_SIZE]) for i in range(0, len(text), CHUNK_SIZE))
+
+
+def _rope_build_nodes(nodes):
+    """Собирает готовые чанки в дерево за O(n) (декартово дерево на стеке)."""
+    stack = []
+    for node in nodes:
+        last = None
+        while stack and stack[-1].prio < node.prio:
+            last = stack.pop()
+            last.update()
+        node.left = last
+        if stack:
+            stack[-1].right = node
+        stack.append(node)
+    while len(stack) > 1:
+        stack.pop().update()
+    if not stack:
+        return None
+    stack[0].update()
+    return stack[0]
+
+
+LAZY_CHUNK_BYTES = 16 * 1024  # размер чанка отображённого файла
+MAPPED_CACHE_CHUNKS = 256  # сколько декодированных чанков держать в памяти
+
+
+class MappedSource:
+    """
+    Большой файл, отображённый в память. Фоновый поток режет его на чанки
+    по границам строк и считает для каждого длину в символах и число переводов
+    строк; сам текст декодируется только когда чанк нужен экрану или правке.
+    Готовый индекс (index из DiskCache) избавляет от этого прохода.
+    """
+
+    def __init__(self, filename, index=None):
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        # Пустой файл отобразить нельзя, но и индексировать в нём нечего
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b""
+        # Как в read_buffer_text: \r убирается, только если так кончаются все
+        # строки; при смешанных окончаниях он остаётся в тексте. Проверять весь
+        # файл приходится лишь тогда, когда уже первая строка кончается \r\n
+        first_nl = self.mm.find(b"\n") if self.size else -1
+        crlf = first_nl > 0 and self.mm[first_nl - 1] == 0x0D and self._all_crlf()
+        self.newline = "\r\n" if crlf else "\n"
+        # Завершающий перевод строки в текст не входит
+        self.text_end = self.size
+        if self.text_end and self.mm[self.text_end - 1] == 0x0A:
+            self.text_end -= 2 if crlf else 1
+        self.final_newline = self.text_end < self.size
+        self.lock = threading.Lock()
+        self.pending = []  # (start, end, length, nl) ещё не добавленные в буфер
+        self.indexed = 0
+        self.done = False
+        self.cache = collections.OrderedDict()
+        self.thread = None
+        if index is not None:
+            self.index = index
+            self.pending = [tuple(index[i:i + 4]) for i in range(0, len(index), 4)]
+            self.indexed = self.text_end
+            self.done = True
+            return
+        from array import array
+
+        self.index = array("q")  # те же четвёрки подряд — для DiskCache
+        self.thread = threading.Thread(target=self._index, daemon=True)
+        self.thread.start()
+
+    def _all_crlf(self, block_size=16 * 1024 * 1024):
+        """Все ли переводы строк файла — \r\n."""
+        mm = self.mm
+        for pos in range(0, self.size, block_size):
+            # Блок \r\n считается с байта раньше: пара на стыке достаётся блоку с её \n
+            if mm[pos:pos + block_size].count(b"\n") != mm[max(pos - 1, 0):pos + block_size].count(b"\r\n"):
+                return False
+        return True
+
+    def _decode(self, start, end):
+        text = self.mm[start:end].decode("utf-8", "replace")
+        return text.replace("\r\n", "\n") if self.newline == "\r\n" else text
+
+    def _block_end(self, pos, limit, block_size):
+        """Конец блока не дальше block_size байт: по переводу строки или границе символа."""
+        mm = self.mm
+        end = min(pos + block_size, limit)
+        if end < limit:
+            nl = mm.rfind(b"\n", pos, end)
+            if nl != -1:
+                return nl + 1
+            # Длинная строка: режем по границе символа UTF-8 и не рвём \r\n
+            while end > pos + 1 and mm[end] & 0xC0 == 0x80:
+                end -= 1
+            if end > pos + 1 and mm[end - 1] == 0x0D and mm[end] == 0x0A:
+                end -= 1
+        return end
+
+    def _index(self):
+        pos = 0
+        while pos < self.text_end:
+            end = self._block_end(pos, self.text_end, LAZY_CHUNK_BYTES)
+            text = self._decode(pos, end)
+            item = (pos, end, len(text), text.count("\n"))
+            self.index.extend(item)
+            with self.lock:
+                self.pending.append(item)
+                self.indexed = end
+            pos = end
+        with self.lock:
+            self.done = True
+
+    def wait(self):
+        """Ждёт конца индексации."""
+        if self.thread is not None:
+            self.thread.join()
+
+    def take(self):
+        with self.lock:
+            items = self.pending
+            self.pending = []
+        return items
+
+    @property
+    def finished(self):
+        with self.lock:
+            return self.done and not self.pending
+
+    def progress(self):
+        return self.indexed / self.size if self.size else 1.0
+
+    def iter_text(self, start, end, block_size=1024 * 1024):
+        """Декодирует диапазон файла блоками; безопасно вызывать из любого потока."""
+        pos = start
+        while pos < end:
+            stop = self._block_end(pos, end, block_size)
+            yield self._decode(pos, stop)
+            pos = stop
+
+    def read(self, start, end):
+        text = self.cache.get(start)
+        if text is not None:
+            self.cache.move_to_end(start)
+            return text
+        text = self._decode(start, end)
+        self.cache[start] = text
+        if len(self.cache) > MAPPED_CACHE_CHUNKS:
+            self.cache.popitem(last=False)
+        return text
+
+
+class TextBuffer:
+    """
+    Текст документа в виде rope (дерево чанков со счётчиками символов и строк).
+    Вставка, удаление и поиск строки по номеру стоят O(log n) плюс размер чанка,
+    поэтому правки не зависят ни от размера файла, ни от длины строки.
+    Позиции задаются смещением в символах; offset()/position() переводят
+    их в (строка, столбец) и обратно.
+    Подписчики из listeners получают каждую правку как (offset, removed, inserted).
+    Внутри переводы строк всегда "\n"; newline и final_newline — формат файла,
+    в котором текст сохраняется (перевод строки и есть ли он в конце).
+    """
+
+    def __init__(self, text=""):
+        self.root = _rope_build(text)
+        self.listeners = []
+        self.source = None
+        self.version = 0  # растёт с каждой правкой
+        self.newline = "\n"
+        self.final_newline = False
+
+    @classmethod
+    def from_mapped(cls, source):
+        """Буфер поверх MappedSource: текст появляется по мере индексации (см. poll)."""
+        buf = cls()
+        buf.source = source
+        buf.loaded_bytes = 0
+        buf.newline = source.newline
+        buf.final_newline = source.final_newline
+        return buf
+
+    @property
+    def loading(self):
+        return self.source is not None and not self.source.finished
+
+    def poll(self):
+        """
+        Добавляет в конец буфера чанки, проиндексированные фоновым потоком.
+        Возвращает номер первой изменившейся строки или None. Слушатели не
+        уведомляются: это не правка, а дочитывание файла.
+        """
+        if self.source is None:
+            return None
+        items = self.source.take()
+        if not items:
+            return None
+        first_line = self.line_count() - 1
+        source = self.source
+        nodes = (_Chunk(None, (source, start, end), length, nl) for start, end, length, nl in items)
+        self.root = _rope_merge(self.root, _rope_build_nodes(nodes))
+        self.loaded_bytes = items[-1][1]
+        return first_line
+
+    def load_mapped(self, source):
+        """Заменяет весь текст файлом source, как from_mapped; слушатели не уведомляются."""
+        self.reset()
+        self.source = source
+        self.loaded_bytes = 0
+        self.newline = source.newline
+        self.final_newline = source.final_newline
+
+    def finish_loading(self):
+        if self.source is not None:
+            self.source.wait()
+            self.poll()
+
+    def append(self, text):
+        """
+        Дописывает text в конец буфера. Как и poll, слушателей не уведомляет:
+        это не правка, а дочитывание растущего файла (см. FileFollower).
+        Возвращает номер первой изменившейся строки.
+        """
+        first_line = self.line_count() - 1
+        if text:
+            self._insert(len(self), text)
+            self.version += 1
+        return first_line
+
+    def reset(self, text=""):
+        """Заменяет весь текст без уведомления слушателей: файл усечён или подменён."""
+        self.root = _rope_build(text)
+        self.source = None
+        self.version += 1
+
+    def __len__(self):
+        return self.root.size if self.root is not None else 0
+
+    def line_count(self):
+        return (self.root.lines if self.root is not None else 0) + 1
+
+    def _newline_offset(self, k):
+        """Смещение k-го (с единицы) перевода строки."""
+        node = self.root
+        base = 0
+        while node is not None:
+            left = node.left
+            if left is not None and k <= left.lines:
+                node = left
+                continue
+            if left is not None:
+                k -= left.lines
+                base += left.size
+            if k <= node.nl:
+                return base + node.newline_positions()[k - 1]
+            k -= node.nl
+            base += node.length
+            node = node.right
+        raise IndexError("line index out of range")
+
+    def line_start(self, line_no):
+        if line_no <= 0:
+            return 0
+        return self._newline_offset(line_no) + 1
+
+    def line_end(self, line_no):
+        """Смещение конца строки (позиция её перевода строки или конца текста)."""
+        if line_no + 1 >= self.line_count():
+            return len(self)
+        return self._newline_offset(line_no + 1)
+
+    def line_length(self, line_no):
+        return self.line_end(line_no) - self.line_start(line_no)
+
+    def line_at(self, line_no):
+        if not 0 <= line_no < self.line_count():
+            raise IndexError("line index out of range")
+        return self.get_range(self.line_start(line_no), self.line_end(line_no))
+
+    def offset(self, line_no, col):
+        return self.line_start(line_no) + col
+
+    def position(self, offset):
+        """Переводит смещение в (строка, столбец)."""
+        node = self.root
+        rest = offset
+        line_no = 0
+        while node is not None:
+            left = node.left
+            lsize = left.size if left is not None else 0
+            if rest < lsize:
+                node = left
+                continue
+            if left is not None:
+                line_no += left.lines
+            rest -= lsize
+            if rest <= node.length:
+                line_no += node.read().count("\n", 0, rest)
+                break
+            line_no += node.nl
+            rest -= node.length
+            node = node.right
+        return line_no, offset - self.line_start(line_no)
+
+    def insert(self, offset, text):
+        if not text:
+            return
+        self._insert(offset, text)
+        self.version += 1
+        for listener in self.listeners:
+            listener(offset, "", text)
+
+    def delete(self, start, end):
+        if end <= start:
+            return
+        removed = self.get_range(start, end) if self.listeners else None
+        self._delete(start, end)
+        self.version += 1
+        for listener in self.listeners:
+            listener(start, removed, "")
+
+    def replace_ranges(self, edits):
+        """
+        Заменяет несколько непересекающихся диапазонов как одну правку:
+        edits — (start, end, text) по возрастанию start, смещения — до правки.
+        Части применяются с конца, чтобы смещения остальных не сдвигались;
+        подписчики получают каждую часть, version растёт один раз.
+        """
+        changed = False
+        for start, end, text in reversed(edits):
+            if end <= start and not text:
+                continue
+            removed = self.get_range(start, end) if self.listeners and end > start else ""
+            if end > start:
+                self._delete(start, end)
+            if text:
+                self._insert(start, text)
+            changed = True
+            for listener in self.listeners:
+                listener(start, removed, text)
+        if changed:
+            self.version += 1
+        return changed
+
+    def _insert(self, offset, text):
+        node = self.root
+        path = []
+        rest = offset
+        while node is not None:
+            path.append(node)
+            lsize = node.left.size if node.left is not None else 0
+            if rest < lsize:
+                node = node.left
+                continue
+            rest -= lsize
+            if rest <= node.length:
+                break
+            rest -= node.length
+            node = node.right
+        if node is not None and node.length + len(text) <= CHUNK_SIZE:
+            # Быстрый путь: правка внутри одного чанка, обновляем агрегаты по пути
+            nl = text.count("\n")
+            old = node.read()
+            node.replace(old[:rest] + text + old[rest:])
+            for n in path:
+                n.size += len(text)
+                n.lines += nl
+            return
+        left, right = _rope_split(self.root, offset)
+        self.root = _rope_merge(_rope_merge(left, _rope_build(text)), right)
+
+    def _delete(self, start, end):
+        node = self.root
+        path = []
+        rest = start
+        while node is not None:
+            path.append(node)
+            lsize = node.left.size if node.left is not None else 0
+            if rest < lsize:
+                node = node.left
+                continue
+            rest -= lsize
+            if rest < node.length:
+                break
+            rest -= node.length
+            node = node.right
+        count = end - start
+        if node is not None and rest + count <= node.length and count < node.length:
+            old = node.read()
+            nl = old.count("\n", rest, rest + count)
+            node.replace(old[:rest] + old[rest + count:])
+            for n in path:
+                n.size -= count
+                n.lines -= nl
+            return
+        left, rest_tree = _rope_split(self.root, start)
+        _, right = _rope_split(rest_tree, count)
+        self.root = _rope_merge(left, right)
+
+    def iter_chunks(self, start=0, end=None):
+        """Отдаёт текст диапазона [start, end) кусками, без склейки."""
+        if end is None:
+            end = len(self)
+        if start >= end:
+            return
+        stack = []
+        node = self.root
+        base = 0
+        while node is not None:
+            lsize = node.left.size if node.left is not None else 0
+            if start < base + lsize:
+                stack.append((node, base + lsize))
+                node = node.left
+            elif start < base + lsize + node.length:
+                stack.append((node, base + lsize))
+                break
+            else:
+                base += lsize + node.length
+                node = node.right
+        while stack:
+            node, text_start = stack.pop()
+            if text_start >= end:
+                return
+            text_end = text_start + node.length
+            text = node.read()
+            if start <= text_start and text_end <= end:
+                yield text
+            else:
+                yield text[max(start - text_start, 0):min(end, text_end) - text_start]
+            node = node.right
+            base = text_end
+            while node is not None:
+                lsize = node.left.size if node.left is not None else 0
+                stack.append((node, base + lsize))
+                node = node.left
+
+    def get_range(self, start, end):
+        return "".join(self.iter_chunks(start, end))
+
+    def iter_lines(self, start_line=0):
+        """Последовательно отдаёт строки, начиная с start_line."""
+        if start_line >= self.line_count():
+            return
+        pending = ""
+        for chunk in self.iter_chunks(self.line_start(start_line)):
+            parts = chunk.split("\n")
+            if len(parts) == 1:
+                pending += chunk
+                continue
+            yield pending + parts[0]
+            for part in parts[1:-1]:
+                yield part
+            pending = parts[-1]
+        yield pending
+
+    def text(self):
+        return self.get_range(0, len(self))
+
+    def snapshot(self, start=0, end=None):
+        """
+        Неизменяемый снимок для фоновой записи за O(число чанков): строки чанков
+        (str неизменяемы) и диапазоны (источник, начало, конец) ещё не
+        прочитанных частей файла, включая не проиндексированный хвост.
+        Снимок диапазона [start, end) обходит только его чанки; крайние
+        при этом читаются и обрезаются.
+        """
+        whole = end is None
+        if end is None:
+            end = len(self)
+        pieces = []
+        stack = []
+        node = self.root
+        base = 0
+        while node is not None:
+            lsize = node.left.size if node.left is not None else 0
+            if start < base + lsize:
+                stack.append((node, base + lsize))
+                node = node.left
+            elif start < base + lsize + node.length:
+                stack.append((node, base + lsize))
+                break
+            else:
+                base += lsize + node.length
+                node = node.right
+        while stack:
+            node, text_start = stack.pop()
+            if text_start >= end:
+                break
+            text_end = text_start + node.length
+            if start <= text_start and text_end <= end:
+                pieces.append(node.text if node.text is not None else node.src)
+            else:
+                pieces.append(node.read()[max(start - text_start, 0):min(end, text_end) - text_start])
+            node = node.right
+            base = text_end
+            while node is not None:
+                lsize = node.left.size if node.left is not None else 0
+                stack.append((node, base + lsize))
+                node = node.left
+        if whole and self.loading and self.loaded_bytes < self.source.text_end:
+            pieces.append((self.source, self.loaded_bytes, self.source.text_end))
+        return pieces
+
+##############################
+# История правок (undo/redo)
+##############################
+
+UNDO_EDIT_OVERHEAD = 96  # примерная цена одной записи в байтах помимо текста
+
+
+class UndoStep:
+    """Один шаг истории: список правок (offset, removed, inserted) и состояние курсора."""
+    __slots__ = ("kind", "edits", "before", "after", "size", "carets")
+
+    def __init__(self, kind, before):
+        self.kind = kind
+        self.edits = []
+        self.before = before
+        self.after = None
+        self.size = 0
+        self.carets = None  # смещения курсоров после последней правки нескольких курсоров
+
+    def can_extend(self, offset, removed, inserted):
+        if not self.edits:
+            return True
+        last_offset, last_removed, last_inserted = self.edits[-1]
+        if self.kind == "insert":
+            return not removed and not last_removed and offset == last_offset + len(last_inserted)
+        if self.kind == "delete":
+            return not inserted and not last_inserted and offset + len(removed) == last_offset
+        return False
+
+    def add(self, offset, removed, inserted):
+        """Добавляет правку, склеивая её с предыдущей, если они соседние."""
+        if self.edits:
+            last_offset, last_removed, last_inserted = self.edits[-1]
+            if not removed and not last_removed and offset == last_offset + len(last_inserted):
+                self.edits[-1] = (last_offset, "", last_inserted + inserted)
+                self.size += len(inserted)
+                return len(inserted)
+            if not inserted and not last_inserted and offset + len(removed) == last_offset:
+                self.edits[-1] = (offset, removed + last_removed, "")
+                self.size += len(removed)
+                return len(removed)
+        self.edits.append((offset, removed, inserted))
+        cost = len(removed) + len(inserted) + UNDO_EDIT_OVERHEAD
+        self.size += cost
+        return cost
+
+
+class UndoHistory:
+    """
+    История в виде обратимых правок вместо снимков всего текста.
+    Память и время undo/redo пропорциональны размеру правки, а не файла.
+    Подряд идущие правки одного вида ("insert", "delete") сливаются в один шаг;
+    самые старые шаги вытесняются, когда история превышает max_bytes.
+    """
+
+    def __init__(self, buf, max_bytes=UNDO_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.undo_stack = collections.deque()
+        self.redo_stack = []
+        self.bytes_used = 0
+        self._pending = None
+        self._current = None
+        self._applying = False
+        buf.listeners.append(self.record)
+
+    def begin(self, state, kind=None, ranges=None):
+        """
+        Отмечает начало пользовательского действия; state — состояние до правки.
+        ranges — правки нескольких курсоров (start, end, text) по возрастанию:
+        такое действие сливается с шагом, если каждый курсор продолжает свою правку.
+        """
+        self._pending = (kind, state, ranges)
+        self._current = None
+
+    @staticmethod
+    def _batch_carets(kind, ranges):
+        """Курсоры до и после правки нескольких курсоров или None, если её не с чем сливать."""
+        if not (kind == "insert" and all(start == end for start, end, _ in ranges)
+                or kind == "delete" and not any(text for _, _, text in ranges)):
+            return None, None
+        before = tuple(end for _, end, _ in ranges)
+        after = []
+        shift = 0
+        for start, end, text in ranges:
+            after.append(start + shift + len(text))
+            shift += len(text) - (end - start)
+        return before, tuple(after)
+
+    def record(self, offset, removed, inserted):
+        if self._applying:
+            return
+        if self._current is None:
+            kind, state, ranges = self._pending if self._pending is not None else (None, None, None)
+            self._pending = None
+            last = self.undo_stack[-1] if self.undo_stack else None
+            if ranges is not None:
+                # Правки всех курсоров приходят по очереди; решаем по всему набору сразу
+                before, after = self._batch_carets(kind, ranges)
+                extend = last is not None and before is not None and last.carets == before
+            else:
+                after = None
+                extend = last is not None and last.carets is None and last.can_extend(offset, removed, inserted)
+            if kind is not None and last is not None and last.kind == kind and not self.redo_stack and extend:
+                self._current = last
+            else:
+                self._current = UndoStep(kind, state)
+                self.undo_stack.append(self._current)
+            self._current.carets = after
+            self._drop_redo()
+        self.bytes_used += self._current.add(offset, removed, inserted)
+        self._trim()
+
+    def clear(self):
+        """Забывает всю историю: текст заменён целиком, старые смещения ничего не значат."""
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        self.bytes_used = 0
+        self._pending = None
+        self._current = None
+
+    def _drop_redo(self):
+        for step in self.redo_stack:
+            self.bytes_used -= step.size
+        self.redo_stack.clear()
+
+    def _trim(self):
+        while self.bytes_used > self.max_bytes and len(self.undo_stack) > 1:
+            self.bytes_used -= self.undo_stack.popleft().size
+
+    def _apply(self, buf, edits, reverse):
+        self._applying = True
+        try:
+            if reverse:
+                for offset, removed, inserted in reversed(edits):
+                    buf.delete(offset, offset + len(inserted))
+                    buf.insert(offset, removed)
+            else:
+                for offset, removed, inserted in edits:
+                    buf.delete(offset, offset + len(removed))
+                    buf.insert(offset, inserted)
+        finally:
+            self._applying = False
+
+    def undo(self, buf, state):
+        """Откатывает последний шаг; возвращает его (step.before — состояние до правки) или None."""
+        self._current = None
+        if not self.undo_stack:
+            return None
+        step = self.undo_stack.pop()
+        step.after = state
+        self._apply(buf, step.edits, reverse=True)
+        self.redo_stack.append(step)
+        return step
+
+    def redo(self, buf):
+        """Повторяет отменённый шаг; возвращает его (step.after — состояние после правки) или None."""
+        self._current = None
+        if not self.redo_stack:
+            return None
+        step = self.redo_stack.pop()
+        self._apply(buf, step.edits, reverse=False)
+        self.undo_stack.append(step)
+        return step
+
+##############################
+# Журнал правок (восстановление после сбоя)
+##############################
+
+JOURNAL_FLUSH_INTERVAL = 0.2  # как часто (с) накопленные правки пишутся в журнал и fsync
+JOURNAL_MAGIC = b"UNISLATE-JOURNAL 1\n"
+
+def journal_path(filename):
+    """Журнал лежит рядом с файлом: dir/.name.unislate-swp."""
+    directory, name = os.path.split(os.path.abspath(filename))
+    return os.path.join(directory, "." + name + ".unislate-swp")
+
+def lock_journal(filename):
+    """
+    Блокировка журнала на время сессии: flock на dir/.name.unislate-swp.lock.
+    Сам файл блокировки не удаляется: удалённый путь мог бы уже открыть
+    другой редактор и заблокировать осиротевший inode, пока третий создаёт
+    новый файл, — и оба считали бы журнал своим. Возвращает открытый файл
+    блокировки или None, если блокировать нечем (нет fcntl, каталог только
+    для чтения); BlockingIOError — журнал ведёт другой запущенный редактор,
+    и он не остаток сбоя.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return None
+    try:
+        lock = open(journal_path(filename) + ".lock", "a")
+    except OSError:
+        return None
+    try:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        raise
+    except OSError:
+        lock.close()
+        return None
+    return lock
+
+def set_aside_journal(filename):
+    """
+    Откладывает журнал, который уже не приложить к файлу, под первым
+    свободным именем .old, .old2, .old3...: отложенные при прошлых сбоях
+    правки не затираются. Возвращает новый путь; OSError пробрасывается.
+    """
+    path = journal_path(filename)
+    target = path + ".old"
+    number = 1
+    while os.path.lexists(target):
+        number += 1
+        target = f"{path}.old{number}"
+    os.replace(path, target)
+    return target
+
+def _journal_base(signature, text=None):
+    """Заголовок журнала: от какого состояния отсчитываются правки."""
+    if text is not None:
+        data = text.encode("utf-8", "surrogatepass")
+        return JOURNAL_MAGIC + b"T %d\n" % len(data) + data
+    if signature is None:
+        return JOURNAL_MAGIC + b"F -\n"
+    return JOURNAL_MAGIC + b"F %d %d %d %d\n" % signature
+
+def _journal_record(offset, removed, inserted):
+    data = inserted.encode("utf-8", "surrogatepass")
+    return b"%d %d %d\n" % (offset, removed, len(data)) + data
+
+def read_journal(path):
+    """
+    Разбирает журнал: (основа, правки) или None, если это не журнал.
+    Основа — ("file", подпись файла или None) либо ("text", текст);
+    правки — (смещение, сколько удалить, что вставить). Недописанная при
+    сбое последняя запись отбрасывается.
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    if not data.startswith(JOURNAL_MAGIC):
+        return None
+    pos = len(JOURNAL_MAGIC)
+    line_end = data.find(b"\n", pos)
+    if line_end == -1:
+        return None
+    fields = data[pos:line_end].split()
+    pos = line_end + 1
+    try:
+        if fields[0] == b"T":
+            end = pos + int(fields[1])
+            if end > len(data):
+                return None
+            base = ("text", data[pos:end].decode("utf-8", "surrogatepass"))
+            pos = end
+        elif fields[1:] == [b"-"]:
+            base = ("file", None)
+        else:
+            base = ("file", tuple(int(x) for x in fields[1:]))
+    except (IndexError, ValueError, UnicodeDecodeError):
+        return None
+    records = []
+    while True:
+        line_end = data.find(b"\n", pos)
+        if line_end == -1:
+            break
+        try:
+            offset, removed, size = (int(x) for x in data[pos:line_end].split())
+        except ValueError:
+            break
+        end = line_end + 1 + size
+        if end > len(data):
+            break
+        records.append((offset, removed, data[line_end + 1:end].decode("utf-8", "surrogatepass")))
+        pos = end
+    return base, records
+
+def replay_journal(buf, records):
+    """Повторяет правки журнала на буфере; время зависит от числа правок, а не от размера файла."""
+    for offset, removed, inserted in records:
+        if offset + removed > len(buf):
+            raise ValueError("journal does not match the file")
+        buf.delete(offset, offset + removed)
+        buf.insert(offset, inserted)
+
+class EditJournal:
+    """
+    Журнал несохранённых правок: подписчик буфера только кладёт правку
+    в очередь (микросекунды на нажатие), а фоновый поток раз в
+    JOURNAL_FLUSH_INTERVAL дописывает накопленное в файл рядом с документом
+    и делает один fsync на всю пачку. После сохранения журнал
+    перезаписывается от нового состояния файла (rebase); при обычном выходе
+    удаляется, так что оставшийся журнал означает сбой.
+    """
+
+    def __init__(self, filename, signature, records=(), base_text=None, lock=None):
+        self.filename = filename
+        self.path = journal_path(filename)
+        self.lock_file = lock  # блокировка lock_journal: снимается при закрытии
+        self.queue = collections.deque()
+        self.seq = len(records)  # сколько правок записано с начала сессии
+        self.base_seq = 0  # номер правки, с которой начинается журнал на диске
+        self.records = list(records)  # правки журнала, уже отданные потоку
+        self.base = _journal_base(signature, base_text)
+        self.rewrite = False  # файл журнала нужно переписать целиком (новая основа)
+        self.pending_base = None
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.closed = False
+        self.error = None
+        self.file = None
+        if records:
+            # Восстановленный журнал продолжается, а не начинается заново
+            self.file = open(self.path, 'ab')
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def record(self, offset, removed, inserted):
+        """Подписчик TextBuffer.listeners."""
+        self.queue.append((offset, len(removed), inserted))
+        self.seq += 1
+
+    def rebase(self, seq, signature=None, text=None):
+        """
+        Файл на диске теперь содержит первые seq правок (сохранение или
+        перечитывание); если он разошёлся с буфером иначе, основой журнала
+        становится текст text.
+        """
+        with self.lock:
+            self.pending_base = (seq, _journal_base(signature, text))
+            self.rewrite = True
+        self.wake.set()
+
+    # --- фоновый поток ---
+
+    def _run(self):
+        while not self.closed:
+            self.wake.wait(JOURNAL_FLUSH_INTERVAL)
+            self.wake.clear()
+            try:
+                self._flush()
+            except OSError as e:
+                self.error = e
+
+    def _flush(self):
+        fresh = []
+        while self.queue:
+            fresh.append(self.queue.popleft())
+        self.records.extend(fresh)
+        with self.lock:
+            rewrite = self.rewrite
+            self.rewrite = False
+            if rewrite:
+                seq, self.base = self.pending_base
+        if rewrite:
+            del self.records[:seq - self.base_seq]
+            self.base_seq = seq
+            self._close_file()
+            if not self.records:
+                self._remove()
+                return
+            fresh = self.records
+        if not fresh:
+            return
+        if self.file is None or rewrite:
+            self.file = open(self.path, 'wb')
+            self.file.write(self.base)
+        self.file.write(b"".join(_journal_record(*r) for r in fresh))
+        self.file.flush()
+        getattr(os, "fdatasync", os.fsync)(self.file.fileno())
+
+    def _close_file(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _remove(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def close(self):
+        """Обычный выход: журнал больше не нужен."""
+        self.closed = True
+        self.wake.set()
+        self.thread.join()
+        self._close_file()
+        self._remove()
+        if self.lock_file is not None:
+            self.lock_file.close()
+
+##############################
+# Кэш на диске (~/.cache/unislate)
+##############################
+
+CACHE_MAX_BYTES = 256 * 1024 * 1024  # общий размер кэша; старые записи удаляются
+CACHE_MAGIC = b"UNISLATE-CACHE 2\n"
+
+
+def cache_directory():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "unislate")
+
+
+def lexer_fingerprint(lexer):
+    """Контрольная сумма правил лексера: состояния от других правил не годятся."""
+    import zlib
+
+    return zlib.crc32(repr((lexer.rules, sorted(lexer.keywords))).encode("utf-8"))
+
+
+class CacheEntry:
+    """
+    Запись кэша для одного большого файла: индекс чанков MappedSource
+    (array('q') по четыре числа на чанк: начало, конец, символов, переводов
+    строк) и проверенные контрольные точки лексера в виде серий
+    [(первая строка, состояние), ...] — у большинства строк оно None.
+    """
+
+    def __init__(self, index, fingerprint=None, runs=(), state_count=0):
+        self.index = index
+        self.fingerprint = fingerprint
+        self.runs = runs
+        self.state_count = state_count
+
+    def states_for(self, lexer):
+        """Контрольные точки для LexerStates или None, если они от другого лексера."""
+        if not self.state_count or self.fingerprint != lexer_fingerprint(lexer):
+            return None
+        states = []
+        bounds = [line for line, _ in self.runs[1:]] + [self.state_count]
+        for (line, state), end in zip(self.runs, bounds):
+            states.extend([state] * (end - line))
+        return states
+
+
+class DiskCache:
+    """
+    Постоянный кэш под ~/.cache/unislate: открытие неизменённого большого
+    файла не индексирует его заново, а подсветка сразу знает состояние
+    лексера в любой уже пройденной строке. Запись на файл одна, имя — хэш
+    пути; внутри хранятся подпись файла (mtime, размер, inode) и контрольная
+    сумма, так что устаревшая или испорченная запись просто не читается.
+    Размер кэша ограничен max_bytes: лишнее удаляется, начиная с давно
+    не открывавшихся файлов.
+    """
+
+    def __init__(self, directory=None, max_bytes=CACHE_MAX_BYTES):
+        self.directory = directory or cache_directory()
+        self.max_bytes = max_bytes
+
+    def path(self, filename):
+        import hashlib
+
+        key = os.path.realpath(filename).encode("utf-8", "surrogateescape")
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest() + ".cache")
+
+    def lookup(self, filename, signature):
+        """CacheEntry для файла с подписью signature (file_signature) или None."""
+        if signature is None or signature[1] < LARGE_FILE_THRESHOLD:
+            return None
+        path = self.path(filename)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        try:
+            entry = self._parse(data, os.path.realpath(filename), signature)
+        except (ValueError, TypeError, KeyError, IndexError, OverflowError, UnicodeDecodeError):
+            entry = None
+        if entry is None:
+            self._remove(path)
+            return None
+        try:
+            os.utime(path)  # для вытеснения: недавно открытые живут дольше
+        except OSError:
+            pass
+        return entry
+
+    def _parse(self, data, realpath, signature):
+        import json
+        import zlib
+        from array import array
+
+        if not data.startswith(CACHE_MAGIC):
+            return None
+        checksum, _, body = data[len(CACHE_MAGIC):].partition(b"\n")
+        if int(checksum, 16) != zlib.crc32(body):
+            return None
+        header, _, payload = body.partition(b"\n")
+        header = json.loads(header)
+        if header["path"] != realpath or tuple(header["signature"]) != tuple(signature):
+            return None  # файл изменился: запись устарела
+        index = array("q")
+        if len(payload) % (4 * index.itemsize):
+            return None
+        index.frombytes(payload)
+        # Чанки должны подряд покрывать файл, иначе индекс бесполезен
+        pos = 0
+        for i in range(0, len(index), 4):
+            if index[i] != pos or index[i + 1] <= pos:
+                return None
+            pos = index[i + 1]
+        if pos != header["text_end"]:
+            return None
+        runs = [(line, state) for line, state in header["runs"]]
+        lines = [line for line, _ in runs]
+        if any(state is not None and state not in MULTILINE_END for _, state in runs):
+            return None
+        if lines and (lines[0] != 0 or lines != sorted(set(lines)) or lines[-1] >= header["state_count"]):
+            return None
+        return CacheEntry(index, header["fingerprint"], runs, header["state_count"] if runs else 0)
+
+    def store(self, filename, signature, source, lexer, states):
+        """
+        Записывает индекс source и контрольные точки states (только проверенные,
+        без _STALE) для файла с подписью signature. Ошибки записи не мешают
+        работе: кэш — только ускорение.
+        """
+        import json
+        import tempfile
+        import zlib
+
+        if _STALE in states:
+            states = states[:states.index(_STALE)]
+        runs = []
+        line = 0
+        for state, group in itertools.groupby(states):
+            runs.append((line, state))
+            line += len(list(group))
+        header = json.dumps({
+            "path": os.path.realpath(filename),
+            "signature": list(signature),
+            "text_end": source.text_end,
+            "fingerprint": lexer_fingerprint(lexer),
+            "runs": runs,
+            "state_count": len(states),
+        })
+        body = header.encode("utf-8") + b"\n" + source.index.tobytes()
+        data = CACHE_MAGIC + f"{zlib.crc32(body):08x}\n".encode("ascii") + body
+        tmp_name = None
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_name = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_name, self.path(filename))
+            tmp_name = None
+            self.evict()
+        except OSError:
+            pass
+        finally:
+            if tmp_name is not None:
+                self._remove(tmp_name)
+
+    def evict(self):
+        """Удаляет самые давние записи, пока кэш больше max_bytes."""
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for item in it:
+                if item.name.endswith(".cache"):
+                    st = item.stat()
+                    entries.append((st.st_mtime, st.st_size, item.path))
+                    total += st.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+##############################
+# Другие функции редактора
+##############################
+
+def read_buffer_text(f):
+    """
+    Текст открытого в двоичном режиме файла в том виде, в каком его хранит
+    TextBuffer, и формат файла: (текст, newline, final_newline). Строки
+    делятся только по \n; \r перед ним убирается, если так кончаются все
+    строки. При смешанных окончаниях \r остаётся в тексте, чтобы файл
+    сохранился байт в байт. Прочие управляющие символы и разделители
+    (\x0c, \x85, U+2028...) — обычный текст.
+    """
+    raw = f.read().decode("utf-8")
+    lf_count = raw.count("\n")
+    newline = "\r\n" if lf_count and raw.count("\r\n") == lf_count else "\n"
+    if newline == "\r\n":
+        raw = raw.replace("\r\n", "\n")
+    final_newline = raw.endswith("\n")
+    return raw[:-1] if final_newline else raw, newline, final_newline
+
+def load_file(filename, cached=None):
+    """Буфер с текстом файла; cached — запись DiskCache с готовым индексом большого файла."""
+    try:
+        if os.path.getsize(filename) >= LARGE_FILE_THRESHOLD:
+            return TextBuffer.from_mapped(MappedSource(filename, cached.index if cached is not None else None))
+    except OSError:
+        pass
+    try:
+        with open(filename, 'rb') as f:
+            text, newline, final_newline = read_buffer_text(f)
+    except Exception:
+        return TextBuffer()
+    buf = TextBuffer(text)
+    buf.newline = newline
+    buf.final_newline = final_newline
+    return buf
+
+# Ошибки, при которых копирование в ядре не поддерживается и надо пробовать попроще
+COPY_FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP}
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+def copy_file_bytes(src_fd, offset, count, dst_fd, progress=None):
+    """
+    Копирует count байт файла src_fd с позиции offset в текущую позицию dst_fd.
+    Байты не проходят через Python: copy_file_range (на некоторых ФС это
+    просто ссылка на те же блоки), иначе sendfile, и только если ядро не
+    умеет ни того ни другого — чтение блоками.
+    """
+    end = offset + count
+    for method in ("copy_file_range", "sendfile", "pread"):
+        if not hasattr(os, method):
+            continue
+        try:
+            while offset < end:
+                n = min(end - offset, COPY_BLOCK_BYTES)
+                if method == "copy_file_range":
+                    n = os.copy_file_range(src_fd, dst_fd, n, offset)
+                elif method == "sendfile":
+                    n = os.sendfile(dst_fd, src_fd, offset, n)
+                else:
+                    data = os.pread(src_fd, n, offset)
+                    write_all(dst_fd, data)
+                    n = len(data)
+                if n == 0:
+                    raise OSError(errno.EIO, "file was truncated while saving")
+                offset += n
+                if progress:
+                    progress(n)
+            return
+        except OSError as e:
+            if method == "pread" or e.errno not in COPY_FALLBACK_ERRNOS:
+                raise
+
+def write_snapshot(filename, pieces, progress=None, newline="\n", final_newline=False):
+    """
+    Атомарно записывает снимок буфера: временный файл в том же каталоге,
+    fsync и os.replace. При любой ошибке исходный файл остаётся нетронутым.
+    Текст пишется с переводами строк newline; нетронутые части отображённого
+    файла копируются байт в байт (copy_file_bytes), поэтому объём работы
+    зависит от размера правок, а не файла.
+    progress(n) вызывается с числом записанных символов или байт.
+    """
+    import shutil
+    import tempfile
+
+    target = os.path.realpath(filename)
+    directory = os.path.dirname(target) or "."
+    fd, tmp_name = tempfile.mkstemp(prefix="." + os.path.basename(target) + ".",
+                                    suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            span = None  # соседние диапазоны одного файла копируются одним вызовом
+            for piece in itertools.chain(pieces, (None,)):
+                if span is not None and not (isinstance(piece, tuple) and piece[0] is span[0]
+                                             and piece[1] == span[2]):
+                    f.flush()
+                    source, start, end = span
+                    copy_file_bytes(source.file.fileno(), start, end - start, f.fileno(), progress)
+                    span = None
+                if piece is None:
+                    break
+                if isinstance(piece, str):
+                    f.write((piece.replace("\n", newline) if newline != "\n" else piece).encode("utf-8"))
+                    if progress:
+                        progress(len(piece))
+                elif span is None:
+                    span = piece
+                else:
+                    span = (span[0], span[1], piece[2])
+            if final_newline:
+                f.write(newline.encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            shutil.copymode(target, tmp_name)
+        except FileNotFoundError:
+            # Новый файл: mkstemp создаёт 0600, возвращаем обычные права с учётом umask
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_name, 0o666 & ~umask)
+        os.replace(tmp_name, target)
+    except BaseException:
+        try:
+            os.unlink(tmp_name)
+        except OSError:
+            pass
+        raise
+    # Фиксируем саму подмену в каталоге; не везде это поддерживается
+    try:
+        dir_fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+def save_file(filename, buf):
+    write_snapshot(filename, buf.snapshot(), newline=buf.newline, final_newline=buf.final_newline)
+
+class FileSaver:
+    """
+    Сохранение в фоновом потоке: снимок буфера берётся сразу, поэтому
+    редактирование можно продолжать, пока файл пишется на диск.
+    """
+
+    def __init__(self, filename, buf):
+        self.filename = filename
+        self.version = buf.version
+        pieces = buf.snapshot()
+        self.total = sum(len(p) if isinstance(p, str) else p[2] - p[1] for p in pieces) or 1
+        self.written = 0
+        self.error = None
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(pieces, buf.newline, buf.final_newline),
+                                       daemon=True)
+        self.thread.start()
+
+    def _advance(self, n):
+        self.written += n
+
+    def _run(self, pieces, newline, final_newline):
+        try:
+            write_snapshot(self.filename, pieces, self._advance, newline, final_newline)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done.set()
+
+    @property
+    def finished(self):
+        return self.done.is_set()
+
+    def progress(self):
+        return min(100, self.written * 100 // self.total)
+
+    def wait(self):
+        self.done.wait()
+
+FILE_CHECK_INTERVAL = 1.0  # как часто (с) проверять, не изменился ли файл на диске
+DIFF_MAX_LINES = 2000  # больший участок сравнивается по опорным строкам (patience diff)
+
+def file_signature(filename):
+    """(mtime, размер, inode, устройство) файла или None, если его нет."""
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino, st.st_dev)
+
+class FileWatch:
+    """
+    Замечает, что открытый файл переписал кто-то другой (форматтер,
+    git checkout). stat() вызывается не чаще раза в FILE_CHECK_INTERVAL;
+    known — подпись файла, какой его видел редактор (загрузка, сохранение
+    или перечитывание).
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.known = file_signature(filename)
+        self.checked = time.monotonic()
+
+    def changed(self, force=False):
+        """Изменился ли файл с последней известной подписи; без force — с паузой между проверками."""
+        now = time.monotonic()
+        if not force and now - self.checked < FILE_CHECK_INTERVAL:
+            return False
+        self.checked = now
+        return file_signature(self.filename) != self.known
+
+    def acknowledge(self, signature=None):
+        """Принимает текущее (или прочитанное FileReloader) состояние файла как известное."""
+        self.known = file_signature(self.filename) if signature is None else signature
+
+def _unique_anchors(old, new, a0, a1, b0, b1):
+    """
+    Пары (i, j) строк, которые встречаются ровно по разу в old[a0:a1] и в
+    new[b0:b1], — наибольшая возрастающая по обоим индексам цепочка
+    (опорные строки patience diff).
+    """
+    old_pos = {}
+    for i in range(a0, a1):
+        old_pos[old[i]] = -1 if old[i] in old_pos else i
+    new_pos = {}
+    for j in range(b0, b1):
+        new_pos[new[j]] = -1 if new[j] in new_pos else j
+    # Словарь хранит порядок первого появления, так что пары уже идут по возрастанию j
+    pairs = [(old_pos[line], j) for line, j in new_pos.items() if j >= 0 and old_pos.get(line, -1) >= 0]
+    if all(a[0] < b[0] for a, b in zip(pairs, pairs[1:])):
+        return pairs  # строки не переставлялись: цепочка — все пары
+    tails = []  # tails[k] — пара, которой кончается лучшая цепочка длины k + 1
+    tail_values = []
+    prev = []
+    for k, (i, j) in enumerate(pairs):
+        pos = bisect.bisect_left(tail_values, i)
+        prev.append(tails[pos - 1] if pos else None)
+        if pos == len(tails):
+            tails.append(k)
+            tail_values.append(i)
+        else:
+            tails[pos] = k
+            tail_values[pos] = i
+    chain = []
+    k = tails[-1] if tails else None
+    while k is not None:
+        chain.append(pairs[k])
+        k = prev[k]
+    chain.reverse()
+    return chain
+
+def _match_lines(old, new, a0, a1, b0, b1, blocks):
+    """Дописывает в blocks совпадающие участки (i, j, длина) old[a0:a1] и new[b0:b1] по порядку."""
+    import difflib
+
+    # Общие начало и конец отрезаем сразу: обычно меняется малая часть файла
+    head = 0
+    while a0 + head < a1 and b0 + head < b1 and old[a0 + head] == new[b0 + head]:
+        head += 1
+    if head:
+        blocks.append((a0, b0, head))
+        a0 += head
+        b0 += head
+    tail = 0
+    while a0 < a1 - tail and b0 < b1 - tail and old[a1 - 1 - tail] == new[b1 - 1 - tail]:
+        tail += 1
+    a1 -= tail
+    b1 -= tail
+    if a0 < a1 and b0 < b1:
+        if a1 - a0 <= DIFF_MAX_LINES and b1 - b0 <= DIFF_MAX_LINES:
+            matcher = difflib.SequenceMatcher(None, old[a0:a1], new[b0:b1], autojunk=False)
+            blocks.extend((a0 + i, b0 + j, n) for i, j, n in matcher.get_matching_blocks() if n)
+        else:
+            # SequenceMatcher на таком участке работает квадратичное время:
+            # режем его по опорным строкам и сравниваем промежутки отдельно.
+            # Без опорных строк участок заменяется целиком
+            anchors = _unique_anchors(old, new, a0, a1, b0, b1)
+            for i, j in anchors:
+                if a0 < i or b0 < j:
+                    _match_lines(old, new, a0, i, b0, j, blocks)
+                last_i, last_j, n = blocks[-1] if blocks else (-1, -1, 0)
+                if last_i + n == i and last_j + n == j:
+                    blocks[-1] = (last_i, last_j, n + 1)  # подряд идущие опорные строки — один участок
+                else:
+                    blocks.append((i, j, 1))
+                a0, b0 = i + 1, j + 1
+            if anchors:
+                _match_lines(old, new, a0, a1, b0, b1, blocks)
+    if tail:
+        blocks.append((a1, b1, tail))
+
+def line_diff(old_text, new_text):
+    """
+    Построчная разница двух текстов. Возвращает (правки, opcodes): правки —
+    (начало, конец, новый текст) в смещениях old_text по возрастанию, opcodes —
+    как у difflib.SequenceMatcher, для переноса номеров строк (map_line).
+    """
+    old = old_text.split("\n")
+    new = new_text.split("\n")
+    blocks = []
+    _match_lines(old, new, 0, len(old), 0, len(new), blocks)
+    opcodes = []
+    i = j = 0
+    for bi, bj, n in blocks + [(len(old), len(new), 0)]:
+        if i < bi or j < bj:
+            tag = "replace" if i < bi and j < bj else "delete" if i < bi else "insert"
+            opcodes.append((tag, i, bi, j, bj))
+        if n:
+            opcodes.append(("equal", bi, bi + n, bj, bj + n))
+        i, j = bi + n, bj + n
+
+    # start — смещение строки i1 в old_text; равные участки пропускаются суммой длин
+    edits = []
+    start = 0
+    for tag, i1, i2, j1, j2 in opcodes:
+        end = start + sum(map(len, old[i1:i2])) + (i2 - i1)  # начало строки i2
+        if tag == "equal":
+            start = end
+            continue
+        text = "\n".join(new[j1:j2])
+        if i1 == i2:  # вставка строк перед i1 (или после последней)
+            if i1 < len(old):
+                edits.append((start, start, text + "\n"))
+            else:
+                edits.append((start - 1, start - 1, "\n" + text))
+        elif j1 == j2:  # удаление строк i1..i2-1 вместе с их переводами строк
+            if i2 < len(old):
+                edits.append((start, end, ""))
+            elif i1 > 0:
+                edits.append((start - 1, end - 1, ""))
+            else:
+                edits.append((0, end - 1, ""))
+        else:
+            edits.append((start, end - 1, text))
+        start = end
+    return edits, opcodes
+
+def map_line(opcodes, line_no):
+    """Номер строки после применения разницы: из изменённого участка — в ближайшую новую строку."""
+    new_count = opcodes[-1][4]
+    for tag, i1, i2, j1, j2 in opcodes:
+        if i1 <= line_no < i2:
+            shift = line_no - i1 if tag == "equal" else min(line_no - i1, max(j2 - j1 - 1, 0))
+            return max(min(j1 + shift, new_count - 1), 0)
+    return max(new_count - 1, 0)
+
+class FileReloader:
+    """
+    Перечитывание изменившегося на диске файла в фоновом потоке: снимок
+    буфера сравнивается с новым содержимым построчно (line_diff), а главный
+    поток потом применяет только изменённые участки — курсор и история
+    правок остаются на месте. Если буфер успел измениться (version),
+    результат устарел и не применяется.
+    """
+
+    def __init__(self, filename, buf):
+        self.filename = filename
+        self.version = buf.version
+        self.edits = None
+        self.opcodes = None
+        self.signature = None
+        self.newline = None
+        self.final_newline = None
+        self.error = None
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(buf.snapshot(),), daemon=True)
+        self.thread.start()
+
+    def _run(self, pieces):
+        try:
+            with open(self.filename, 'rb') as f:
+                st = os.fstat(f.fileno())
+                new_text, self.newline, self.final_newline = read_buffer_text(f)
+            self.signature = (st.st_mtime_ns, st.st_size, st.st_ino, st.st_dev)
+            old_text = "".join(text for _, text in iter_snapshot_blocks(pieces))
+            self.edits, self.opcodes = line_diff(old_text, new_text)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done.set()
+
+    @property
+    def finished(self):
+        return self.done.is_set()
+
+def prompt_user(stdscr, prompt):
+    curses.echo()
+    height, width = stdscr.getmaxyx()
+    stdscr.move(height - 1, 0)
+    stdscr.clrtoeol()
+    stdscr.addstr(height - 1, 0, prompt)
+    stdscr.refresh()
+    inp = stdscr.getstr(height - 1, len(prompt), width - len(prompt) - 1)
+    curses.noecho()
+    try:
+        return inp.decode("utf-8").strip()
+    except Exception:
+        return ""
+
+def prompt_user_cancelable(stdscr, prompt, strip=True):
+    height, width = stdscr.getmaxyx()
+    input_str = ""
+    pos = len(prompt)
+    stdscr.move(height - 1, 0)
+    stdscr.clrtoeol()
+    stdscr.addstr(height - 1, 0, prompt)
+    stdscr.refresh()
+    while True:
+        ch = stdscr.getch()
+        if ch == 27:
+            return None
+        elif ch in (curses.KEY_ENTER, 10, 13):
+            break
+        elif ch in (curses.KEY_BACKSPACE, 127, 8):
+            if len(input_str) > 0:
+                input_str = input_str[:-1]
+                pos -= 1
+                stdscr.move(height - 1, pos)
+                stdscr.delch(height - 1, pos)
+        else:
+            if 0 <= ch < 256:
+                c = chr(ch)
+                if c.isprintable():
+                    input_str += c
+                    stdscr.addstr(height - 1, pos, c)
+                    pos += 1
+        stdscr.refresh()
+    return input_str.strip() if strip else input_str
+
+# ASCII art и приветственное сообщение
+ASCII_ART = r"""
+  _    _       _     _       _       
+ | |  | |     (_)   | |     | |      
+ | |  | |_ __  _ ___| | __ _| |_ ___ 
+ | |  | | '_ \| / __| |/ _` | __/ _ \
+ | |__| | | | | \__ \ | (_| | ||  __/
+  \____/|_| |_|_|___/_|\__,_|\__\___|
+                                                   
+developed by qwez with ♥️
+"""
+
+def draw_welcome(stdscr, colors):
+    stdscr.clear()
+    height, width = stdscr.getmaxyx()
+    ascii_lines = ASCII_ART.strip("\n").splitlines()
+    total_lines = len(ascii_lines) + 3
+    start_y = max((height - total_lines) // 2, 0)
+    for idx, line in enumerate(ascii_lines):
+        x = max((width - len(line)) // 2, 0)
+        try:
+            stdscr.addstr(start_y + idx, x, line, colors["default"])
+        except curses.error:
+            pass
+    prompt_msg = "Press any key to start..."
+    try:
+        stdscr.addstr(start_y + len(ascii_lines) + 2, max((width - len(prompt_msg)) // 2, 0),
+                      prompt_msg, colors["default"])
+    except curses.error:
+        pass
+    stdscr.refresh()
+    key = stdscr.getch()
+    if key == 17:
+        curses.endwin()
+        sys.exit(0)
+
+##############################
+# Функции для выделения
+##############################
+
+def get_line_selection_range(line_no, sel_start, sel_end, line_length):
+    if sel_start is None or sel_end is None:
+        return None
+    (sy, sx) = sel_start
+    (ey, ex) = sel_end
+    if (sy, sx) > (ey, ex):
+        sy, sx, ey, ex = ey, ex, sy, sx
+    if line_no < sy or line_no > ey:
+        return None
+    if sy == ey:
+        return (min(sx, ex), max(sx, ex))
+    if line_no == sy:
+        return (sx, line_length)
+    elif line_no == ey:
+        return (0, ex)
+    else:
+        return (0, line_length)
+
+def apply_selection_to_segment(text, seg_start, seg_end, sel_start, sel_end, base_attr, sel_attr=None):
+    # sel_attr=None — выделение инверсией поверх цвета подсветки
+    result = []
+    if seg_end <= sel_start or seg_start >= sel_end:
+        return [(text, base_attr)]
+    if seg_start < sel_start:
+        prefix_len = sel_start - seg_start
+        result.append((text[:prefix_len], base_attr))
+        text = text[prefix_len:]
+        seg_start = sel_start
+    overlap = min(seg_end, sel_end) - seg_start
+    if overlap > 0:
+        result.append((text[:overlap], base_attr | curses.A_REVERSE if sel_attr is None else sel_attr))
+        text = text[overlap:]
+        seg_start += overlap
+    if seg_start < seg_end:
+        result.append((text, base_attr))
+    return result
+
+def get_selection_offsets(buf, sel_start, sel_end):
+    (sy, sx) = sel_start
+    (ey, ex) = sel_end
+    if (sy, sx) > (ey, ex):
+        sy, sx, ey, ex = ey, ex, sy, sx
+    return buf.offset(sy, sx), buf.offset(ey, ex)
+
+def get_selected_text(buf, sel_start, sel_end):
+    start, end = get_selection_offsets(buf, sel_start, sel_end)
+    return buf.get_range(start, end)
+
+def remove_selected_text(buf, sel_start, sel_end):
+    start, end = get_selection_offsets(buf, sel_start, sel_end)
+    buf.delete(start, end)
+    return buf
+
+##############################
+# Поиск и замена
+##############################
+
+SEARCH_BLOCK_CHARS = 1024 * 1024  # столько текста регулярка видит за раз
+
+def iter_snapshot_blocks(pieces, block_size=SEARCH_BLOCK_CHARS):
+    """
+    Обходит снимок буфера (TextBuffer.snapshot) блоками целых строк.
+    Отдаёт пары (смещение блока в символах, текст блока); все блоки, кроме
+    последнего, заканчиваются переводом строки.
+    """
+    offset = 0
+    carry = ""
+    parts = []
+    size = 0
+    for piece in pieces:
+        texts = (piece,) if isinstance(piece, str) else piece[0].iter_text(piece[1], piece[2])
+        for text in texts:
+            parts.append(text)
+            size += len(text)
+            if size < block_size:
+                continue
+            block = carry + "".join(parts)
+            parts = []
+            cut = block.rfind("\n") + 1
+            if cut == 0:
+                carry = block  # одна очень длинная строка — копим дальше
+                size = len(carry)
+                continue
+            yield offset, block[:cut]
+            offset += cut
+            carry = block[cut:]
+            size = len(carry)
+    block = carry + "".join(parts)
+    cut = block.rfind("\n") + 1
+    if cut:
+        yield offset, block[:cut]
+    # Хвост после последнего перевода строки отдаём всегда, даже пустой:
+    # это последняя строка буфера
+    yield offset + cut, block[cut:]
+
+def _block_endpos(block):
+    # Последний перевод строки блока не отдаём регулярке: иначе $ совпал бы
+    # ещё и после него, в начале следующего блока
+    return len(block) - 1 if block.endswith("\n") else len(block)
+
+def compile_search(pattern):
+    """Регулярное выражение поиска; re.error пробрасывается вызывающему."""
+    return re.compile(pattern, re.MULTILINE)
+
+def find_text(buf, needle, start=0, end=None):
+    """Смещение первого вхождения needle в [start, end) буфера или None; текст читается по чанкам."""
+    keep = len(needle) - 1
+    carry = ""
+    base = start
+    for chunk in buf.iter_chunks(start, end):
+        text = carry + chunk
+        index = text.find(needle)
+        if index != -1:
+            return base + index
+        # Вхождение может начаться в конце чанка: его хвост переходит в следующий
+        carry = text[len(text) - keep:] if keep else ""
+        base += len(text) - len(carry)
+    return None
+
+class SearchWorker:
+    """
+    Фоновый поиск по снимку буфера. Найденные совпадения (начало, конец)
+    дописываются в self.matches по мере продвижения, поэтому интерфейс
+    может показывать их, не дожидаясь конца прохода. Совпадения
+    не пересекают границы блоков (SEARCH_BLOCK_CHARS).
+    """
+
+    def __init__(self, buf, regex):
+        self.regex = regex
+        self.version = buf.version
+        self.matches = []
+        self.starts = []  # для bisect
+        self.cancelled = False
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(buf.snapshot(),), daemon=True)
+        self.thread.start()
+
+    def _run(self, pieces):
+        try:
+            finditer = self.regex.finditer
+            for base, block in iter_snapshot_blocks(pieces):
+                if self.cancelled:
+                    return
+                for m in finditer(block, 0, _block_endpos(block)):
+                    start, end = m.span()
+                    if start == end:
+                        continue  # пустые совпадения не подсвечиваются и не выбираются
+                    # Сначала matches: главный поток читает их по длине starts
+                    self.matches.append((base + start, base + end))
+                    self.starts.append(base + start)
+        finally:
+            self.done.set()
+
+    def cancel(self):
+        self.cancelled = True
+
+    @property
+    def finished(self):
+        return self.done.is_set()
+
+    def count(self):
+        return len(self.starts)
+
+    def find_from(self, offset, backward=False):
+        """Индекс ближайшего совпадения от offset (с переходом через край) или None."""
+        n = len(self.starts)
+        if not n:
+            return None
+        if backward:
+            i = bisect.bisect_left(self.starts, offset, 0, n) - 1
+            if i >= 0:
+                return i
+            return n - 1 if self.finished else None
+        i = bisect.bisect_left(self.starts, offset, 0, n)
+        if i < n:
+            return i
+        # Дальше совпадений пока нет; по кругу — только когда проход закончен
+        return 0 if self.finished else None
+
+    def visible(self, buf, first_line, last_line):
+        """{номер строки: [(начало, конец), ...]} для совпадений в видимых строках."""
+        if buf.version != self.version:
+            return {}
+        n = len(self.starts)
+        lo = buf.line_start(first_line)
+        hi = buf.line_end(min(last_line, buf.line_count() - 1))
+        result = {}
+        i = bisect.bisect_left(self.starts, lo, 0, n)
+        while i < n and self.matches[i][0] <= hi:
+            start, end = self.matches[i]
+            y, x = buf.position(start)
+            ey, ex = buf.position(end)
+            while y <= ey and y <= last_line:
+                line_end = ex if y == ey else buf.line_length(y)
+                result.setdefault(y, []).append((x, line_end))
+                y += 1
+                x = 0
+            i += 1
+        return result
+
+def replace_all(buf, regex, repl):
+    """
+    Заменяет все совпадения одной правкой буфера: от первого изменённого
+    места до последнего. Регулярка идёт по всему тексту сразу, а не по
+    блокам, иначе совпадения через границу блока (например, \\n) пропадали бы.
+    Возвращает число замен; re.error пробрасывается.
+    """
+    text = buf.text()
+    match = regex.search(text)
+    if match is None:
+        return 0
+    new_text, total = regex.subn(repl, text)
+    first = match.start()  # до первого совпадения текст не меняется
+    # Общий хвост старого и нового текста: шагами, уменьшающимися вдвое
+    tail = 0
+    limit = min(len(text), len(new_text)) - first
+    step = 1 << 16
+    while step:
+        while (tail + step <= limit
+               and text[len(text) - tail - step:len(text) - tail]
+               == new_text[len(new_text) - tail - step:len(new_text) - tail]):
+            tail += step
+        step >>= 1
+    if total:
+        buf.delete(first, len(text) - tail)
+        buf.insert(first, new_text[first:len(new_text) - tail])
+    return total
+
+##############################
+# Отрисовка редактора с номерами строк и выделением
+##############################
+
+class ScreenDamage:
+    """
+    Учёт «грязных» строк между кадрами: правки буфера, смена выделения,
+    прокрутка и статусная строка. draw_editor перерисовывает только их.
+    Заодно кэширует проверку существования файла для статусной строки.
+    """
+
+    def __init__(self, buf=None):
+        self.buf = buf
+        self.full = True
+        self.dirty_lines = set()
+        self.dirty_from = None  # все строки начиная с этой (вставка/удаление строк)
+        self.frame = None
+        self.sel_keys = {}
+        self.status = None
+        self.pending = set()  # строки, нарисованные без готовой подсветки
+        self.colored = {}  # строка -> сегменты последнего кадра: временные цвета до прихода подсветки
+        self._exists = {}
+        if buf is not None:
+            buf.listeners.append(self.on_edit)
+
+    def on_edit(self, offset, removed, inserted):
+        line_no = self.buf.position(offset)[0]
+        if "\n" in removed or "\n" in inserted:
+            self.mark_from(line_no)
+            # Ниже правки строки сдвинулись: их старые цвета относятся к другим строкам
+            self.colored = {y: v for y, v in self.colored.items() if y < line_no}
+        else:
+            self.dirty_lines.add(line_no)
+
+    def mark_from(self, line_no):
+        if self.dirty_from is None or line_no < self.dirty_from:
+            self.dirty_from = line_no
+
+    def invalidate(self):
+        self.full = True
+        self.status = None
+
+    def invalidate_status(self):
+        self.status = None
+
+    def scrolled(self, shift, rows, offset_y):
+        """
+        Текст на экране сдвинут на shift строк вверх (вниз, если shift < 0):
+        сдвигаем запомненные выделения строк экрана, открывшиеся строки — грязные.
+        """
+        self.sel_keys = {i - shift: key for i, key in self.sel_keys.items() if 0 <= i - shift < rows}
+        exposed = range(rows - shift, rows) if shift > 0 else range(-shift)
+        self.dirty_lines.update(offset_y + i for i in exposed)
+
+    def is_dirty(self, line_no):
+        return line_no in self.dirty_lines or (self.dirty_from is not None and line_no >= self.dirty_from)
+
+    def file_exists(self, filename):
+        if filename not in self._exists:
+            self._exists[filename] = os.path.exists(filename)
+        return self._exists[filename]
+
+    def forget_file(self, filename):
+        self._exists.pop(filename, None)
+        self.status = None
+
+    def clean(self):
+        self.full = False
+        self.dirty_lines.clear()
+        self.dirty_from = None
+
+
+def line_number_width(line_count):
+    return len(str(line_count)) + 2
+
+def follow_cursor_x(cursor_x, offset_x, text_width):
+    """
+    Горизонтальная прокрутка, при которой колонка курсора видна. Окно
+    сдвигается скачком на четверть ширины, а не на символ: каждый сдвиг
+    перерисовывает весь экран.
+    """
+    if cursor_x < offset_x:
+        return max(0, cursor_x - text_width // 4)
+    if cursor_x >= offset_x + text_width:
+        return cursor_x - text_width + 1 + text_width // 4
+    return offset_x
+
+def line_segments(buf, lexer_states, lexer, line_no, offset_x, text_width, colors, line_start=None,
+                  highlighter=None, stale=None):
+    """
+    Сегменты подсветки строки line_no, покрывающие видимые колонки
+    [offset_x, offset_x + text_width), колонка, с которой они начинаются,
+    длина строки и флаг «подсветка готова». Длинная строка целиком не читается
+    и не лексируется: только окно от ближайшей контрольной точки лексера
+    с запасом WINDOW_LOOKAHEAD. line_start можно передать, если начало строки
+    уже известно.
+    С highlighter лексер в этом потоке не вызывается: если результата ещё нет,
+    строка запрашивается у фонового потока, а сегменты берут цвета из stale
+    (сегменты прошлого кадра) или остаются без цвета.
+    """
+    if line_start is None:
+        line_start = buf.line_start(line_no)
+    length = buf.line_end(line_no) - line_start
+    known = highlighter is None or line_no < lexer_states.valid
+    if length <= LONG_LINE_THRESHOLD:
+        line = buf.get_range(line_start, line_start + length)
+        if highlighter is None:
+            state = lexer_states.state_before(line_no)
+            return highlight_cache.lex(lexer, line, state, colors)[0], 0, length, True
+        if known:
+            state = lexer_states.states[line_no - 1] if line_no > 0 else None
+            result = highlight_cache.get(lexer, line, state, colors)
+            if result is not None:
+                return result[0], 0, length, True
+            highlighter.request(lexer, line, state)
+        return restyle_segments(line, stale or (), colors["default"]), 0, length, False
+    if not known:
+        text = read_line_piece(buf, line_start, offset_x, offset_x + text_width, length)[0]
+        return [(text, colors["default"])], offset_x, length, False
+    origin, state = lexer_states.column_state(line_no, offset_x)
+    base = max(origin - 1, 0)  # символ перед окном нужен для ^ и \b
+    text = read_line_piece(buf, line_start, base, offset_x + text_width + WINDOW_LOOKAHEAD, length)[0]
+    return lexer.lex(text, state, colors, origin - base)[0], origin, length, True
+
+def restyle_segments(line, segments, default_attr):
+    """Раскрашивает line атрибутами старых сегментов по колонкам; остаток — default_attr."""
+    result = []
+    pos = 0
+    for text, attr in segments:
+        if pos >= len(line):
+            break
+        result.append((line[pos:pos + len(text)], attr))
+        pos += len(text)
+    if pos < len(line):
+        result.append((line[pos:], default_attr))
+    return result
+
+def _paint_range(pieces, pos, start, end, attr=None):
+    painted = []
+    for text, piece_attr in pieces:
+        painted.extend(apply_selection_to_segment(text, pos, pos + len(text), start, end, piece_attr, attr))
+        pos += len(text)
+    return painted
+
+def draw_line(stdscr, row, line_no, segments, origin, offset_x, line_num_width, width, colors, sel_range,
+              match_ranges=None, caret_ranges=None):
+    line_number = f"{line_no+1}".rjust(line_num_width - 1) + " "
+    try:
+        stdscr.addstr(row, 0, line_number, curses.A_DIM)
+    except curses.error:
+        pass
+
+    x = line_num_width
+    column = origin
+    for text, attr in segments:
+        seg_start = column
+        column += len(text)
+        if column <= offset_x:
+            continue
+        if seg_start < offset_x:
+            text = text[offset_x - seg_start:]
+            seg_start = offset_x
+        if x >= width:
+            break
+        text = text[:width - x]
+        if sel_range is None and not match_ranges and not caret_ranges:
+            try:
+                stdscr.addstr(row, x, text, attr)
+            except curses.error:
+                pass
+            x += len(text)
+            continue
+        pieces = [(text, attr)]
+        # Совпадения поиска красим поверх подсветки, выделение — поверх них
+        for start, end in match_ranges or ():
+            pieces = _paint_range(pieces, seg_start, start, end, colors["search_match"])
+        if sel_range is not None:
+            pieces = _paint_range(pieces, seg_start, sel_range[0], sel_range[1])
+        # Дополнительные курсоры и их выделения — так же инверсией
+        for start, end in caret_ranges or ():
+            pieces = _paint_range(pieces, seg_start, start, end)
+        for piece_text, piece_attr in pieces:
+            try:
+                stdscr.addstr(row, x, piece_text, piece_attr)
+            except curses.error:
+                pass
+            x += len(piece_text)
+    # Курсор за последним символом строки рисуется инверсным пробелом
+    for start, end in caret_ranges or ():
+        for col in range(max(start, column), end):
+            screen_x = line_num_width + col - offset_x
+            if line_num_width <= screen_x < width:
+                try:
+                    stdscr.addstr(row, screen_x, " ", curses.A_REVERSE)
+                except curses.error:
+                    pass
+
+def scroll_rows(stdscr, shift, rows):
+    """
+    Сдвигает верхние rows строк экрана (текст без статусной строки) на shift
+    вверх областью прокрутки терминала. С idlok curses отправляет терминалу
+    сдвиг и только открывшиеся строки, а не весь экран. False — окно не
+    прокрутилось, нужна полная перерисовка.
+    """
+    try:
+        stdscr.setscrreg(0, rows - 1)
+        stdscr.scrollok(True)
+        stdscr.scroll(shift)
+        return True
+    except curses.error:
+        return False
+    finally:
+        # Иначе запись в правый нижний угол области прокручивала бы её
+        stdscr.scrollok(False)
+
+def draw_editor(stdscr, buf, cursor_y, cursor_x, offset_y, offset_x, filename, colors, sel_start, sel_end,
+                damage=None, lexer_states=None, message=None, highlights=None, profiler=None, highlighter=None,
+                carets=None):
+    if damage is None:
+        damage = ScreenDamage()
+    height, width = stdscr.getmaxyx()
+    lexer = get_lexer(filename)
+    if lexer_states is None:
+        lexer_states = LexerStates(buf, lexer, listen=False)
+    elif lexer_states.lexer is not lexer:
+        lexer_states.reset(lexer)
+        damage.full = True
+    
+    line_count = buf.line_count()
+    line_num_width = line_number_width(line_count)
+    frame = (offset_y, offset_x, line_num_width, height, width)
+    if damage.frame != frame:
+        shift = offset_y - damage.frame[0] if damage.frame is not None and damage.frame[1:] == frame[1:] else None
+        damage.frame = frame
+        if damage.full or shift is None or abs(shift) >= height - 1 or not scroll_rows(stdscr, shift, height - 1):
+            damage.full = True
+        else:
+            damage.scrolled(shift, height - 1, offset_y)
+
+    # Строки, у которых сменилось входное состояние лексера, нужно перекрасить
+    if profiler is not None:
+        profiler.switch("highlight")
+    bottom = offset_y + height - 1
+    deadline = time.monotonic() + HIGHLIGHT_FRAME_WAIT
+    if highlighter is None:
+        lexer_states.advance(bottom)
+    else:
+        # Контрольные точки считает фоновый поток; ждём его не дольше HIGHLIGHT_FRAME_WAIT
+        highlighter.wait(offset_y, bottom, deadline)
+        if highlighter.take_arrived():
+            # Строки, нарисованные раньше без подсветки, перерисуем с ней
+            damage.dirty_lines.update(damage.pending)
+    if profiler is not None:
+        profiler.switch("draw")
+    changed = lexer_states.take_changed()
+    if changed is not None:
+        damage.dirty_lines.update(range(max(changed[0], offset_y), min(changed[1], offset_y + height - 1) + 1))
+
+    # Строки, у которых поменялось выделение, тоже считаются грязными
+    rows = []
+    for i in range(height - 1):
+        actual_line = i + offset_y
+        sel_key = get_line_selection_range(actual_line, sel_start, sel_end, None)
+        if highlights and actual_line in highlights:
+            sel_key = (sel_key, tuple(highlights[actual_line]))
+        if carets and actual_line in carets:
+            sel_key = (sel_key, tuple(carets[actual_line]))
+        if damage.full or damage.is_dirty(actual_line) or damage.sel_keys.get(i) != sel_key:
+            rows.append(i)
+        damage.sel_keys[i] = sel_key
+
+    if damage.full:
+        stdscr.erase()
+        damage.status = None
+        damage.pending.clear()
+    text_width = max(width - line_num_width, 1)
+
+    def paint_row(i, line_start, clear):
+        """Рисует строку экрана i; возвращает длину строки или None за концом буфера."""
+        actual_line = i + offset_y
+        if clear:
+            try:
+                stdscr.move(i, 0)
+                stdscr.clrtoeol()
+            except curses.error:
+                pass
+        if actual_line >= line_count:
+            return None
+        segments, origin, length, ready = line_segments(buf, lexer_states, lexer, actual_line, offset_x, text_width,
+                                                        colors, line_start, highlighter,
+                                                        damage.colored.get(actual_line))
+        if highlighter is not None:
+            if ready:
+                damage.pending.discard(actual_line)
+                if origin == 0:
+                    damage.colored[actual_line] = segments
+            else:
+                damage.pending.add(actual_line)
+        sel_range = get_line_selection_range(actual_line, sel_start, sel_end, length)
+        draw_line(stdscr, i, actual_line, segments, origin, offset_x, line_num_width, width, colors, sel_range,
+                  highlights.get(actual_line) if highlights else None, carets.get(actual_line) if carets else None)
+        return length
+
+    prev_row = None
+    line_start = 0  # при полной перерисовке строки идут подряд: начало следующей известно
+    for i in rows:
+        if prev_row != i - 1 and i + offset_y < line_count:
+            line_start = buf.line_start(i + offset_y)
+        length = paint_row(i, line_start, not damage.full)
+        if length is not None:
+            line_start += length + 1
+            prev_row = i
+    if highlighter is not None:
+        if damage.pending:
+            # Строки без подсветки уже запрошены: если она успеет к сроку кадра, перерисуем их сразу
+            if profiler is not None:
+                profiler.switch("highlight")
+            highlighter.wait(offset_y, bottom, deadline)
+            if profiler is not None:
+                profiler.switch("draw")
+            if highlighter.take_arrived():
+                for actual_line in sorted(damage.pending):
+                    if offset_y <= actual_line < bottom:
+                        paint_row(actual_line - offset_y, None, True)
+        if damage.full:
+            damage.colored = {y: v for y, v in damage.colored.items() if offset_y <= y < bottom}
+    damage.clean()
+                    
+    # Статусная строка – только информация, без управления.
+    # Добавлено указание, если файл новый (еще не существует).
+    if filename is None:
+        status_filename = "untitled (new)"
+    elif not damage.file_exists(filename):
+        status_filename = f"{filename} (new)"
+    else:
+        status_filename = filename
+
+    if message:
+        mode = message
+    elif buf.loading:
+        mode = f"LOADING {buf.source.progress():.0%}"
+    else:
+        mode = "EDIT"
+    status = f"{status_filename} | Ln {cursor_y+1}/{line_count} | Col {cursor_x+1} | {mode}"
+    if status != damage.status:
+        damage.status = status
+        try:
+            stdscr.addstr(height - 1, 0, status[:width].ljust(width), colors["default"])
+        except curses.error:
+            pass
+    scr_y = cursor_y - offset_y
+    scr_x = (cursor_x - offset_x) + line_num_width
+    if 0 <= scr_y < height - 1 and 0 <= scr_x < width:
+        try:
+            stdscr.move(scr_y, scr_x)
+        except curses.error:
+            pass
+    stdscr.noutrefresh()
+    if profiler is not None:
+        profiler.switch("refresh")
+    # Пока в терминал пишется OSC 52, кадр остаётся в curses и уйдёт следующим doupdate
+    if terminal_lock.acquire(blocking=False):
+        try:
+            curses.doupdate()
+        finally:
+            terminal_lock.release()
+
+##############################
+# Ввод: пачки нажатий и bracketed paste
+##############################
+
+PASTE_BEGIN = "[200~"  # после ESC
+PASTE_END = b"\x1b[201~"
+PASTE_TIMEOUT = 1000   # мс ожидания продолжения вставки
+KEY_PASTE = -2         # get() вернул вставленный блок, текст в reader.paste_text
+
+# Alt+стрелки, Alt+Shift+стрелки и Ctrl+Home/End: своих констант в curses у них
+# нет, терминал назначает им коды сам (расширенные имена terminfo). KeyReader
+# переводит их в эти виртуальные коды
+KEY_ALT_UP = -3
+KEY_ALT_DOWN = -4
+KEY_ALT_SHIFT_UP = -5
+KEY_ALT_SHIFT_DOWN = -6
+KEY_ALT_SHIFT_LEFT = -7
+KEY_ALT_SHIFT_RIGHT = -8
+KEY_CTRL_HOME = -9
+KEY_CTRL_END = -10
+KEY_CTRL_SHIFT_HOME = -11
+KEY_CTRL_SHIFT_END = -12
+EXTENDED_KEYS = {
+    b"kUP3": KEY_ALT_UP, b"kDN3": KEY_ALT_DOWN,
+    b"kUP4": KEY_ALT_SHIFT_UP, b"kDN4": KEY_ALT_SHIFT_DOWN,
+    b"kLFT4": KEY_ALT_SHIFT_LEFT, b"kRIT4": KEY_ALT_SHIFT_RIGHT,
+    b"kHOM5": KEY_CTRL_HOME, b"kEND5": KEY_CTRL_END,
+    b"kHOM6": KEY_CTRL_SHIFT_HOME, b"kEND6": KEY_CTRL_SHIFT_END,
+}
+
+def extended_key_codes():
+    """
+    {код curses: виртуальный код} для EXTENDED_KEYS в текущем терминале.
+    Пусто, если терминал их не описывает или curses не инициализирован.
+    """
+    codes = {}
+    for code in range(curses.KEY_MIN, 1024):
+        try:
+            name = curses.keyname(code)
+        except ValueError:
+            continue
+        except curses.error:
+            break  # initscr() не вызывался
+        if name in EXTENDED_KEYS:
+            codes[code] = EXTENDED_KEYS[name]
+    return codes
+
+class KeyReader:
+    """
+    Чтение клавиш с возвратом (pushback) и разбором bracketed paste.
+    Ведёт счётчики: сколько клавиш, пачек ввода и кадров, чтобы можно было
+    посмотреть, сколько перерисовок приходится на одну пачку.
+    """
+
+    def __init__(self, stdscr):
+        self.stdscr = stdscr
+        self.pushback = collections.deque()
+        self.paste_text = ""
+        self.keys = 0
+        self.bursts = 0
+        self.frames = 0
+        self.pastes = 0
+        self.decode_time = 0.0  # время разбора ввода (без ожидания клавиш)
+        self.extended = extended_key_codes()
+
+    @staticmethod
+    def set_bracketed_paste(enabled):
+        sys.stdout.write("\x1b[?2004h" if enabled else "\x1b[?2004l")
+        sys.stdout.flush()
+
+    def _getch(self, timeout):
+        if self.pushback:
+            return self.pushback.popleft()
+        self.stdscr.timeout(timeout)
+        return self.stdscr.getch()
+
+    def get(self, timeout=-1):
+        """
+        Следующая клавиша; timeout=0 — только то, что уже лежит во вводе (-1, если пусто).
+        Вставка через терминал целиком возвращается как KEY_PASTE.
+        """
+        key = self._getch(timeout)
+        if key == -1:
+            return key
+        started = time.perf_counter()
+        if timeout != 0:
+            self.bursts += 1
+        self.keys += 1
+        if key == 27 and self._match_paste_begin():
+            self.paste_text = self._read_paste()
+            self.pastes += 1
+            key = KEY_PASTE
+        else:
+            key = self.extended.get(key, key)
+        self.decode_time += time.perf_counter() - started
+        return key
+
+    def _match_paste_begin(self):
+        seen = []
+        for expected in PASTE_BEGIN:
+            key = self._getch(0)
+            if key == -1:
+                break
+            seen.append(key)
+            if key != ord(expected):
+                break
+        else:
+            return True
+        self.pushback.extendleft(reversed(seen))
+        return False
+
+    def _read_paste(self):
+        data = bytearray()
+        while not data.endswith(PASTE_END):
+            key = self._getch(PASTE_TIMEOUT)
+            if key == -1:
+                break  # терминал так и не закрыл вставку
+            if key < 256:  # коды KEY_* внутри вставки не несут текста
+                data.append(key)
+        if data.endswith(PASTE_END):
+            del data[-len(PASTE_END):]
+        text = data.decode("utf-8", errors="replace")
+        return text.replace("\r\n", "\n").replace("\r", "\n")
+
+##############################
+# Буфер обмена
+##############################
+
+CLIPBOARD_PASTE_TIMEOUT = 0.5  # сколько секунд вставка ждёт системный буфер обмена
+OSC52_CHUNK = 64 * 1024  # OSC 52 пишется в терминал кусками такого размера
+terminal_lock = threading.Lock()  # вывод в терминал в обход curses (OSC 52)
+
+_pyperclip = None
+
+def system_clipboard():
+    """
+    Модуль pyperclip или None, если его нет. Импортируется при первом
+    копировании или вставке: при импорте он перебирает бэкенды буфера обмена.
+    """
+    global _pyperclip
+    if _pyperclip is None:
+        try:
+            import pyperclip
+        except ImportError:
+            pyperclip = False
+        _pyperclip = pyperclip
+    return _pyperclip or None
+
+def has_clipboard_backend():
+    """Есть ли системный буфер обмена: без X11/Wayland xclip и xsel только зависнут."""
+    if sys.platform in ("darwin", "win32", "cygwin"):
+        return True
+    return bool(os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY"))
+
+def osc52_sequence(text):
+    """Управляющая последовательность OSC 52: терминал кладёт text в свой буфер обмена."""
+    import base64
+    return "\x1b]52;c;" + base64.b64encode(text.encode("utf-8")).decode("ascii") + "\x07"
+
+class Clipboard:
+    """
+    Буфер обмена редактора. Внутренний текст (self.text) обновляется сразу,
+    а обмен с системным буфером (pyperclip, то есть xclip/xsel на Linux)
+    идёт в фоновом потоке: скопированное отдаётся системе без ожидания,
+    а системный буфер читается только при вставке, и она ждёт его не
+    дольше CLIPBOARD_PASTE_TIMEOUT. Без X11/Wayland, например по SSH,
+    скопированное уходит терминалу последовательностью OSC 52; прочитать
+    её обратно терминалы обычно не дают, так что вставка тогда берёт
+    внутренний текст.
+    OSC 52 выводится под terminal_lock: пока он пишется, draw_editor
+    не сбрасывает кадр в терминал, но ввод продолжает обрабатываться.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.backend = has_clipboard_backend()
+        self.cond = threading.Condition()
+        self.copy_pending = None  # текст, ещё не отданный системе (важен только последний)
+        self.paste_pending = None  # (номер вставки, номер копирования) — прочитать системный буфер
+        self.paste_id = 0
+        self.pulled = 0  # номер вставки, для которой системный буфер уже прочитан
+        self.copies = 0
+        self.writing = False
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    @property
+    def busy(self):
+        return self.writing
+
+    # --- фоновый поток ---
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while self.copy_pending is None and self.paste_pending is None and not self.closed:
+                    self.cond.wait()
+                text, self.copy_pending = self.copy_pending, None
+                request, self.paste_pending = self.paste_pending, None
+                if text is None and self.closed:
+                    return
+            if text is not None:
+                self._push(text)
+            if request is not None:
+                pulled = self._pull()
+                with self.cond:
+                    paste_id, copies = request
+                    # Копирование после запроса новее того, что прочитано из системы
+                    if pulled and copies == self.copies:
+                        self.text = pulled
+                    self.pulled = paste_id
+                    self.cond.notify_all()
+
+    def _push(self, text):
+        pyperclip = system_clipboard() if self.backend else None
+        if pyperclip:
+            try:
+                pyperclip.copy(text)
+                return
+            except Exception:
+                pass
+        if sys.stdout.isatty():
+            self._write_osc52(text)
+
+    def _pull(self):
+        pyperclip = system_clipboard() if self.backend else None
+        if pyperclip:
+            try:
+                return pyperclip.paste()
+            except Exception:
+                pass
+        return None
+
+    def _write_osc52(self, text):
+        sequence = osc52_sequence(text)
+        self.writing = True
+        try:
+            # Последовательность должна дойти до терминала без вкраплений вывода curses
+            with terminal_lock:
+                for start in range(0, len(sequence), OSC52_CHUNK):
+                    sys.stdout.write(sequence[start:start + OSC52_CHUNK])
+                    sys.stdout.flush()
+        except OSError:
+            pass
+        finally:
+            self.writing = False
+
+    # --- главный поток ---
+
+    def copy(self, text):
+        with self.cond:
+            self.text = text
+            self.copies += 1
+            self.copy_pending = text
+            self.cond.notify()
+
+    def paste(self):
+        """
+        Текст для вставки. Системный буфер читает фоновый поток, а вставка
+        ждёт его не дольше CLIPBOARD_PASTE_TIMEOUT; ввод в это время не
+        обрабатывается, так что клавиши после Ctrl+V не обгоняют вставку.
+        Не успел или пуст — вставляется внутренний текст.
+        """
+        if not self.backend:
+            return self.text
+        with self.cond:
+            self.paste_id += 1
+            paste_id = self.paste_id
+            self.paste_pending = (paste_id, self.copies)
+            self.cond.notify()
+            self.cond.wait_for(lambda: self.pulled == paste_id, CLIPBOARD_PASTE_TIMEOUT)
+            return self.text
+
+    def close(self, timeout=2.0):
+        """Даёт дописать последнее копирование (xclip, OSC 52) перед выходом."""
+        with self.cond:
+            self.closed = True
+            self.paste_pending = None
+            self.cond.notify()
+        self.thread.join(timeout)
+
+##############################
+# Слежение за растущим файлом (-f)
+##############################
+
+FOLLOW_POLL_INTERVAL = 0.25  # период stat() без inotify; с inotify — страховочный таймаут
+FOLLOW_COALESCE = 0.01  # после события inotify ждём, чтобы прочитать серию записей разом
+FOLLOW_READ_BYTES = 1024 * 1024  # файл дочитывается кусками такого размера
+FOLLOW_APPLY_CHARS = 1024 * 1024  # сколько нового текста добавлять в буфер за кадр
+FOLLOW_POLL_MS = 100  # как часто главный цикл забирает дочитанное, пока ввода нет
+
+# Файл в этом режиме только читается: остальные клавиши отклоняются сигналом
+FOLLOW_KEYS = {
+    3, 6, 7, 17, 27,  # Ctrl+C, Ctrl+F, Ctrl+G, Ctrl+Q, Esc
+    curses.KEY_RESIZE, curses.KEY_F3,
+    curses.KEY_UP, curses.KEY_DOWN, curses.KEY_LEFT, curses.KEY_RIGHT,
+    curses.KEY_PPAGE, curses.KEY_NPAGE, curses.KEY_HOME, curses.KEY_END, KEY_CTRL_HOME, KEY_CTRL_END,
+} | {getattr(curses, name, -1) for name in ("KEY_SLEFT", "KEY_SRIGHT", "KEY_SUP", "KEY_SDOWN")}
+
+# Маски inotify из <sys/inotify.h>
+IN_MODIFY = 0x002
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+def inotify_watch(directory):
+    """
+    Дескриптор inotify, следящий за каталогом, или None, если inotify
+    недоступен (не Linux, нет ctypes, исчерпан лимит). Следим за каталогом,
+    а не за файлом: так видны и переименование при ротации, и новый файл.
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    except (ImportError, OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+class FileFollower:
+    """
+    Режим слежения (unislate -f): файл открыт только для чтения, фоновый
+    поток ждёт событий inotify (или опрашивает stat()) и читает лишь
+    дописанные байты, так что цена зависит от объёма новых данных, а не от
+    размера файла. Усечение (размер меньше прочитанного) и ротация (по
+    имени теперь другой inode) перечитывают файл с начала.
+    Главный поток забирает прочитанное через poll() и дописывает в буфер.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = None
+        self.identity = None  # (st_dev, st_ino) открытого файла
+        self.offset = 0  # сколько байт файла прочитано
+        self._reset_decoder()
+        self.lock = threading.Lock()
+        self.pending = []  # ("append", текст) и ("reset", сообщение) для главного потока
+        self.closed = False
+        # Без mmap даже для больших файлов: усечение отображённого файла
+        # (logrotate copytruncate) роняет процесс по SIGBUS при первом же чтении
+        parts = []
+        if self._open() is not None:
+            while True:
+                data = self.file.read(FOLLOW_READ_BYTES)
+                if not data:
+                    break
+                self.offset += len(data)
+                parts.append(self._decode(data))
+        self.buf = TextBuffer("".join(parts))
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _open(self):
+        """Открывает файл по имени; возвращает его размер или None, если файла нет."""
+        try:
+            f = open(self.filename, 'rb')
+        except OSError:
+            return None
+        if self.file is not None:
+            self.file.close()
+        self.file = f
+        st = os.fstat(f.fileno())
+        self.identity = (st.st_dev, st.st_ino)
+        return st.st_size
+
+    def _reset_decoder(self):
+        import codecs
+        self.decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        self.held_cr = False  # последний прочитанный \r может оказаться началом \r\n
+        # Буфер, как и load_file, не хранит завершающий перевод строки файла:
+        # он добавляется перед следующим дописанным куском
+        self.trailing_newline = False
+
+    def _decode(self, data):
+        """Декодирует дописанные байты в текст для TextBuffer.append."""
+        text = self.decoder.decode(data)
+        if self.held_cr:
+            text = "\r" + text
+        self.held_cr = text.endswith("\r")
+        if self.held_cr:
+            text = text[:-1]
+        if not text:
+            return ""
+        text = text.replace("\r\n", "\n")
+        if self.trailing_newline:
+            text = "\n" + text
+        self.trailing_newline = text.endswith("\n")
+        return text[:-1] if self.trailing_newline else text
+
+    # --- фоновый поток ---
+
+    def _run(self):
+        import select
+        watch = inotify_watch(os.path.dirname(os.path.abspath(self.filename)))
+        try:
+            while not self.closed:
+                if watch is None:
+                    time.sleep(FOLLOW_POLL_INTERVAL)
+                elif select.select([watch], [], [], FOLLOW_POLL_INTERVAL)[0]:
+                    time.sleep(FOLLOW_COALESCE)
+                    try:
+                        while os.read(watch, 64 * 1024):
+                            pass
+                    except BlockingIOError:
+                        pass
+                self._check()
+        except Exception:
+            pass  # файл больше не читается; на экране остаётся прочитанное
+        finally:
+            if watch is not None:
+                os.close(watch)
+
+    def _check(self):
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return  # ротация: старый файл переименован, новый ещё не создан
+        if (st.st_dev, st.st_ino) != self.identity:
+            # Дочитываем то, что успели дописать в старый файл, и переходим на новый
+            if self.file is not None:
+                self._read_available()
+            had_file = self.file is not None
+            if self._open() is None:
+                return
+            self._restart("File replaced; following the new file" if had_file else "File created")
+        elif st.st_size < self.offset:
+            self._restart("File truncated; reloaded")
+        self._read_available()
+
+    def _restart(self, message):
+        self.offset = 0
+        self._reset_decoder()
+        with self.lock:
+            # Непрочитанные куски старого содержимого уже не нужны
+            self.pending = [("reset", message)]
+
+    def _read_available(self):
+        if self.file is None:
+            return
+        while not self.closed:
+            self.file.seek(self.offset)
+            data = self.file.read(FOLLOW_READ_BYTES)
+            if not data:
+                return
+            self.offset += len(data)
+            text = self._decode(data)
+            if text:
+                with self.lock:
+                    self.pending.append(("append", text))
+
+    # --- главный поток ---
+
+    @property
+    def busy(self):
+        """В очереди осталось больше, чем poll() забирает за кадр."""
+        return bool(self.pending)
+
+    def poll(self):
+        """
+        Переносит прочитанное в буфер, не больше FOLLOW_APPLY_CHARS за вызов.
+        Возвращает (номер первой изменившейся строки, сообщение об усечении
+        или подмене файла либо None) или None, если ничего нового нет.
+        """
+        if self.buf.loading:
+            return None
+        with self.lock:
+            taken = 0
+            count = 0
+            for kind, text in self.pending:
+                if count and taken + len(text) > FOLLOW_APPLY_CHARS:
+                    break
+                taken += len(text)
+                count += 1
+            items = self.pending[:count]
+            del self.pending[:count]
+        if not items:
+            return None
+        first_line = None
+        message = None
+        for kind, text in items:
+            if kind == "reset":
+                self.buf.reset()
+                first_line = 0
+                message = text
+                continue
+            line = self.buf.append(text)
+            if first_line is None:
+                first_line = line
+        return first_line, message
+
+    def close(self):
+        self.closed = True
+
+##############################
+# Профилирование (--profile)
+##############################
+
+PROFILE_PHASES = ("input", "edit", "undo", "highlight", "draw", "refresh")
+PROFILE_WINDOW = 500  # по скольким последним кадрам считаются p50/p99
+PROFILE_NESTED_IN = {"undo": "edit", "highlight": "draw"}
+
+class FrameProfiler:
+    """
+    Время фаз главного цикла по кадрам. Кадр — от окончания ожидания ввода
+    до doupdate(). Время обёрток timed() вложено в объемлющую фазу
+    (PROFILE_NESTED_IN) и из неё вычитается. Опционально пишет трассировку:
+    одна JSON-строка на кадр.
+    """
+
+    def __init__(self, trace_path=None):
+        self.frame_times = collections.deque(maxlen=PROFILE_WINDOW)
+        self.nested = dict.fromkeys(PROFILE_PHASES, 0.0)
+        self.marks = []
+        self.frame_no = 0
+        self.phase = None
+        self.phase_start = 0.0
+        self.frame_start = None
+        self.trace = open(trace_path, "w", encoding="utf-8") if trace_path else None
+
+    def timed(self, phase, func):
+        """Обёртка, относящая время вызовов func к вложенной фазе phase."""
+        nested = self.nested
+        clock = time.perf_counter
+
+        def wrapper(*args, **kwargs):
+            started = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                nested[phase] += clock() - started
+        return wrapper
+
+    def switch(self, phase):
+        """Закрывает текущую фазу кадра и начинает phase."""
+        now = time.perf_counter()
+        if self.frame_start is None:
+            self.frame_start = now
+        if self.phase is not None:
+            self.marks.append((self.phase, now - self.phase_start))
+        self.phase = phase
+        self.phase_start = now
+
+    def add(self, phase, seconds):
+        self.nested[phase] += seconds
+
+    def end_frame(self, **extra):
+        if self.frame_start is None:
+            return
+        self.switch(None)
+        phases = dict.fromkeys(PROFILE_PHASES, 0.0)
+        for phase, seconds in self.marks:
+            phases[phase] += seconds
+        for phase, seconds in self.nested.items():
+            phases[phase] += seconds
+            parent = PROFILE_NESTED_IN.get(phase)
+            if parent is not None:
+                # Поиск рисует кадры внутри "edit", так что вычитаемое может не совпасть
+                phases[parent] = max(0.0, phases[parent] - seconds)
+            self.nested[phase] = 0.0
+        total = sum(phases.values())
+        self.frame_times.append(total)
+        if self.trace is not None:
+            import json
+            record = {"frame": self.frame_no, "ts": round(self.frame_start, 6),
+                      "total_ms": round(total * 1000, 3)}
+            record.update((f"{phase}_ms", round(seconds * 1000, 3)) for phase, seconds in phases.items())
+            record.update(extra)
+            self.trace.write(json.dumps(record) + "\n")
+        self.frame_no += 1
+        self.marks = []
+        self.phase = None
+        self.frame_start = None
+
+    def percentile(self, p):
+        if not self.frame_times:
+            return 0.0
+        times = sorted(self.frame_times)
+        return times[min(len(times) - 1, int(len(times) * p / 100))]
+
+    def overlay(self, undo_bytes):
+        return (f"p50 {self.percentile(50) * 1000:.1f}ms p99 {self.percentile(99) * 1000:.1f}ms "
+                f"undo {undo_bytes / (1024 * 1024):.1f}MB")
+
+    def close(self):
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
+
+##############################
+# Правка документа (Editor)
+##############################
+
+# Переходы по файлу: код клавиши -> (метод Editor, расширять ли выделение)
+NAVIGATION_KEYS = {
+    curses.KEY_PPAGE: ("page_up", False), curses.KEY_NPAGE: ("page_down", False),
+    curses.KEY_HOME: ("move_home", False), curses.KEY_END: ("move_end", False),
+    curses.KEY_SPREVIOUS: ("page_up", True), curses.KEY_SNEXT: ("page_down", True),
+    curses.KEY_SHOME: ("move_home", True), curses.KEY_SEND: ("move_end", True),
+    KEY_CTRL_HOME: ("move_to_start", False), KEY_CTRL_END: ("move_to_end", False),
+    KEY_CTRL_SHIFT_HOME: ("move_to_start", True), KEY_CTRL_SHIFT_END: ("move_to_end", True),
+}
+
+# Alt+Shift+стрелки: сдвиг угла прямоугольного выделения (строки, столбцы)
+COLUMN_KEYS = {
+    KEY_ALT_SHIFT_UP: (-1, 0), KEY_ALT_SHIFT_DOWN: (1, 0),
+    KEY_ALT_SHIFT_LEFT: (0, -1), KEY_ALT_SHIFT_RIGHT: (0, 1),
+}
+
+class Editor:
+    """
+    Состояние правки без терминала: буфер, курсор, выделение, история undo
+    и видимое окно (offset_y/offset_x при размере height x width, включая
+    статусную строку). key() понимает те же коды клавиш, что и редактор в
+    терминале; main() рисует это состояние, а пакетный режим (--batch)
+    выполняет на нём сценарии.
+    """
+
+    def __init__(self, buf, height=24, width=80):
+        self.buf = buf
+        self.history = UndoHistory(buf)
+        self.cursor_y = 0
+        self.cursor_x = 0
+        self.offset_y = 0
+        self.offset_x = 0
+        self.height = height
+        self.width = width
+        self.modified = False
+        self.select_mode = False
+        self.selection_start = None
+        self.selection_end = None
+        self.clipboard = None  # системный буфер обмена (Clipboard) — в терминале
+        self.copied = ""  # последний скопированный или вырезанный текст
+        self.carets = []  # дополнительные курсоры: (строка, столбец, начало выделения, конец выделения)
+        self.column = None  # прямоугольное выделение: (угол, другой угол, версия буфера, основной курсор)
+
+    # --- состояние ---
+
+    def get_state(self):
+        return (self.cursor_y, self.cursor_x, self.offset_y, self.offset_x, self.modified)
+
+    def set_state(self, state):
+        self.cursor_y, self.cursor_x, self.offset_y, self.offset_x, self.modified = state
+
+    def record_undo(self, kind=None, ranges=None):
+        self.history.begin(self.get_state(), kind, ranges)
+
+    def has_selection(self):
+        return (self.selection_start is not None and self.selection_end is not None
+                and self.selection_start != self.selection_end)
+
+    def cancel_selection(self):
+        self.select_mode = False
+        self.selection_start = None
+        self.selection_end = None
+
+    def select(self, start, end):
+        """Выделяет диапазон смещений [start, end), курсор — в его конец."""
+        self.carets = []
+        self.selection_start = self.buf.position(start)
+        self.selection_end = self.buf.position(end)
+        self.select_mode = True
+        self.cursor_y, self.cursor_x = self.selection_end
+        self.scroll_to_cursor()
+
+    def goto(self, line_no, col=0):
+        self.collapse()
+        self.cursor_y = max(0, min(line_no, self.buf.line_count() - 1))
+        self.cursor_x = max(0, min(col, self.buf.line_length(self.cursor_y)))
+        self.scroll_to_cursor()
+
+    def clamp_cursor(self):
+        """Возвращает курсор в пределы текста после правки не через Editor."""
+        self.cursor_y = min(self.cursor_y, self.buf.line_count() - 1)
+        self.cursor_x = min(self.cursor_x, self.buf.line_length(self.cursor_y))
+
+    def scroll_to_cursor(self):
+        if self.cursor_y < self.offset_y or self.cursor_y >= self.offset_y + self.height - 1:
+            self.offset_y = max(0, self.cursor_y - (self.height - 1) // 2)
+        self.offset_x = follow_cursor_x(self.cursor_x, self.offset_x,
+                                        self.width - line_number_width(self.buf.line_count()))
+
+    # --- правка ---
+
+    def insert_text(self, text):
+        # Вставка блока — одна правка буфера и один шаг undo
+        buf = self.buf
+        self.record_undo()
+        if self.has_selection():
+            remove_selected_text(buf, self.selection_start, self.selection_end)
+            self.cursor_y, self.cursor_x = min(self.selection_start, self.selection_end)
+            self.cancel_selection()
+        pos = buf.offset(self.cursor_y, self.cursor_x)
+        buf.insert(pos, text)
+        self.cursor_y, self.cursor_x = buf.position(pos + len(text))
+        if self.cursor_y >= self.offset_y + self.height - 1:
+            self.offset_y = self.cursor_y - self.height + 2
+        self.modified = True
+
+    def type_char(self, ch):
+        if self.carets:
+            return self._edit_carets(lambda i, start, end: (start, end, ch), "insert")
+        self.record_undo("insert")
+        self.buf.insert(self.buf.offset(self.cursor_y, self.cursor_x), ch)
+        self.cursor_x += len(ch)
+        self.modified = True
+        self.cancel_selection()
+
+    def tab(self):
+        self.type_char(TAB_SPACES)
+
+    def newline(self):
+        # Enter переносит отступ текущей строки
+        if self.carets:
+            return self._edit_carets(lambda i, start, end: (start, end, "\n" + self._indent_at(start)))
+        self.record_undo()
+        line = self.buf.line_at(self.cursor_y)
+        indent_match = re.match(r'(\s*)', line)
+        indent = indent_match.group(1) if indent_match else ""
+        self.buf.insert(self.buf.offset(self.cursor_y, self.cursor_x), "\n" + indent)
+        self.cursor_y += 1
+        self.cursor_x = len(indent)
+        if self.cursor_y >= self.offset_y + self.height - 1:
+            self.offset_y += 1
+        self.modified = True
+        self.cancel_selection()
+
+    def backspace(self):
+        buf = self.buf
+        if self.carets:
+            return self._edit_carets(lambda i, start, end: (start - (start == end and start > 0), end, ""), "delete")
+        if self.cursor_x > 0:
+            self.record_undo("delete")
+            pos = buf.offset(self.cursor_y, self.cursor_x)
+            buf.delete(pos - 1, pos)
+            self.cursor_x -= 1
+        elif self.cursor_y > 0:
+            self.record_undo("delete")
+            self.cursor_x = buf.line_length(self.cursor_y - 1)
+            pos = buf.line_start(self.cursor_y)
+            buf.delete(pos - 1, pos)
+            self.cursor_y -= 1
+        else:
+            return False
+        self.modified = True
+        self.cancel_selection()
+        return True
+
+    def copy_text(self, text):
+        self.copied = text
+        if self.clipboard is not None:
+            self.clipboard.copy(text)
+
+    def copy(self):
+        """Ctrl+C: выделение или, без него, текущая строка."""
+        if self.carets:
+            return self._copy_all()
+        if self.has_selection():
+            self.copy_text(get_selected_text(self.buf, self.selection_start, self.selection_end))
+            self.cancel_selection()
+        else:
+            self.copy_text(self.buf.line_at(self.cursor_y))
+
+    def cut(self):
+        """Ctrl+X: выделение или, без него, текущая строка целиком."""
+        buf = self.buf
+        if self.carets:
+            return self._cut_all()
+        self.record_undo()
+        if self.has_selection():
+            self.copy_text(get_selected_text(buf, self.selection_start, self.selection_end))
+            remove_selected_text(buf, self.selection_start, self.selection_end)
+            (self.cursor_y, self.cursor_x) = min(self.selection_start, self.selection_end)
+            self.cancel_selection()
+        else:
+            self.copy_text(buf.line_at(self.cursor_y))
+            if buf.line_count() > 1:
+                if self.cursor_y < buf.line_count() - 1:
+                    buf.delete(buf.line_start(self.cursor_y), buf.line_start(self.cursor_y + 1))
+                else:
+                    buf.delete(buf.line_start(self.cursor_y) - 1, len(buf))
+                    self.cursor_y -= 1
+                self.cursor_x = min(self.cursor_x, buf.line_length(self.cursor_y))
             else:
-                curses.beep()
+                buf.delete(0, len(buf))
+                self.cursor_x = 0
+        self.modified = True
+
+    def paste(self, text=None):
+        """Вставляет text или, без него, содержимое буфера обмена поверх выделения."""
+        if text is None:
+            text = self.clipboard.paste() if self.clipboard is not None else self.copied
+        if not text:
+            return False
+        if self.carets:
+            return self._paste_all(text)
+        self.insert_text(text)
+        self.cancel_selection()
+        return True
+
+    def replace_all(self, regex, repl):
+        """Замена всех совпадений одним шагом undo; возвращает их число."""
+        self.record_undo()
+        count = replace_all(self.buf, regex, repl)
+        if count:
+            self.modified = True
+            self.collapse()
+            self.clamp_cursor()
+            self.scroll_to_cursor()
+        return count
+
+    def apply_diff(self, edits, opcodes):
+        # Меняются только отличающиеся участки (line_diff), и всё — один шаг undo.
+        # После его отмены текст расходится с диском, отсюда modified=True в состоянии шага
+        self.history.begin((self.cursor_y, self.cursor_x, self.offset_y, self.offset_x, True))
+        for start, end, text in reversed(edits):
+            self.buf.delete(start, end)
+            self.buf.insert(start, text)
+        self.cursor_y = map_line(opcodes, self.cursor_y)
+        self.cursor_x = min(self.cursor_x, self.buf.line_length(self.cursor_y))
+        self.modified = False
+        self.collapse()
+        self.scroll_to_cursor()
+
+    def undo(self):
+        self.collapse()
+        step = self.history.undo(self.buf, self.get_state())
+        if step is None:
+            return False
+        if step.before is not None:
+            self.set_state(step.before)
+        self.cancel_selection()
+        return True
+
+    def redo(self):
+        self.collapse()
+        step = self.history.redo(self.buf)
+        if step is None:
+            return False
+        if step.after is not None:
+            self.set_state(step.after)
+        self.cancel_selection()
+        return True
+
+    # --- перемещение ---
+
+    def move_up(self, select=False):
+        return self._move(self._up, select)
+
+    def move_down(self, select=False):
+        return self._move(self._down, select)
+
+    def move_left(self, select=False):
+        return self._move(self._left, select)
+
+    def move_right(self, select=False):
+        return self._move(self._right, select)
+
+    def move_home(self, select=False):
+        return self._move(lambda select: self._jump(self.cursor_y, 0, select), select)
+
+    def move_end(self, select=False):
+        return self._move(lambda select: self._jump(self.cursor_y, self.buf.line_length(self.cursor_y), select),
+                          select)
+
+    def page_up(self, select=False):
+        return self._move(lambda select: self._page(-1, select), select)
+
+    def page_down(self, select=False):
+        return self._move(lambda select: self._page(1, select), select)
+
+    def move_to_start(self, select=False):
+        return self._move(lambda select: self._jump(0, 0, select), select)
+
+    def move_to_end(self, select=False):
+        last = self.buf.line_count() - 1
+        return self._move(lambda select: self._jump(last, self.buf.line_length(last), select), select)
+
+    def _move(self, step, select):
+        if not self.carets:
+            return step(select)
+        # Каждый курсор по очереди становится основным и делает тот же шаг;
+        # окно прокручивает только основной
+        primary = self._caret()
+        offset = (self.offset_y, self.offset_x)
+        moved = []
+        for caret in self.carets:
+            self._load_caret(caret)
+            step(select)
+            moved.append(self._caret())
+        self.offset_y, self.offset_x = offset
+        self._load_caret(primary)
+        result = step(select)
+        self.set_carets(moved, self._caret())
+        return result
+
+    def _up(self, select):
+        self._begin_move(select)
+        if self.cursor_y == 0:
+            return self._end_move(select, False)
+        self.cursor_y -= 1
+        if self.cursor_y < self.offset_y and not select:
+            self.offset_y = self.cursor_y
+        self.cursor_x = min(self.cursor_x, self.buf.line_length(self.cursor_y))
+        return self._end_move(select, True)
 
-        # Обработка Shift+стрелок для выделения
-        elif key in (getattr(curses, "KEY_SLEFT", -1),):
-            if not select_mode:
-                select_mode = True
-                selection_start = (cursor_y, cursor_x)
-            if cursor_x > 0:
-                cursor_x -= 1
-            elif cursor_y > 0:
-                cursor_y -= 1
-                cursor_x = len(lines[cursor_y])
+    def _down(self, select):
+        self._begin_move(select)
+        if self.cursor_y >= self.buf.line_count() - 1:
+            return self._end_move(select, False)
+        self.cursor_y += 1
+        if self.cursor_y >= self.offset_y + self.height - 1 and not select:
+            self.offset_y += 1
+        self.cursor_x = min(self.cursor_x, self.buf.line_length(self.cursor_y))
+        return self._end_move(select, True)
+
+    def _left(self, select):
+        self._begin_move(select)
+        if self.cursor_x > 0:
+            self.cursor_x -= 1
+        elif self.cursor_y > 0:
+            self.cursor_y -= 1
+            self.cursor_x = self.buf.line_length(self.cursor_y)
+            if self.cursor_y < self.offset_y and not select:
+                self.offset_y = self.cursor_y
+        else:
+            return self._end_move(select, False)
+        return self._end_move(select, True)
+
+    def _right(self, select):
+        self._begin_move(select)
+        if self.cursor_x < self.buf.line_length(self.cursor_y):
+            self.cursor_x += 1
+        elif self.cursor_y < self.buf.line_count() - 1:
+            self.cursor_y += 1
+            self.cursor_x = 0
+            if self.cursor_y >= self.offset_y + self.height - 1 and not select:
+                self.offset_y += 1
+        else:
+            return self._end_move(select, False)
+        return self._end_move(select, True)
+
+    def _page(self, direction, select):
+        # Окно и курсор сдвигаются на высоту текста сразу, без прохода по строкам:
+        # курсор остаётся в той же строке экрана, пока окно не упрётся в край файла
+        self._begin_move(select)
+        rows = max(self.height - 1, 1)
+        last = self.buf.line_count() - 1
+        y = max(0, min(self.cursor_y + direction * rows, last))
+        if y == self.cursor_y:
+            return self._end_move(select, False)
+        self.offset_y = max(0, min(self.offset_y + direction * rows, last - rows + 1))
+        self.cursor_y = y
+        self.cursor_x = min(self.cursor_x, self.buf.line_length(y))
+        self.scroll_to_cursor()
+        return self._end_move(select, True)
+
+    def _jump(self, y, x, select):
+        # Home/End и Ctrl+Home/End; конец файла показывается внизу окна, а не посередине
+        self._begin_move(select)
+        if (y, x) == (self.cursor_y, self.cursor_x):
+            return self._end_move(select, False)
+        self.cursor_y, self.cursor_x = y, x
+        if self.cursor_y >= self.offset_y + self.height - 1:
+            self.offset_y = max(0, self.cursor_y - self.height + 2)
+        self.scroll_to_cursor()
+        return self._end_move(select, True)
+
+    def _begin_move(self, select):
+        # Стрелки сбрасывают выделение, Shift+стрелки начинают или продолжают его
+        if not select:
+            self.cancel_selection()
+        elif not self.select_mode:
+            self.select_mode = True
+            self.selection_start = (self.cursor_y, self.cursor_x)
+
+    def _end_move(self, select, moved):
+        if select:
+            self.selection_end = (self.cursor_y, self.cursor_x)
+        return moved
+
+    # --- несколько курсоров ---
+
+    def _caret(self):
+        """Основной курсор как (строка, столбец, начало выделения, конец выделения)."""
+        if self.select_mode and self.selection_start is not None:
+            return (self.cursor_y, self.cursor_x, self.selection_start,
+                    self.selection_end if self.selection_end is not None else self.selection_start)
+        return (self.cursor_y, self.cursor_x, None, None)
+
+    def _load_caret(self, caret):
+        self.cursor_y, self.cursor_x, self.selection_start, self.selection_end = caret
+        self.select_mode = self.selection_start is not None
+
+    def set_carets(self, carets, primary):
+        """Ставит основной курсор primary и дополнительные carets; совпадающие по позиции сливаются."""
+        seen = {primary[:2]}
+        self.carets = []
+        for caret in sorted(carets, key=lambda c: c[:2]):
+            if caret[:2] not in seen:
+                seen.add(caret[:2])
+                self.carets.append(caret)
+        self._load_caret(primary)
+
+    def collapse(self):
+        """Esc: остаётся один основной курсор без выделения."""
+        self.carets = []
+        self.column = None
+        self.cancel_selection()
+        return True
+
+    def add_caret(self, dy):
+        """Alt+Up/Down: курсор строкой выше или ниже крайнего; новый становится основным."""
+        carets = self.carets + [self._caret()]
+        edge = min(carets, key=lambda c: c[:2]) if dy < 0 else max(carets, key=lambda c: c[:2])
+        y = edge[0] + dy
+        if not 0 <= y < self.buf.line_count():
+            return False
+        x = self.cursor_x if edge[:2] == (self.cursor_y, self.cursor_x) else edge[1]
+        self.set_carets(carets, (y, min(x, self.buf.line_length(y)), None, None))
+        self.scroll_to_cursor()
+        return True
+
+    def select_column(self, dy, dx):
+        """
+        Alt+Shift+стрелки: прямоугольное выделение — по курсору с выделением
+        на каждой строке. Угол, с которого начали, сохраняется, пока следующим
+        действием снова идёт Alt+Shift+стрелка.
+        """
+        if self.column is not None and self.column[2:] == (self.buf.version, self._caret()):
+            anchor, (y, x) = self.column[:2]
+        else:
+            anchor = (y, x) = (self.cursor_y, self.cursor_x)
+        y = max(0, min(y + dy, self.buf.line_count() - 1))
+        x = max(0, x + dx)
+        ay, ax = anchor
+        top = min(ay, y)
+        carets = []
+        for line_no in range(top, max(ay, y) + 1):
+            length = self.buf.line_length(line_no)
+            start, end = min(ax, length), min(x, length)
+            if start != end:
+                carets.append((line_no, end, (line_no, start), (line_no, end)))
             else:
-                curses.beep()
-            selection_end = (cursor_y, cursor_x)
-        elif key in (getattr(curses, "KEY_SRIGHT", -1),):
-            if not select_mode:
-                select_mode = True
-                selection_start = (cursor_y, cursor_x)
-            if cursor_x < len(lines[cursor_y]):
-                cursor_x += 1
-            elif cursor_y < len(lines) - 1:
-                cursor_y += 1
-                cursor_x = 0
+                carets.append((line_no, end, None, None))
+        primary = carets.pop(y - top)
+        self.set_carets(carets, primary)
+        self.column = (anchor, (y, x), self.buf.version, self._caret())
+        self.scroll_to_cursor()
+        return True
+
+    def add_next_occurrence(self):
+        """
+        Ctrl+D: без выделения выделяет слово под курсором, с выделением —
+        добавляет курсор на следующем вхождении того же текста (по кругу).
+        """
+        buf = self.buf
+        if not self.has_selection():
+            line_start = buf.line_start(self.cursor_y)
+            for match in re.finditer(r"\w+", buf.line_at(self.cursor_y)):
+                if match.start() <= self.cursor_x <= match.end():
+                    self._load_caret(self._caret_at(line_start + match.start(), line_start + match.end()))
+                    return True
+            return False
+        start, end = get_selection_offsets(buf, self.selection_start, self.selection_end)
+        needle = buf.get_range(start, end)
+        taken = {start}
+        for caret in self.carets:
+            if caret[2] is not None:
+                taken.add(get_selection_offsets(buf, caret[2], caret[3])[0])
+        found = find_text(buf, needle, end)
+        if found is None:
+            found = find_text(buf, needle, 0, end)
+        if found is None or found in taken:
+            return False
+        self.set_carets(self.carets + [self._caret()], self._caret_at(found, found + len(needle)))
+        self.scroll_to_cursor()
+        return True
+
+    def _caret_at(self, start, end):
+        head = self.buf.position(end)
+        return head + (self.buf.position(start), head)
+
+    def _indent_at(self, offset):
+        line_no = self.buf.position(offset)[0]
+        return re.match(r"\s*", self.buf.line_at(line_no)).group(0)
+
+    def _spans(self):
+        """Диапазоны смещений всех курсоров по возрастанию: (начало, конец, основной ли)."""
+        spans = []
+        for i, (y, x, sel_start, sel_end) in enumerate(self.carets + [self._caret()]):
+            if sel_start is not None and sel_start != sel_end:
+                start, end = get_selection_offsets(self.buf, sel_start, sel_end)
             else:
-                curses.beep()
-            selection_end = (cursor_y, cursor_x)
-        elif key in (getattr(curses, "KEY_SUP", -1),):
-            if not select_mode:
-                select_mode = True
-                selection_start = (cursor_y, cursor_x)
-            if cursor_y > 0:
-                cursor_y -= 1
-                cursor_x = min(cursor_x, len(lines[cursor_y]))
+                start = end = self.buf.offset(y, x)
+            spans.append((start, end, i == len(self.carets)))
+        spans.sort()
+        return spans
+
+    def _edit_carets(self, make, kind=None):
+        """
+        Одна правка на каждый курсор: make(i, начало, конец) получает диапазон
+        i-го по порядку курсора (его выделение или пустой) и возвращает
+        (начало, конец, текст). Всё применяется одним replace_ranges — один
+        шаг undo и одна перерисовка; правки, задевшие соседние, объединяются
+        с ними в одну, а их курсоры — в один. kind — как у record_undo: набор и удаление подряд
+        отменяются одним шагом.
+        """
+        buf = self.buf
+        edits = []
+        primary_index = None
+        for i, (start, end, is_primary) in enumerate(self._spans()):
+            edit = make(i, start, end)
+            while edits and edit[0] < edits[-1][1]:
+                last_start, last_end, last_text = edits.pop()
+                edit = (min(last_start, edit[0]), max(last_end, edit[1]), last_text + edit[2])
+                if primary_index == len(edits):
+                    is_primary = True
+            if is_primary:
+                primary_index = len(edits)
+            edits.append(edit)
+        self.record_undo(kind, edits)
+        if not buf.replace_ranges(edits):
+            return False
+        carets = []
+        shift = 0
+        for start, end, text in edits:
+            carets.append(buf.position(start + shift + len(text)) + (None, None))
+            shift += len(text) - (end - start)
+        self.column = None
+        self.set_carets(carets, carets.pop(primary_index))
+        self.modified = True
+        self.scroll_to_cursor()
+        return True
+
+    def _type_all(self, text):
+        return self._edit_carets(lambda i, start, end: (start, end, text))
+
+    def _paste_all(self, text):
+        # Столько же строк, сколько курсоров (например, скопированных ими же), — по строке на курсор
+        lines = text.split("\n")
+        if len(lines) == len(self.carets) + 1:
+            return self._edit_carets(lambda i, start, end: (start, end, lines[i]))
+        return self._type_all(text)
+
+    def _selected_texts(self):
+        return [self.buf.get_range(start, end) for start, end, _ in self._spans() if end > start]
+
+    def _copy_all(self):
+        texts = self._selected_texts()
+        if not texts:
+            lines = sorted({caret[0] for caret in self.carets + [self._caret()]})
+            texts = [self.buf.line_at(line_no) for line_no in lines]
+        self.copy_text("\n".join(texts))
+        self.set_carets([c[:2] + (None, None) for c in self.carets], self._caret()[:2] + (None, None))
+        return True
+
+    def _cut_all(self):
+        texts = self._selected_texts()
+        if texts:
+            self.copy_text("\n".join(texts))
+            return self._edit_carets(lambda i, start, end: (start, end, ""))
+        # Без выделений — строки курсоров целиком
+        buf = self.buf
+        lines = sorted({caret[0] for caret in self.carets + [self._caret()]})
+        self.copy_text("\n".join(buf.line_at(line_no) for line_no in lines))
+
+        def whole_line(i, start, end):
+            line_no = buf.position(start)[0]
+            if line_no < buf.line_count() - 1:
+                return (buf.line_start(line_no), buf.line_start(line_no + 1), "")
+            # Последняя строка уносит перевод строки перед собой, а значит, и перед
+            # всеми вырезаемыми строками подряд над ней (их правки сольются с этой)
+            first = line_no
+            while first - 1 in lines:
+                first -= 1
+            return (max(buf.line_start(first) - 1, 0), len(buf), "")
+        return self._edit_carets(whole_line)
+
+    def caret_ranges(self, first_line, last_line):
+        """
+        Дополнительные курсоры (ячейка под курсором) и их выделения в строках
+        first_line..last_line для draw_editor: {строка: [(начало, конец), ...]}.
+        """
+        ranges = {}
+        for y, x, sel_start, sel_end in self.carets:
+            if sel_start is not None:
+                top, bottom = sorted((sel_start[0], sel_end[0]))
+                for line_no in range(max(top, first_line), min(bottom, last_line) + 1):
+                    ranges.setdefault(line_no, []).append(
+                        get_line_selection_range(line_no, sel_start, sel_end, self.buf.line_length(line_no)))
+            if first_line <= y <= last_line:
+                ranges.setdefault(y, []).append((x, x + 1))
+        return ranges or None
+
+    # --- клавиши ---
+
+    def key(self, code):
+        """
+        Нажатие, как в терминале: стрелки, PageUp/PageDown, Home/End и
+        Ctrl+Home/End (с Shift — с выделением), Ctrl+C/X/V/Z/Y,
+        Backspace, Enter, Tab и печатаемые символы; Alt+Up/Down, Alt+Shift+стрелки,
+        Ctrl+D и Esc управляют дополнительными курсорами. Возвращает False, если
+        клавиша упёрлась в край или ей нечего делать (терминал подаёт сигнал).
+        """
+        if code in (KEY_ALT_UP, KEY_ALT_DOWN):
+            return self.add_caret(-1 if code == KEY_ALT_UP else 1)
+        if code in COLUMN_KEYS:
+            return self.select_column(*COLUMN_KEYS[code])
+        if code == 4:  # Ctrl+D
+            return self.add_next_occurrence()
+        if code == 27:  # Esc
+            return self.collapse()
+        if code == curses.KEY_UP:
+            return self.move_up()
+        if code == curses.KEY_DOWN:
+            return self.move_down()
+        if code == curses.KEY_LEFT:
+            return self.move_left()
+        if code == curses.KEY_RIGHT:
+            return self.move_right()
+        if code == getattr(curses, "KEY_SLEFT", None):
+            return self.move_left(select=True)
+        if code == getattr(curses, "KEY_SRIGHT", None):
+            return self.move_right(select=True)
+        if code == getattr(curses, "KEY_SUP", None):
+            return self.move_up(select=True)
+        if code == getattr(curses, "KEY_SDOWN", None):
+            return self.move_down(select=True)
+        if code in NAVIGATION_KEYS:
+            method, select = NAVIGATION_KEYS[code]
+            return getattr(self, method)(select)
+        if code == 3:  # Ctrl+C
+            self.copy()
+        elif code == 24:  # Ctrl+X
+            self.cut()
+        elif code == 22:  # Ctrl+V
+            self.paste()
+        elif code == 26:  # Ctrl+Z
+            return self.undo()
+        elif code == 25:  # Ctrl+Y
+            return self.redo()
+        elif code in (curses.KEY_BACKSPACE, 127, 8):
+            self.backspace()
+        elif code in (curses.KEY_ENTER, 10, 13):
+            self.newline()
+        elif code == 9:
+            self.tab()
+        elif 0 <= code < 0x110000 and chr(code).isprintable():
+            self.type_char(chr(code))
+        return True
+
+##############################
+# Пакетный режим (--batch)
+##############################
+
+# Имена клавиш для команды keys сценария
+BATCH_KEYS = {
+    "Up": ("move_up", False), "Down": ("move_down", False),
+    "Left": ("move_left", False), "Right": ("move_right", False),
+    "S-Up": ("move_up", True), "S-Down": ("move_down", True),
+    "S-Left": ("move_left", True), "S-Right": ("move_right", True),
+    "Enter": ("newline",), "Tab": ("tab",), "Backspace": ("backspace",),
+    "C-c": ("copy",), "C-x": ("cut",), "C-v": ("paste",),
+    "C-z": ("undo",), "C-y": ("redo",),
+    "A-Up": ("add_caret", -1), "A-Down": ("add_caret", 1),
+    "A-S-Up": ("select_column", -1, 0), "A-S-Down": ("select_column", 1, 0),
+    "A-S-Left": ("select_column", 0, -1), "A-S-Right": ("select_column", 0, 1),
+    "C-d": ("add_next_occurrence",), "Esc": ("collapse",),
+    "PgUp": ("page_up", False), "PgDn": ("page_down", False),
+    "Home": ("move_home", False), "End": ("move_end", False),
+    "C-Home": ("move_to_start", False), "C-End": ("move_to_end", False),
+    "S-PgUp": ("page_up", True), "S-PgDn": ("page_down", True),
+    "S-Home": ("move_home", True), "S-End": ("move_end", True),
+}
+BATCH_ESCAPES = {"n": "\n", "t": "\t", "\\": "\\"}
+
+
+def _unescape(text):
+    # В type и insert текст берётся до конца строки как есть, кроме \n, \t и \\
+    return re.sub(r"\\(.)", lambda m: BATCH_ESCAPES.get(m.group(1), m.group(0)), text)
+
+
+def parse_batch_script(text):
+    """
+    Разбирает сценарий --batch в список команд (имя, аргументы):
+
+        type TEXT            набор с клавиатуры: \\n — Enter с отступом, \\t — Tab
+        insert TEXT          вставка блока, как Ctrl+V
+        keys NAME...         Up, S-Down, PgDn, C-End, Enter, Backspace, C-x, C-v, C-z, A-Down, C-d...
+        goto LINE [COL]      курсор на строку и столбец (с единицы)
+        find PATTERN         выделить следующее совпадение от курсора
+        replace PATTERN REPL заменить все совпадения
+
+    Аргументы find, replace и goto разбираются как в shell (shlex).
+    Пустые строки и строки с # пропускаются. Ошибка — ValueError с номером строки.
+    """
+    import shlex
+
+    commands = []
+    for number, line in enumerate(text.splitlines(), 1):
+        stripped = line.strip()
+        if not stripped or stripped.startswith("#"):
+            continue
+        name, _, rest = stripped.partition(" ")
+        try:
+            if name in ("type", "insert"):
+                if not rest:
+                    raise ValueError(f"{name} needs text")
+                commands.append((name, _unescape(rest)))
+            elif name == "keys":
+                names = rest.split()
+                unknown = [key for key in names if key not in BATCH_KEYS]
+                if unknown or not names:
+                    raise ValueError(f"unknown key {unknown[0]!r}" if unknown else "keys needs key names")
+                commands.append((name, names))
+            elif name == "goto":
+                args = [int(arg) for arg in shlex.split(rest)]
+                if not 1 <= len(args) <= 2 or min(args) < 1:
+                    raise ValueError("goto needs LINE [COL], counted from 1")
+                commands.append((name, args))
+            elif name in ("find", "replace"):
+                args = shlex.split(rest)
+                if len(args) != (1 if name == "find" else 2):
+                    raise ValueError("find needs PATTERN" if name == "find" else "replace needs PATTERN REPL")
+                compile_search(args[0])
+                commands.append((name, args))
             else:
-                curses.beep()
-            selection_end = (cursor_y, cursor_x)
-        elif key in (getattr(curses, "KEY_SDOWN", -1),):
-            if not select_mode:
-                select_mode = True
-                selection_start = (cursor_y, cursor_x)
-            if cursor_y < len(lines) - 1:
-                cursor_y += 1
-                cursor_x = min(cursor_x, len(lines[cursor_y]))
+                raise ValueError(f"unknown command {name!r}")
+        except (ValueError, re.error) as e:
+            raise ValueError(f"line {number}: {e}") from None
+    return commands
+
+
+def run_batch_commands(ed, commands):
+    """Выполняет разобранный сценарий над Editor."""
+    for name, arg in commands:
+        if name == "type":
+            for ch in arg:
+                if ch == "\n":
+                    ed.newline()
+                elif ch == "\t":
+                    ed.tab()
+                else:
+                    ed.type_char(ch)
+        elif name == "insert":
+            ed.paste(arg)
+        elif name == "keys":
+            for key in arg:
+                method, *args = BATCH_KEYS[key]
+                getattr(ed, method)(*args)
+        elif name == "goto":
+            ed.goto(arg[0] - 1, arg[1] - 1 if len(arg) > 1 else 0)
+        elif name == "find":
+            # Поиск идёт дальше курсора, а не по первой позиции совпадения — как F3
+            buf = ed.buf
+            match = compile_search(arg[0]).search(buf.text(), buf.offset(ed.cursor_y, ed.cursor_x))
+            if match is not None:
+                ed.select(match.start(), match.end())
+        elif name == "replace":
+            ed.replace_all(compile_search(arg[0]), arg[1])
+
+
+def batch_edit_file(job):
+    """
+    Одна задача пула: открыть файл, выполнить сценарий, сохранить, если текст
+    изменился. Возвращает (имя, байт, секунд, изменён ли, ошибка или None).
+    """
+    filename, commands = job
+    start = time.perf_counter()
+    try:
+        size = os.path.getsize(filename)
+        buf = load_file(filename)
+        buf.finish_loading()
+        ed = Editor(buf)
+        run_batch_commands(ed, commands)
+        if ed.modified:
+            save_file(filename, buf)
+        return filename, size, time.perf_counter() - start, ed.modified, None
+    except Exception as e:
+        return filename, 0, time.perf_counter() - start, False, str(e)
+
+
+def pool_workers(jobs, task_count):
+    """Сколько процессов нужно пулу: не больше задач и по умолчанию по одному на CPU."""
+    return max(1, min(jobs or os.cpu_count() or 1, task_count))
+
+
+def pool_map(func, tasks, workers):
+    """
+    Результаты func по задачам в их порядке. При нескольких workers задачи
+    раздаются пулу процессов (func должна быть функцией модуля), иначе всё
+    выполняется в этом процессе.
+    """
+    if workers == 1:
+        yield from map(func, tasks)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(workers) as pool:
+        # Мелкие задачи раздаются пачками, чтобы не платить за пересылку каждой
+        yield from pool.map(func, tasks, chunksize=max(1, len(tasks) // (workers * 4)))
+
+
+def print_throughput(out, done, total_bytes, elapsed, workers, failed):
+    elapsed = max(elapsed, 1e-9)
+    print(f"{done} files, {total_bytes / 1e6:.2f} MB in {elapsed:.2f} s "
+          f"({done / elapsed:.1f} files/s, {total_bytes / 1e6 / elapsed:.2f} MB/s, "
+          f"{workers} process{'es' if workers != 1 else ''})"
+          + (f"; {failed} failed" if failed else ""), file=out)
+
+
+def run_batch(script, filenames, jobs=None, out=sys.stdout):
+    """
+    Выполняет сценарий над каждым файлом без терминала и печатает время
+    по файлам и общую пропускную способность. Файлы раздаются пулу
+    процессов; при одном файле или jobs=1 всё идёт в этом процессе.
+    Возвращает код выхода: 1, если хоть один файл не обработан.
+    """
+    with open(script, encoding="utf-8") as f:
+        commands = parse_batch_script(f.read())
+    tasks = [(filename, commands) for filename in filenames]
+    workers = pool_workers(jobs, len(tasks))
+    start = time.perf_counter()
+    failed = 0
+    total_bytes = 0
+    for filename, size, elapsed, changed, error in pool_map(batch_edit_file, tasks, workers):
+        if error is not None:
+            failed += 1
+            print(f"{filename}: error: {error}", file=out)
+            continue
+        total_bytes += size
+        print(f"{filename}: {elapsed * 1000:.1f} ms, {size} bytes, {'changed' if changed else 'unchanged'}",
+              file=out)
+    print_throughput(out, len(tasks) - failed, total_bytes, time.perf_counter() - start, workers, failed)
+    return 1 if failed else 0
+
+##############################
+# Экспорт подсветки (--export)
+##############################
+
+# Типы токенов лексеров; в экспорте «цвет» сегмента — имя его типа
+EXPORT_TOKENS = {name: name for name in
+                 ("default", "keyword", "string", "comment", "number", "md_header", "md_link")}
+# Те же цвета, что у цветовых пар в main(): SGR для терминала и CSS для HTML
+EXPORT_STYLES = {
+    "keyword": ("1;36", "color: #00cdcd; font-weight: bold"),
+    "string": ("33", "color: #cdcd00"),
+    "comment": ("32", "color: #00cd00"),
+    "number": ("35", "color: #cd00cd"),
+    "md_header": ("1;34", "color: #5c5cff; font-weight: bold"),
+    "md_link": ("36", "color: #00cdcd"),
+}
+EXPORT_EXTENSIONS = {"html": ".html", "ansi": ".ansi"}
+HTML_HEAD = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+pre.unislate {{ background: #000; color: #e5e5e5; padding: 1em; }}
+{styles}
+</style>
+</head>
+<body>
+<pre class="unislate">"""
+HTML_TAIL = "</pre>\n</body>\n</html>\n"
+
+
+def export_stream(lines, out, filename, fmt):
+    """
+    Пишет строки файла в out с подсветкой в формате fmt ("html" или "ansi").
+    Лексер выбирается по расширению, как в редакторе, и состояние переходит
+    со строки на строку; в памяти держится только текущая строка.
+    """
+    lexer = get_lexer(filename)
+    if fmt == "html":
+        from html import escape
+
+        styles = "\n".join(f"pre.unislate .{name} {{ {css}; }}" for name, (_, css) in EXPORT_STYLES.items())
+        out.write(HTML_HEAD.format(title=escape(os.path.basename(filename)), styles=styles))
+    state = None
+    for line in lines:
+        line = line.rstrip("\r\n")
+        segments, state = lexer.lex(line, state, EXPORT_TOKENS)
+        parts = []
+        for text, token in segments:
+            style = EXPORT_STYLES.get(token)
+            if fmt == "html":
+                text = escape(text, quote=False)
+                parts.append(f'<span class="{token}">{text}</span>' if style and text else text)
             else:
-                curses.beep()
-            selection_end = (cursor_y, cursor_x)
+                parts.append(f"\x1b[{style[0]}m{text}\x1b[0m" if style and text else text)
+        parts.append("\n")
+        out.write("".join(parts))
+    if fmt == "html":
+        out.write(HTML_TAIL)
 
-        # Копирование: Ctrl+C
-        elif key == 3:
-            if selection_start is not None and selection_end is not None and selection_start != selection_end:
-                clipboard = get_selected_text(lines, selection_start, selection_end)
-                cancel_selection()
+
+def export_file(job):
+    """
+    Одна задача пула: подсвеченная копия source в target.
+    Возвращает (source, байт, ошибка или None).
+    """
+    source, target, fmt = job
+    try:
+        size = os.path.getsize(source)
+        directory = os.path.dirname(target)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(source, encoding="utf-8", errors="replace") as f, \
+                open(target, "w", encoding="utf-8") as out:
+            export_stream(f, out, source, fmt)
+        return source, size, None
+    except Exception as e:
+        return source, 0, str(e)
+
+
+def export_sources(paths):
+    """
+    (файл, путь относительно выходного каталога) для путей из командной строки.
+    Каталоги обходятся рекурсивно без скрытых; из них берутся только файлы
+    с расширениями из HIGHLIGHT_FUNCTIONS, явно названные файлы — любые.
+    Выходные пути берутся от общего корня всех аргументов, чтобы a/x.py и
+    b/x.py не писались в один файл.
+    """
+    roots = [os.path.abspath(path if os.path.isdir(path) else os.path.dirname(path) or ".") for path in paths]
+    try:
+        common = os.path.commonpath(roots) if roots else ""
+    except ValueError:
+        common = None  # разные диски: общего корня нет, путь берётся целиком без диска
+    for path in paths:
+        if os.path.isdir(path):
+            found = []
+            for root, dirs, names in os.walk(path):
+                dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+                found.extend(os.path.join(root, name) for name in sorted(names)
+                             if os.path.splitext(name)[1].lower() in HIGHLIGHT_FUNCTIONS)
+        else:
+            found = [path]
+        for source in found:
+            if common is None:
+                yield source, os.path.splitdrive(os.path.abspath(source))[1].lstrip(os.sep)
             else:
-                clipboard = lines[cursor_y]
-            if pyperclip:
-                try:
-                    pyperclip.copy(clipboard)
-                except Exception:
-                    pass
+                yield source, os.path.relpath(os.path.abspath(source), common)
+
+
+def run_export(fmt, paths, output=None, jobs=None, out=sys.stdout, report=sys.stderr):
+    """
+    Экспорт подсветки. С output каждый файл пишется в свой файл внутри
+    каталога output (пулом процессов); без него всё идёт подряд в out в этом
+    процессе, а итог — в report. Возвращает код выхода.
+    """
+    sources = list(export_sources(paths))
+    start = time.perf_counter()
+    failed = 0
+    total_bytes = 0
+    if output is None:
+        if fmt == "html" and len(sources) > 1:
+            raise ValueError("several files need --output DIR for HTML")
+        workers = 1
+        for index, (source, _) in enumerate(sources):
+            try:
+                with open(source, encoding="utf-8", errors="replace") as f:
+                    if len(sources) > 1:
+                        # Заголовки между файлами — как у head и tail
+                        out.write(("\n" if index else "") + f"==> {source} <==\n")
+                    export_stream(f, out, source, fmt)
+                total_bytes += os.path.getsize(source)
+            except OSError as e:
+                failed += 1
+                print(f"{source}: error: {e}", file=report)
+    else:
+        seen = {}
+        for source, relative in sources:
+            # Один и тот же файл, названный дважды (a и a/x.py), перезаписал бы свой же результат
+            if relative in seen:
+                raise ValueError(f"{seen[relative]} and {source} would be exported to the same file")
+            seen[relative] = source
+        tasks = [(source, os.path.join(output, relative + EXPORT_EXTENSIONS[fmt]), fmt)
+                 for source, relative in sources]
+        workers = pool_workers(jobs, len(tasks))
+        for source, size, error in pool_map(export_file, tasks, workers):
+            if error is not None:
+                failed += 1
+                print(f"{source}: error: {error}", file=report)
+            else:
+                total_bytes += size
+    print_throughput(report, len(sources) - failed, total_bytes, time.perf_counter() - start, workers, failed)
+    return 1 if failed else 0
+
+##############################
+# Main Editor Function
+##############################
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="unislate", description="Terminal text editor with syntax highlighting.")
+    parser.add_argument("files", nargs="*", metavar="file",
+                        help="file to open or create; with --batch, the files to edit")
+    parser.add_argument("--profile", action="store_true",
+                        help="show frame timings (p50/p99) and undo memory in the status bar")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="write per-frame phase timings as JSON lines to FILE (implies --profile)")
+    parser.add_argument("-f", "--follow", action="store_true",
+                        help="follow a growing file read-only, like tail -f (handles truncation and rotation)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="do not read or write the index and highlighting cache of large files")
+    parser.add_argument("--batch", metavar="SCRIPT",
+                        help="apply the edit script SCRIPT to every file without opening the editor")
+    parser.add_argument("--export", choices=("html", "ansi"),
+                        help="write the given files and directories with syntax highlighting instead of editing")
+    parser.add_argument("-o", "--output", metavar="DIR",
+                        help="directory for --export results (default: standard output)")
+    parser.add_argument("-j", "--jobs", type=int, metavar="N",
+                        help="worker processes for --batch and --export (default: one per CPU)")
+    options = parser.parse_args(argv)
+    if options.export is not None:
+        if not options.files:
+            parser.error("--export needs at least one file or directory")
+        if options.batch is not None or options.follow:
+            parser.error("--export cannot be combined with --batch or --follow")
+    elif options.output is not None:
+        parser.error("--output is only used with --export")
+    if options.batch is not None:
+        if not options.files:
+            parser.error("--batch needs at least one file")
+        if options.follow:
+            parser.error("--batch and --follow cannot be combined")
+    elif len(options.files) > 1 and options.export is None:
+        parser.error("only one file can be opened; use --batch to edit several")
+    if options.jobs is not None and options.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    options.filename = options.files[0] if options.files else None
+    if options.follow and not options.filename:
+        parser.error("--follow needs a file name")
+    return options
+
+def main(stdscr, options=None):
+    if options is None:
+        options = parse_args(sys.argv[1:])
+    # Инициализация curses – используем raw() чтобы Ctrl+C не обрабатывался терминалом
+    curses.noecho()
+    curses.raw()
+    stdscr.keypad(True)
+    # Сдвиг окна (scroll_rows) терминал выполняет сам: приходят только новые строки
+    stdscr.idlok(True)
+    curses.curs_set(1)
+    curses.start_color()
+    curses.use_default_colors()
+    stdscr.bkgd(' ', curses.A_NORMAL)
+    
+    signal.signal(signal.SIGINT, lambda sig, frame: None)
+    # Фоновые потоки (подсветка, поиск, запись) не должны подолгу держать GIL, пока ждёт ввод
+    sys.setswitchinterval(SWITCH_INTERVAL)
+
+    # Инициализация цветовых пар
+    curses.init_pair(1, curses.COLOR_WHITE, -1)    # default
+    curses.init_pair(2, curses.COLOR_CYAN, -1)       # keyword (жирный)
+    curses.init_pair(3, curses.COLOR_YELLOW, -1)     # string
+    curses.init_pair(4, curses.COLOR_GREEN, -1)      # comment
+    curses.init_pair(5, curses.COLOR_MAGENTA, -1)    # number
+    curses.init_pair(6, curses.COLOR_BLUE, -1)       # md_header
+    curses.init_pair(7, curses.COLOR_CYAN, -1)       # md_link
+    curses.init_pair(8, curses.COLOR_BLACK, curses.COLOR_YELLOW)  # search_match
+
+    colors = {
+        "default": curses.A_NORMAL,
+        "keyword": curses.color_pair(2) | curses.A_BOLD,
+        "string": curses.color_pair(3),
+        "comment": curses.color_pair(4),
+        "number": curses.color_pair(5),
+        "md_header": curses.color_pair(6) | curses.A_BOLD,
+        "md_link": curses.color_pair(7),
+        "search_match": curses.color_pair(8)
+    }
+
+    # Загрузка файла или приветственный экран
+    follower = None
+    watch = None
+    cache = None if options.no_cache else DiskCache()
+    cached = None
+    opened_signature = None
+    if options.filename and options.follow:
+        filename = options.filename
+        follower = FileFollower(filename)
+        buf = follower.buf
+    elif options.filename:
+        filename = options.filename
+        # Подпись файла снимается до чтения: правка между ними не потеряется
+        watch = FileWatch(filename)
+        opened_signature = watch.known
+        if cache is not None:
+            cached = cache.lookup(filename, opened_signature)
+        buf = load_file(filename, cached)
+    else:
+        draw_welcome(stdscr, colors)
+        filename = None
+        buf = TextBuffer()
+
+    ed = Editor(buf, *stdscr.getmaxyx())
+    history = ed.history
+    damage = ScreenDamage(buf)
+    lexer_states = LexerStates(buf, get_lexer(filename))
+    if cached is not None:
+        # Контрольные точки прошлого открытия: сверяются с первой же строкой и принимаются целиком
+        states = cached.states_for(lexer_states.lexer)
+        if states:
+            lexer_states.states = states
+    highlighter = HighlightWorker(lexer_states, colors)
+    profiler = None
+    if options.profile or options.trace:
+        profiler = FrameProfiler(options.trace)
+        # Запись undo меряется внутри "edit"; "highlight" — ожидание фоновой подсветки в кадре
+        buf.listeners[buf.listeners.index(history.record)] = profiler.timed("undo", history.record)
+    clipboard = Clipboard()
+    ed.clipboard = clipboard
+    saver = None  # Фоновое сохранение, если идёт
+    saved_seq = 0  # сколько правок журнала попало в сохраняемый снимок
+    journal = None  # Журнал несохранённых правок (есть, когда у буфера есть файл)
+    reloader = None  # Сравнение с изменившимся на диске файлом, если идёт
+    search_pattern = ""  # последний шаблон поиска — для F3 и замены
+    search_worker = None
+    message = None  # Временное сообщение в статусной строке
+    message_until = 0.0
+
+    if follower is not None:
+        # Слежение начинается с конца файла, как у tail -f
+        ed.cursor_y = buf.line_count() - 1
+        ed.offset_y = max(0, buf.line_count() - (stdscr.getmaxyx()[0] - 1))
+
+    def confirm(question):
+        # Вопрос в статусной строке; да — только 'y'
+        stdscr.move(height - 1, 0)
+        stdscr.clrtoeol()
+        stdscr.addstr(height - 1, 0, question, colors["default"])
+        stdscr.refresh()
+        answer = stdscr.getch()
+        damage.invalidate_status()
+        return answer in (ord('y'), ord('Y'))
 
-        # Вырезание: Ctrl+X
-        elif key == 24:
-            record_undo()
-            if selection_start is not None and selection_end is not None and selection_start != selection_end:
-                clipboard = get_selected_text(lines, selection_start, selection_end)
-                lines = remove_selected_text(lines, selection_start, selection_end)
-                (cursor_y, cursor_x) = selection_start
-                cancel_selection()
-                modified = True
+    def select_match(worker, index):
+        # Совпадение становится выделением, курсор — в его конец
+        ed.select(*worker.matches[index])
+
+    def run_search():
+        # Инкрементальный поиск: шаблон набирается в статусной строке,
+        # совпадения подсвечиваются по мере того, как их находит SearchWorker
+        nonlocal search_pattern, search_worker
+        origin = (ed.cursor_y, ed.cursor_x, ed.offset_y, ed.offset_x)
+        origin_offset = buf.offset(ed.cursor_y, ed.cursor_x)
+        pattern = search_pattern
+        worker = None
+        error = None
+        current = None
+        stale = True
+        while True:
+            if stale:
+                stale = False
+                if worker is not None:
+                    worker.cancel()
+                worker = None
+                error = None
+                current = None
+                ed.collapse()
+                ed.cursor_y, ed.cursor_x, ed.offset_y, ed.offset_x = origin
+                if pattern:
+                    try:
+                        worker = SearchWorker(buf, compile_search(pattern))
+                    except re.error as e:
+                        error = str(e)
+            if worker is not None and current is None:
+                current = worker.find_from(origin_offset)
+                if current is not None:
+                    select_match(worker, current)
+
+            rows, cols = stdscr.getmaxyx()
+            highlights = worker.visible(buf, ed.offset_y, ed.offset_y + rows - 2) if worker is not None else None
+            draw_editor(stdscr, buf, ed.cursor_y, ed.cursor_x, ed.offset_y, ed.offset_x, filename, colors,
+                        ed.selection_start, ed.selection_end, damage, lexer_states, None, highlights,
+                        highlighter=highlighter)
+            keys.frames += 1
+            if error is not None:
+                info = f"  [{error}]"
+            elif worker is not None:
+                more = "" if worker.finished else "+"
+                info = f"  [{0 if current is None else current + 1}/{worker.count()}{more}]"
             else:
-                clipboard = lines[cursor_y]
-                if len(lines) > 1:
-                    del lines[cursor_y]
-                    if cursor_y >= len(lines):
-                        cursor_y = len(lines) - 1
-                    cursor_x = min(cursor_x, len(lines[cursor_y]))
+                info = ""
+            prompt = "Find: " + pattern
+            try:
+                stdscr.addstr(rows - 1, 0, (prompt + info)[:cols - 1].ljust(cols - 1), colors["default"])
+                stdscr.move(rows - 1, min(len(prompt), cols - 1))
+            except curses.error:
+                pass
+            stdscr.refresh()
+            damage.invalidate_status()
+
+            key = keys.get(50 if worker is not None and not worker.finished else -1)
+            if key == -1:
+                continue
+            if key == KEY_PASTE:
+                pattern += keys.paste_text.split("\n", 1)[0]
+                stale = True
+            elif key == curses.KEY_RESIZE:
+                ed.height, ed.width = stdscr.getmaxyx()
+                damage.invalidate()
+            elif key == 27:  # Esc — вернуться туда, откуда начали
+                if worker is not None:
+                    worker.cancel()
+                ed.cancel_selection()
+                ed.cursor_y, ed.cursor_x, ed.offset_y, ed.offset_x = origin
+                return
+            elif key in (curses.KEY_ENTER, 10, 13):
+                search_pattern = pattern
+                search_worker = worker
+                return
+            elif key in (curses.KEY_BACKSPACE, 127, 8):
+                if pattern:
+                    pattern = pattern[:-1]
+                    stale = True
+            elif key in (curses.KEY_DOWN, curses.KEY_UP):
+                if worker is None or current is None:
+                    curses.beep()
+                    continue
+                start = worker.matches[current][0]
+                if key == curses.KEY_DOWN:
+                    index = worker.find_from(start + 1)
                 else:
-                    lines[0] = ""
-                    cursor_x = 0
-                modified = True
-            if pyperclip:
-                try:
-                    pyperclip.copy(clipboard)
-                except Exception:
-                    pass
+                    index = worker.find_from(start, backward=True)
+                if index is None:
+                    curses.beep()
+                else:
+                    current = index
+                    select_match(worker, current)
+            elif 0 <= key < 256 and chr(key).isprintable():
+                pattern += chr(key)
+                stale = True
+
+    def find_next():
+        # F3: следующее совпадение последнего шаблона от курсора
+        nonlocal search_worker
+        if not search_pattern:
+            return False
+        if search_worker is None or search_worker.version != buf.version:
+            if search_worker is not None:
+                search_worker.cancel()
+            search_worker = SearchWorker(buf, compile_search(search_pattern))
+        offset = buf.offset(ed.cursor_y, ed.cursor_x)
+        index = search_worker.find_from(offset)
+        while index is None and not search_worker.finished:
+            search_worker.done.wait(0.01)
+            index = search_worker.find_from(offset)
+        if index is None:
+            return False
+        select_match(search_worker, index)
+        return True
 
-        # Вставка: Ctrl+V
-        elif key == 22:
-            if pyperclip:
+    if watch is not None:
+        try:
+            journal_lock = lock_journal(filename)
+        except BlockingIOError:
+            # Журнал пишет другой запущенный редактор: это не остаток сбоя, не трогаем его
+            journal_lock = False
+            message = "File is open in another editor session; crash recovery is off"
+            message_until = time.monotonic() + 5
+    if watch is not None and journal_lock is not False:
+        # Журнал, оставшийся от упавшей сессии: предлагаем повторить его правки
+        height, width = ed.height, ed.width = stdscr.getmaxyx()
+        records = ()
+        base_text = None
+        recovered = read_journal(journal_path(filename))
+        if recovered is not None:
+            (kind, base), records = recovered
+            if kind == "file" and base != watch.known:
+                # Файл менялся после сбоя: правки к нему не приложить, но и выбрасывать их нельзя
                 try:
-                    clipboard = pyperclip.paste()
-                except Exception:
-                    pass
-            if clipboard:
-                record_undo()
-                if selection_start is not None and selection_end is not None and selection_start != selection_end:
-                    lines = remove_selected_text(lines, selection_start, selection_end)
-                    cursor_y, cursor_x = selection_start
-                    cancel_selection()
-                if "\n" in clipboard:
-                    clipboard_lines = clipboard.split("\n")
+                    kept = set_aside_journal(filename)
+                    message = f"Swap journal does not match the file; kept as {os.path.basename(kept)}"
+                except OSError as e:
+                    # Новый журнал затёр бы старые правки: лучше остаться без восстановления
+                    message = f"Swap journal does not match the file and could not be set aside: {e}"
+                    if journal_lock is not None:
+                        journal_lock.close()
+                    journal_lock = False
+                message_until = time.monotonic() + 5
+                records = ()
+            elif records and confirm(f"Recover {len(records)} unsaved edits from a crashed session? (y/n): "):
+                buf.finish_loading()
+                history.begin(ed.get_state())
+                try:
+                    if kind == "text":
+                        buf.delete(0, len(buf))
+                        buf.insert(0, base)
+                        base_text = base
+                    replay_journal(buf, records)
+                    ed.modified = True
+                    message = f"Recovered unsaved edits: {len(records)}"
+                except ValueError as e:
+                    history.undo(buf, ed.get_state())
+                    history.redo_stack.clear()
+                    message = f"Recovery failed: {e}"
+                    records = ()
+                    base_text = None
+                message_until = time.monotonic() + 2
+            else:
+                records = ()
+        if journal_lock is not False:
+            journal = EditJournal(filename, watch.known, records, base_text, journal_lock)
+            buf.listeners.append(journal.record)
+
+    keys = KeyReader(stdscr)
+    keys.set_bracketed_paste(True)
+
+    while True:
+        height, width = ed.height, ed.width = stdscr.getmaxyx()
+        # Большой файл дочитывается в фоне: подхватываем новые строки и не блокируемся в getch
+        old_line_count = buf.line_count()
+        first_new_line = buf.poll()
+        if first_new_line is not None:
+            damage.mark_from(first_new_line)
+            lexer_states.invalidate_from(first_new_line)
+        if follower is not None:
+            followed = follower.poll()
+            if followed is not None:
+                first_line, note = followed
+                damage.mark_from(first_line)
+                lexer_states.invalidate_from(first_line)
+                if note is not None:
+                    # Файл усечён или подменён: прежние позиции ничего не значат
+                    message = note
+                    message_until = time.monotonic() + 2
+                    ed.collapse()
+                    damage.invalidate()
+            if buf.line_count() != old_line_count or followed is not None:
+                if ed.offset_y + height - 1 >= old_line_count and ed.selection_start is None:
+                    # Конец файла был на экране — едем за ним, как tail -f
+                    ed.cursor_y = buf.line_count() - 1
+                    ed.cursor_x = 0
+                    ed.offset_y = max(0, buf.line_count() - (height - 1))
+                else:
+                    ed.cursor_y = min(ed.cursor_y, buf.line_count() - 1)
+                    ed.cursor_x = min(ed.cursor_x, buf.line_length(ed.cursor_y))
+                    ed.offset_y = min(ed.offset_y, ed.cursor_y)
+        if saver is not None and saver.finished:
+            damage.forget_file(saver.filename)
+            if saver.error is not None:
+                message = f"Save failed: {saver.error}"
+            else:
+                # Правки, сделанные во время записи, в файл не попали
+                if buf.version == saver.version:
+                    ed.modified = False
+                message = f"Saved: {saver.filename}"
+                # На диске теперь то, что записали мы сами
+                watch = FileWatch(saver.filename)
+                if journal is not None:
+                    journal.rebase(saved_seq, watch.known)
+                elif not os.path.exists(journal_path(saver.filename)):
+                    # Чужой или отложенный журнал не затираем: остаёмся без восстановления
+                    try:
+                        journal_lock = lock_journal(saver.filename)
+                    except BlockingIOError:
+                        journal_lock = False
+                    if journal_lock is not False:
+                        journal = EditJournal(saver.filename, watch.known, lock=journal_lock)
+                        buf.listeners.append(journal.record)
+            message_until = time.monotonic() + 2
+            saver = None
+        if watch is not None and saver is None and reloader is None and watch.changed():
+            # Файл переписал кто-то другой: сравниваем в фоне, применим только разницу
+            damage.forget_file(watch.filename)
+            signature = file_signature(watch.filename)
+            if signature is None:
+                watch.acknowledge()  # удалён: перечитывать нечего, Ctrl+S создаст его снова
+            elif buf.source is None and signature[1] < LARGE_FILE_THRESHOLD:
+                reloader = FileReloader(watch.filename, buf)
+            else:
+                # Большой файл не сравниваем: это две полные копии текста в памяти, а чтение
+                # старого отображения усечённого файла кончается SIGBUS. Отображаем заново
+                if not ed.modified or confirm("File changed on disk. Reload it? Unsaved edits will be lost (y/n): "):
+                    try:
+                        buf.load_mapped(MappedSource(watch.filename))
+                    except (OSError, ValueError) as e:
+                        message = f"Reload failed: {e}"
+                    else:
+                        history.clear()
+                        ed.modified = False
+                        ed.collapse()
+                        ed.clamp_cursor()
+                        ed.scroll_to_cursor()
+                        lexer_states.invalidate_from(0)
+                        damage.invalidate()
+                        if journal is not None:
+                            journal.rebase(journal.seq, signature)
+                        message = "File changed on disk; reloaded"
                 else:
-                    clipboard_lines = [clipboard]
-                if len(clipboard_lines) == 1:
-                    line = lines[cursor_y]
-                    lines[cursor_y] = line[:cursor_x] + clipboard_lines[0] + line[cursor_x:]
-                    cursor_x += len(clipboard_lines[0])
+                    message = "Kept unsaved edits; saving will overwrite the file"
+                message_until = time.monotonic() + 2
+                watch.acknowledge(signature)
+        if reloader is not None and reloader.finished:
+            if reloader.error is not None:
+                watch.acknowledge()
+                message = f"Reload failed: {reloader.error}"
+                message_until = time.monotonic() + 2
+                reloader = None
+            elif buf.version != reloader.version:
+                reloader = FileReloader(watch.filename, buf)  # буфер успел измениться — сравниваем заново
+            else:
+                # Формат файла (переводы строк) берём с диска, даже если текст тот же
+                buf.newline, buf.final_newline = reloader.newline, reloader.final_newline
+                if not reloader.edits:
+                    ed.modified = False  # на диске тот же текст, что и в буфере
+                elif not ed.modified or confirm("File changed on disk. Reload it? Unsaved edits stay in undo (y/n): "):
+                    ed.apply_diff(reloader.edits, reloader.opcodes)
+                    message = "File changed on disk; reloaded"
                 else:
-                    line = lines[cursor_y]
-                    before = line[:cursor_x]
-                    after = line[cursor_x:]
-                    new_lines = [before + clipboard_lines[0]] + clipboard_lines[1:-1] + [clipboard_lines[-1] + after]
-                    lines[cursor_y:cursor_y+1] = new_lines
-                    cursor_y = cursor_y + len(new_lines) - 1
-                    cursor_x = len(clipboard_lines[-1])
-                modified = True
-
-        # Backspace
-        elif key in (curses.KEY_BACKSPACE, 127, 8):
-            if cursor_x > 0:
-                record_undo()
-                line = lines[cursor_y]
-                lines[cursor_y] = line[:cursor_x - 1] + line[cursor_x:]
-                cursor_x -= 1
-                modified = True
-                cancel_selection()
-            elif cursor_y > 0:
-                record_undo()
-                prev_line = lines[cursor_y - 1]
-                curr_line = lines[cursor_y]
-                cursor_x = len(prev_line)
-                lines[cursor_y - 1] = prev_line + curr_line
-                del lines[cursor_y]
-                cursor_y -= 1
-                modified = True
-                cancel_selection()
-
-        # Enter
-        elif key in (curses.KEY_ENTER, 10, 13):
-            record_undo()
-            line = lines[cursor_y]
-            indent_match = re.match(r'(\s*)', line)
-            indent = indent_match.group(1) if indent_match else ""
-            new_line = indent + line[cursor_x:]
-            lines[cursor_y] = line[:cursor_x]
-            lines.insert(cursor_y + 1, new_line)
-            cursor_y += 1
-            cursor_x = len(indent)
-            if cursor_y >= offset_y + height - 1:
-                offset_y += 1
-            modified = True
-            cancel_selection()
-
-        # Tab
-        elif key == 9:
-            record_undo()
-            line = lines[cursor_y]
-            lines[cursor_y] = line[:cursor_x] + TAB_SPACES + line[cursor_x:]
-            cursor_x += len(TAB_SPACES)
-            modified = True
-            cancel_selection()
-
-        # Печатаемые символы
+                    message = "Kept unsaved edits; saving will overwrite the file"
+                if journal is not None:
+                    # Журнал отсчитывается от файла на диске, а тот стал другим
+                    if ed.modified:
+                        journal.rebase(journal.seq, text=buf.text())
+                    else:
+                        journal.rebase(journal.seq, reloader.signature)
+                if reloader.edits:
+                    message_until = time.monotonic() + 2
+                watch.acknowledge(reloader.signature)
+                reloader = None
+        if journal is not None and journal.error is not None:
+            message = f"Swap journal failed: {journal.error}"
+            message_until = time.monotonic() + 2
+            journal.error = None
+        if saver is not None:
+            status_message = f"SAVING {saver.progress()}%"
+        elif message is not None and time.monotonic() < message_until:
+            status_message = message
         else:
+            status_message = message = None
+        if status_message is None and profiler is not None:
+            status_message = profiler.overlay(history.bytes_used)
+        if status_message is None and follower is not None and not buf.loading:
+            status_message = "FOLLOW"
+        if status_message is None and ed.carets:
+            status_message = f"{len(ed.carets) + 1} CURSORS"
+        # Сначала разбираем всё, что уже пришло с терминала, и только потом рисуем кадр
+        key = keys.get(0)
+        if key == -1:
+            # Любая правка или перемещение могли увести курсор за край окна
+            ed.offset_x = follow_cursor_x(ed.cursor_x, ed.offset_x, width - line_number_width(buf.line_count()))
+            if profiler is not None:
+                profiler.switch("draw")
+            draw_editor(stdscr, buf, ed.cursor_y, ed.cursor_x, ed.offset_y, ed.offset_x, filename, colors,
+                        ed.selection_start, ed.selection_end, damage, lexer_states, status_message, profiler=profiler, highlighter=highlighter,
+                        carets=ed.caret_ranges(ed.offset_y, ed.offset_y + height - 2) if ed.carets else None)
+            keys.frames += 1
+            if profiler is not None:
+                profiler.add("input", keys.decode_time)
+                keys.decode_time = 0.0
+                profiler.end_frame(keys=keys.keys, lines=buf.line_count(), undo_bytes=history.bytes_used)
+            if highlighter.busy or clipboard.busy or (follower is not None and follower.busy):
+                key = keys.get(HIGHLIGHT_POLL_MS)
+            elif follower is not None:
+                key = keys.get(FOLLOW_POLL_MS)
+            elif buf.loading or saver is not None or reloader is not None or message is not None:
+                key = keys.get(100)
+            elif watch is not None:
+                key = keys.get(int(FILE_CHECK_INTERVAL * 1000))
+            else:
+                key = keys.get(-1)
+        if profiler is not None:
+            profiler.switch("edit")
+        if key == -1:
+            # Таймаут ожидания ввода: возвращаемся за фоновыми результатами.
+            # Без этого -1 совпадал бы с KEY_SUP/KEY_SDOWN там, где их нет в curses
+            continue
+
+        if follower is not None and key not in FOLLOW_KEYS:
+            curses.beep()
+            continue
+
+        if key == KEY_PASTE:
+            if keys.paste_text:
+                ed.paste(keys.paste_text)
+            continue
+
+        if key == curses.KEY_RESIZE:
+            stdscr.clear()
+            damage.invalidate()
+            ed.offset_y = 0
+            ed.offset_x = 0
+            continue
+
+        # Выход: Ctrl+Q (код 17)
+        if key == 17:
+            if saver is not None:
+                # Не обрываем запись на полпути
+                saver.wait()
+                if saver.error is None and buf.version == saver.version:
+                    ed.modified = False
+                saver = None
+            if ed.modified and not confirm("Unsaved changes! Quit without saving? (y/n): "):
+                continue
+            break
+
+        elif key == 19:  # Сохранение Ctrl+S
+            damage.invalidate_status()
+            if saver is not None:
+                curses.beep()
+                continue
+            if not filename:
+                name = prompt_user_cancelable(stdscr, "Save as: ")
+                if name is None or name == "":
+                    continue
+                filename = name
+            if (watch is not None and watch.filename == filename and watch.changed(force=True)
+                    and file_signature(filename) is not None and not confirm("File changed on disk since it was read. Overwrite it? (y/n): ")):
+                continue
+            try:
+                saver = FileSaver(filename, buf)
+                saved_seq = journal.seq if journal is not None else 0
+            except Exception as e:
+                message = f"Save failed: {e}"
+                message_until = time.monotonic() + 2
+
+        elif key == 6:  # Поиск: Ctrl+F
+            run_search()
+
+        elif key == 7:  # Переход к строке: Ctrl+G
+            damage.invalidate_status()
+            answer = prompt_user_cancelable(stdscr, f"Go to line (1-{buf.line_count()}, line:col): ")
+            if not answer:
+                continue
+            line_no, _, col = answer.partition(":")
             try:
-                ch = chr(key)
+                ed.goto(int(line_no) - 1, int(col) - 1 if col else 0)
             except ValueError:
+                message = f"Not a line number: {answer}"
+                message_until = time.monotonic() + 2
+
+        elif key == curses.KEY_F3:  # Следующее совпадение
+            if not find_next():
+                curses.beep()
+
+        elif key == 18:  # Замена всех совпадений: Ctrl+R
+            damage.invalidate_status()
+            pattern = prompt_user_cancelable(stdscr, "Replace (regex): ", strip=False)
+            if not pattern:
+                continue
+            repl = prompt_user_cancelable(stdscr, "Replace with: ", strip=False)
+            if repl is None:
                 continue
-            if ch.isprintable():
-                record_undo()
-                line = lines[cursor_y]
-                lines[cursor_y] = line[:cursor_x] + ch + line[cursor_x:]
-                cursor_x += 1
-                if cursor_x >= offset_x + width:
-                    offset_x += 1
-                modified = True
-                cancel_selection()
+            try:
+                regex = compile_search(pattern)
+                count = ed.replace_all(regex, repl)
+            except re.error as e:
+                message = f"Bad regex: {e}"
+            else:
+                search_pattern = pattern
+                message = f"Replaced {count} match{'es' if count != 1 else ''}"
+            message_until = time.monotonic() + 2
 
+        # Перемещение, выделение, undo/redo, копирование и набор текста
+        elif not ed.key(key):
+            curses.beep()
+
+    highlighter.close()
+    clipboard.close()
+    if journal is not None:
+        journal.close()
+    if (cache is not None and opened_signature is not None and buf.source is not None
+            and not buf.loading and buf.version == 0 and filename == options.filename):
+        # Файл не правили: индекс и проверенные точки годятся для следующего открытия
+        states = lexer_states.states[:lexer_states.valid]
+        if cached is None or len(states) > cached.state_count:
+            cache.store(filename, opened_signature, buf.source, lexer_states.lexer, states)
+    if follower is not None:
+        follower.close()
+    if profiler is not None:
+        profiler.close()
     stdscr.clear()
     stdscr.refresh()
 
 def main_wrapper():
-    curses.wrapper(main)
+    options = parse_args(sys.argv[1:])
+    if options.batch is not None:
+        try:
+            sys.exit(run_batch(options.batch, options.files, options.jobs))
+        except (OSError, ValueError) as e:
+            sys.exit(f"unislate: {options.batch}: {e}")
+    if options.export is not None:
+        try:
+            sys.exit(run_export(options.export, options.files, options.output, options.jobs))
+        except ValueError as e:
+            sys.exit(f"unislate: {e}")
+    try:
+        curses.wrapper(main, options)
+    finally:
+        KeyReader.set_bracketed_paste(False)
 
 if __name__ == '__main__':
     main_wrapper()